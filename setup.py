@@ -12,6 +12,9 @@ setup(
     entry_points={'console_scripts': [
         'cpu = simple_cpu.cpu:main',
         'asm = simple_cpu.asm:main',
+        'cpu-fuzz = simple_cpu.fuzz:main',
+        'cpu-replay = simple_cpu.replay:main',
+        'cpu-run = simple_cpu.runner:main',
     ]},
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -24,5 +27,6 @@ setup(
     keywords='cpu simulator virtual machine assembler',
     url='https://bitbucket.org/kveroneau/simple-cpu',
     packages=find_packages(),
+    extras_require={'batch': ['numpy']},
     zip_safe=False,
 )
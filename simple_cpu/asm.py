@@ -1,7 +1,9 @@
 from cmd import Cmd
 from simple_cpu.cpu import CPU, CPUException, UInt16
+from simple_cpu.decoder import FIXED
 import shlex, readline, os, sys
 from simple_cpu.devices import ConIOHook, HelloWorldHook
+from simple_cpu.peephole import PeepholeOptimizer
 try:
     from simple_cpu.framebuffer import VGAConsoleDevice
 except ImportError:
@@ -23,6 +25,15 @@ class Coder(Cmd):
         'call': 9,
         'je': 15,
         'jne': 16,
+        'jl': 27,
+        'jg': 28,
+        'jle': 29,
+        'jge': 30,
+        'jb': 31,
+        'ja': 32,
+        'jbe': 33,
+        'jae': 34,
+        'tsw': 35,
     }
     bcX_map = {
         'int': [1,0],
@@ -45,6 +56,7 @@ class Coder(Cmd):
         'or': 23,
         'xor': 24,
         'not': 25,
+        'cas': 36,
     }
     bc0_map = {
         'pushf': 20,
@@ -77,6 +89,16 @@ class Coder(Cmd):
         'xor':  0x18,
         'not':  0x19,
         'ret':  0x1a,
+        'jl':   0x1b,
+        'jg':   0x1c,
+        'jle':  0x1d,
+        'jge':  0x1e,
+        'jb':   0x1f,
+        'ja':   0x20,
+        'jbe':  0x21,
+        'jae':  0x22,
+        'tsw':  0x23,
+        'cas':  0x24,
     }
     mov_map = {
         'ax':   0xa0,
@@ -111,6 +133,7 @@ class Coder(Cmd):
         self.cpu = cpu
         self.labels = {}
         self.cseg = 0
+        self.memsnapshot = None
     def unknown_command(self, line):
         self.stdout.write('*** Unknown syntax: %s\n'%line)
     def emptyline(self):
@@ -125,18 +148,18 @@ class Coder(Cmd):
         except CPUException, e:
             self.stdout.write('CPUException: %s\n' % e)
     def get_label(self, lbl, reference=True):
-        """ This method is used to translate variables in the assembly code. """
+        """
+        This method is used to translate variables in the assembly code.  A label which isn't defined yet translates
+        to None, and the address of the operand about to be written is kept so that do_label can patch it.
+        """
         if lbl[0] == '*':
             label = lbl[1:]
             if reference == False:
                 return self.labels[label][0]
-            elif label in self.labels:
-                self.labels[label][1].append(self.ptr)
-                ptr = self.labels[label][0]
-            else:
-                self.labels[label] = [0,[self.ptr]]
-                ptr = 0
-            return ptr
+            elif label in self.labels and self.labels[label][0] is not None:
+                return self.labels[label][0]
+            self.labels.setdefault(label, [None, []])[1].append(self.cpu.mem.ptr)
+            return None
         return lbl
     def get_int(self, arg):
         """ This method is used to translate an argument into an integer we can write into memory. """
@@ -149,34 +172,55 @@ class Coder(Cmd):
         except:
             return 0
     def write_type(self, typ, value):
-        """ This method is used to write specific type information about an integer into memory. """
-        b = value&0xf
-        self.cpu.mem.write(b|typ<<4)
-        if value < 16:
-            return
-        elif value < 4096:
-            self.cpu.mem.write(value>>4)
-        else:
-            self.cpu.mem.write16(value>>4)
-    def write_value(self, value):
+        """ This method is used to write specific type information about an integer into memory, as wide as its type. """
+        self.cpu.mem.write(value&0xf|typ<<4)
+        if typ in (2,4,):
+            self.cpu.mem.write(value>>4&0xff)
+        elif typ in (3,5,):
+            self.cpu.mem.write16(value>>4&0xffff)
+    def operand(self, value):
+        """ Translates an argument into the (type, value) it is encoded as, or None if it's too large to encode. """
         if value in self.var_map:
-            self.cpu.mem.write(self.var_map[value])
+            return 0, self.var_map[value]
         elif value.startswith('&'):
             value = self.get_label(value[1:])
+            if value is None:
+                return 5, 0
             if isinstance(value, str):
                 value = int(value[1:], 16)
             if value < 4096:
-                self.write_type(4, value)
+                return 4, value
             elif value < 1048576:
-                self.write_type(5, value)
+                return 5, value
         else:
             value = self.get_int(value)
-            if value < 16:
-                self.write_type(1, value)
+            if value is None:
+                return 3, 0
+            elif value < 16:
+                return 1, value
             elif value < 4096:
-                self.write_type(2, value)
+                return 2, value
             elif value < 1048576:
-                self.write_type(3, value)
+                return 3, value
+        return None
+    def write_value(self, value):
+        operand = self.operand(value)
+        if operand is not None:
+            self.write_type(*operand)
+    def write_fixed(self, op, args):
+        """ Writes an instruction in the fixed-width encoding, used when the CPU being assembled for executes that. """
+        ptr = self.cpu.mem.ptr
+        operands = []
+        for i, arg in enumerate(args):
+            self.cpu.mem.ptr = ptr+4+i*2
+            operand = self.operand(arg)
+            if operand is None or operand[1] > 0xFFFF:
+                self.cpu.mem.ptr = ptr
+                raise CPUException('%s does not fit in a fixed-width operand.' % arg)
+            operands.append(operand)
+        operands += [(0, 0)]*(2-len(operands))
+        self.cpu.mem.writeblock(ptr, FIXED.pack(op, operands[0][0], operands[1][0], operands[0][1], operands[1][1]))
+        self.cpu.mem.ptr = ptr+FIXED.size
     def default(self, line):
         if line.startswith('#'):
             return False
@@ -204,6 +248,9 @@ class Coder(Cmd):
         if op not in self.bc_map:
             self.unknown_command(line)
             return
+        if self.cpu.fixed:
+            self.write_fixed(self.bc_map[op], arg.split(',')[::-1] if arg != '' else [])
+            return
         self.cpu.mem.write(self.bc_map[op])
         try:
             a1,a2 = arg.split(',')
@@ -235,6 +282,8 @@ class Coder(Cmd):
         if args != '':
             args = self.get_label(args, False)
             self.cpu.mem.ptr = self.get_int(args)
+        elif self.cpu.symbols:
+            print '%s (%s)' % (self.ptr, self.cpu.symbols.describe(self.ptr))
         else:
             print self.ptr
     def do_label(self, args):
@@ -242,12 +291,17 @@ class Coder(Cmd):
         if args != '':
             if args.startswith('!'):
                 self.cseg = 0
-            if args in self.labels:
-                self.labels[args][0] = self.cpu.mem.ptr-self.cseg
-                for ptr in self.labels[args][1]:
-                    self.cpu.mem[ptr] = UInt16(self.labels[args][0])
-            else:
-                self.labels[args] = [self.cpu.mem.ptr-self.cseg, []]
+            value = self.cpu.mem.ptr-self.cseg
+            ptr = self.cpu.mem.ptr
+            for ref in self.labels.get(args, [None, []])[1]:
+                if self.cpu.fixed:
+                    self.cpu.mem.write16(ref, value)
+                    continue
+                self.cpu.mem.ptr = ref
+                self.write_type(self.cpu.mem.read(ref)>>4, value)
+            self.cpu.mem.ptr = ptr
+            self.labels[args] = [value, []]
+            self.cpu.symbols.add(args, ptr)
             if args.startswith('!'):
                 self.cseg = self.cpu.mem.ptr
         else:
@@ -281,9 +335,9 @@ class Coder(Cmd):
         s = shlex.split(args)
         if len(s) > 0:
             if len(s) == 1:
-                self.cpu.savebin(s[0], 0, self.cpu.mem.ptr)
+                self.cpu.savebin(s[0], 0, self.cpu.mem.ptr, code=True)
             else:
-                self.cpu.savebin(s[0], self.cpu.mem.ptr, int(s[1]))
+                self.cpu.savebin(s[0], self.cpu.mem.ptr, int(s[1]), code=True)
     def do_loadbin(self, args):
         """ Loads a binary image from disc into memory. """
         s = shlex.split(args)
@@ -295,13 +349,15 @@ class Coder(Cmd):
         self.cpu.mem.clear()
         readline.clear_history()
     def do_data(self, args):
-        """ Stores a zero-terminated string to the current memory address. """
+        """ Stores a zero-terminated string to the current memory address, padded to the next instruction when fixed-width. """
         s = shlex.split(args)
         if len(s) > 0:
             data = s[0].replace('\\n', '\n').replace('\\x00', '\x00')
             for c in data:
                 self.cpu.mem.write(ord(c))
             self.cpu.mem.write(0)
+            while self.cpu.fixed and self.cpu.mem.ptr % FIXED.size:
+                self.cpu.mem.write(0)
     def do_poke(self, args):
         """ Stores a raw byte at a specific memory location. """
         if args != '':
@@ -340,6 +396,7 @@ class Coder(Cmd):
         if args == '':
             print self.cpu.get_value()
     def do_hexdump(self, args):
+        """ Shows memory in rows of 16 bytes, from an address or over a start:stop range given in hex. """
         if args != '':
             try:
                 start,stop = args.split(':')
@@ -349,16 +406,42 @@ class Coder(Cmd):
                 stop = start+16
         else:
             start,stop = self.ptr,self.ptr+16
-        ptr = start
-        while ptr<stop-1:
-            self.stdout.write('%s: ' % hex(ptr))
-            for i in range(0,16):
-                try:
-                    self.stdout.write('%s  ' % hex(self.cpu.mem.read(ptr)))
-                except:
-                    self.stdout.write('0x0  ')
-                ptr+=1
+        lines = max(0, (stop-start+14)//16)
+        data = self.cpu.mem.readrange(start, lines*16)
+        for line in range(0, len(data), 16):
+            self.stdout.write('%s: ' % hex(start+line))
+            self.stdout.write(''.join('%s  ' % hex(ord(c)) for c in data[line:line+16]))
             self.stdout.write('\n')
+    def do_search(self, args):
+        """ Finds a quoted string, or hex bytes such as: search de ad be ef, anywhere in memory. """
+        s = shlex.split(args)
+        if len(s) == 0:
+            self.stdout.write('Please specify a string or hex bytes to search for.\n')
+            return False
+        if args.strip()[0] in ('"', "'",):
+            pattern = s[0]
+        else:
+            try:
+                pattern = ''.join(chr(int(value, 16)) for value in s)
+            except ValueError:
+                self.stdout.write('Please provide hex bytes, or a quoted string.\n')
+                return False
+        found = self.cpu.mem.search(pattern)
+        if found:
+            self.columnize([hex(addr) for addr in found])
+        else:
+            self.stdout.write('Not found.\n')
+    def do_snapshot(self, args):
+        """ Takes a copy of memory which the diff command compares with. """
+        self.memsnapshot = self.cpu.mem.snapshot()
+        self.stdout.write('Snapshot taken of %d memory blocks.\n' % len(self.memsnapshot))
+    def do_diff(self, args):
+        """ Shows the memory which has changed since the last snapshot command. """
+        if self.memsnapshot is None:
+            self.stdout.write('Please take a snapshot first.\n')
+            return False
+        for addr, old, new in self.cpu.mem.diff(self.memsnapshot):
+            self.stdout.write('%s: %s -> %s\n' % (hex(addr), ' '.join(hex(ord(c)) for c in old), ' '.join(hex(ord(c)) for c in new)))
     def do_hex(self, args):
         """ Convert a decimal number to a hex. """
         if args != '':
@@ -377,8 +460,14 @@ class Coder(Cmd):
             value = int(args)
             self.stdout.write('%s (%s)\n' % (hex(value), chr(value)))
     def do_bp(self, args):
-        """ Sets a breakpoint at the current memory location. """
-        if args != '':
+        """ Sets a breakpoint at the current memory location, an address, or a label such as *loop. """
+        if args.startswith('*'):
+            addr = self.cpu.symbols.address(args[1:])
+            if addr is None:
+                self.stdout.write('There is no label %s.\n' % args[1:])
+                return
+            self.cpu.bp = addr
+        elif args != '':
             self.cpu.bp = int(args)
         else:
             self.cpu.bp = self.ptr
@@ -441,7 +530,6 @@ class Coder(Cmd):
         if len(s) != 3:
             self.stdout.write('Please specify the following: src, dest, size\n')
             return False
-        optr = self.cpu.mem.ptr
         try:
             src = int(s[0])
             dest = int(s[1])
@@ -450,32 +538,9 @@ class Coder(Cmd):
             self.stdout.write('Please provide numeric parameters only.\n')
             return False
         try:
-            self.cpu.mem.ptr = src
-            buf = self.cpu.mem.read(size)
-        except:
-            self.stdout.write('There was an error during the read operation.\n')
-            self.cpu.mem.ptr = optr
-            return False
-        try:
-            self.cpu.mem.memclear(src, size)
+            self.cpu.mem.memmove(src, dest, size)
         except:
-            self.stdout.write('There was an error during the clear operation.\n')
-            self.cpu.mem.ptr = src
-            self.cpu.mem.write(buf)
-            self.cpu.mem.ptr = optr
-            return False
-        try:
-            self.cpu.mem.ptr = dest
-            old = self.cpu.mem.read(size)
-            self.cpu.mem.ptr = dest
-            self.cpu.mem.write(buf)
-        except:
-            self.stdout.write('There was an error during the write operation.\n')
-            self.cpu.mem.ptr = dest
-            self.cpu.mem.write(old)
-            self.cpu.mem.ptr = src
-            self.cpu.mem.write(buf)
-            self.cpu.mem.ptr = optr
+            self.stdout.write('There was an error during the move operation.\n')
     def do_stepping(self, args):
         """ Turn on or off register stepping for each command run. """
         if args == 'off':
@@ -494,6 +559,8 @@ def main():
     parser = OptionParser('%prog -c|-o OUTPUT SOURCE')
     parser.add_option('--source', dest='source', help='Compile source code file into a binary image')
     parser.add_option('-o', '--output', dest='output', help='Specify a filename for the assembled binary image')
+    parser.add_option('-O', '--optimize', action='store_true', dest='optimize', default=False, help='Run the peephole optimizer over the source before assembling it')
+    parser.add_option('--fixed', action='store_true', dest='fixed', default=False, help='Assemble into the fixed-width encoding, which is larger but faster to decode')
     parser.add_option('-c', '--cli', action='store_true', dest='cli', default=False, help='Start the command-line assembler/debugger')
     parser.add_option('--vgaconsole', action='store_true', dest='enable_vga', default=False, help='Enable the VGAConsole framebuffer device')
     options, args = parser.parse_args()
@@ -507,17 +574,27 @@ def main():
             parser.error('You can only supply a single source file.')
         source = options.source
     c = CPU()
+    c.fixed = options.fixed
     cli = Coder()
     cli.configure(c)
     if source is not None:
-        cli.do_source(sys.argv[1])
+        if options.optimize:
+            optimizer = PeepholeOptimizer(cli)
+            cli.cmdqueue.extend(optimizer.optimize(open(source, 'r').readlines()))
+            report = optimizer.report
+            if 'skipped' in report:
+                sys.stdout.write('%s: not optimized, %s.\n' % (source, report['skipped']))
+            else:
+                sys.stdout.write('%s: %d -> %d instructions, %d -> %d bytes\n' % ((source,)+report['instructions']+report['bytes']))
+        else:
+            cli.do_source(source)
         cli.cmdqueue.append('.')
         cli.cmdloop('Assembling %s...' % source)
         if options.output:
             fname = options.output
         else:
             fname = '%s.bin' % source.split('.')[0]
-        c.savebin(fname, 0, c.mem.ptr)
+        c.savebin(fname, 0, c.mem.ptr, code=True)
     elif options.cli:
         c.add_device(ConIOHook)
         c.add_device(HelloWorldHook)
@@ -0,0 +1,310 @@
+from simple_cpu.exceptions import CPUException
+from simple_cpu.cpu import CPURegisters, ZERO, CARRY, SIGN, OVERFLOW
+from simple_cpu.decoder import decode
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+REGISTERS = CPURegisters.registers
+IP, AX, SP, CS, DS, SS, CR = [REGISTERS.index(reg) for reg in ('ip', 'ax', 'sp', 'cs', 'ds', 'ss', 'cr')]
+ZF, CF, SF, OF = [1<<bit for bit in (ZERO, CARRY, SIGN, OVERFLOW)]
+
+class BatchCPU(object):
+    """
+    This runs the same program on many virtual machines at once, keeping the registers and memory of every instance
+    in NumPy arrays.  Each step executes one instruction on every running instance: instances whose code pointer agrees
+    are grouped, the instruction is decoded once with the same encoding CPU.get_value reads, and the opcode is applied
+    to the whole group as vector operations.  Instances that branch differently simply fall into separate groups.
+    All instances must run the same code image, and the engine has no devices, so IN and OUT are errors.
+    An instance which faults is stopped and its error message recorded in *errors*, the others carry on.
+    """
+    def __init__(self, count, size=0x10000):
+        if numpy is None:
+            raise CPUException('The batch engine requires NumPy.')
+        self.count = count
+        self.size = size
+        self.regs = numpy.zeros((count, len(REGISTERS)), numpy.int64)
+        self.flags = numpy.zeros(count, numpy.int64)
+        self.mem = numpy.zeros((count, size), numpy.uint8)
+        self.running = numpy.zeros(count, bool)
+        self.faulted = numpy.zeros(count, bool)
+        self.errors = {}
+        self.int_table = 0xFFFF-512
+        self.steps = 0
+        self.__opcodes = {}
+        for name in dir(self.__class__):
+            if name[:7] == 'opcode_':
+                self.__opcodes.update({int(name[7:], 16):getattr(self, name)})
+    @property
+    def var_map(self):
+        return REGISTERS
+    def register(self, name):
+        """ Returns the column of register *name* for every instance, as a writable view. """
+        return self.regs[:, REGISTERS.index(name)]
+    def loadbin(self, filename, dest):
+        self.writeblock(dest, open(filename, 'rb').read())
+    def writeblock(self, dest, block, index=slice(None)):
+        """ Copies a block of data into the memory of every instance, or only those selected by *index*. """
+        data = numpy.frombuffer(block, numpy.uint8)
+        self.mem[index, dest:dest+len(data)] = data
+    def readblock(self, index, addr, size):
+        return self.mem[index, addr:addr+size].tostring()
+    def read8(self, idx, addr):
+        return self.mem[idx, addr%self.size].astype(numpy.int64)
+    def read16(self, idx, addr):
+        return self.read8(idx, addr)|self.read8(idx, addr+1)<<8
+    def write8(self, idx, addr, value):
+        self.mem[idx, addr%self.size] = value&0xFF
+    def write16(self, idx, addr, value):
+        self.write8(idx, addr, value)
+        self.write8(idx, addr+1, value>>8)
+    def resolve(self, idx, operand):
+        typ, value = operand
+        if typ == 0:
+            return self.regs[idx, value]
+        elif typ == 4:
+            return self.read8(idx, value)
+        elif typ == 5:
+            return self.read16(idx, value)
+        return numpy.full(len(idx), value, numpy.int64)
+    def set_value(self, idx, dst, src, valid=None):
+        typ, value = dst
+        if valid is not None and typ not in valid:
+            raise CPUException('Attempted to place data in invalid location for specific operation.')
+        if typ == 0:
+            self.regs[idx, value] = src
+        elif typ in (4,5,):
+            addr = self.regs[idx, DS]+value
+            small = src < 256
+            self.write8(idx, addr, src)
+            self.write8(idx[~small], addr[~small]+1, src[~small]>>8)
+        else:
+            raise CPUException('Attempted to move data into immediate value.')
+    def push(self, idx, value):
+        self.write16(idx, self.regs[idx, SS]+self.regs[idx, SP], value)
+        self.regs[idx, SP] += 2
+    def pop(self, idx):
+        self.regs[idx, SP] -= 2
+        return self.read16(idx, self.regs[idx, SS]+self.regs[idx, SP])
+    def fault(self, idx, message):
+        for i in idx:
+            self.errors[int(i)] = message
+        self.running[idx] = False
+        self.faulted[idx] = True
+    def run(self, cs=0, persistent=[], limit=None):
+        """ Runs every instance from cs until all have halted or faulted, or *limit* steps have been taken. """
+        self.prepare(cs, persistent)
+        while self.running.any():
+            if limit is not None and self.steps >= limit:
+                break
+            self.step()
+        return self.steps
+    def prepare(self, cs=0, persistent=[]):
+        """ Clears the registers not in persistent and starts every instance at cs, for run() or stepping by hand. """
+        for reg in REGISTERS:
+            if reg not in persistent:
+                self.regs[:, REGISTERS.index(reg)] = 0
+        self.regs[:, CS] = cs
+        self.running[:] = True
+        self.faulted[:] = False
+        self.errors = {}
+        self.steps = 0
+    def step(self):
+        """ Executes one instruction on every running instance. """
+        active = numpy.flatnonzero(self.running)
+        if not len(active):
+            return
+        pcs = self.regs[active, CS]+self.regs[active, IP]
+        if (pcs == pcs[0]).all():
+            self.execute(active, int(pcs[0]))
+        else:
+            values, groups = numpy.unique(pcs, return_inverse=True)
+            for i, pc in enumerate(values):
+                self.execute(active[groups == i], int(pc))
+        self.steps += 1
+    def execute(self, idx, pc):
+        read = lambda addr: int(self.mem[idx[0], addr%self.size])
+        try:
+            op, operands, size = decode(read, pc)
+            target = self.__opcodes[op](idx, operands, pc+size)
+        except CPUException, e:
+            self.fault(idx, str(e))
+            return
+        if target is True:
+            return
+        if target is None:
+            target = pc+size
+        ok = ~self.faulted[idx]
+        self.regs[idx[ok], IP] = (target-self.regs[idx, CS])[ok]
+    def opcode_0x0(self, idx, operands, next_pc):
+        pass # NOP
+    def opcode_0x1(self, idx, operands, next_pc):
+        """ INT """
+        i = self.resolve(idx, operands[0])
+        self.push(idx, self.regs[idx, CS])
+        self.push(idx, next_pc-self.regs[idx, CS])
+        self.regs[idx, CS] = self.read16(idx, i*2+self.int_table)
+        self.regs[idx, IP] = 0
+        return True
+    def opcode_0x2(self, idx, operands, next_pc):
+        """ MOV """
+        self.set_value(idx, operands[1], self.resolve(idx, operands[0]))
+    def opcode_0x3(self, idx, operands, next_pc):
+        """ IN """
+        raise CPUException('Device I/O is not supported by the batch engine.')
+    def opcode_0x4(self, idx, operands, next_pc):
+        """ OUT """
+        raise CPUException('Device I/O is not supported by the batch engine.')
+    def opcode_0x5(self, idx, operands, next_pc):
+        """ HLT """
+        self.running[idx] = False
+    def opcode_0x6(self, idx, operands, next_pc):
+        """ JMP """
+        return self.regs[idx, CS]+self.resolve(idx, operands[0])
+    def opcode_0x7(self, idx, operands, next_pc):
+        """ PUSH """
+        if operands[0][0] != 0:
+            raise CPUException('Attempt to PUSH a non-register.')
+        self.push(idx, self.resolve(idx, operands[0]))
+    def opcode_0x8(self, idx, operands, next_pc):
+        """ POP """
+        idx = self.check_stack(idx)
+        self.set_value(idx, operands[0], self.pop(idx), [0])
+    def opcode_0x9(self, idx, operands, next_pc):
+        """ CALL """
+        target = self.regs[idx, CS]+self.resolve(idx, operands[0])
+        self.push(idx, self.regs[idx, CS])
+        self.push(idx, next_pc-self.regs[idx, CS])
+        return target
+    def opcode_0xa(self, idx, operands, next_pc):
+        """ INC """
+        if operands[0][0] != 0:
+            raise CPUException('Attempt to increment a non-register.')
+        self.regs[idx, operands[0][1]] += 1
+    def opcode_0xb(self, idx, operands, next_pc):
+        """ DEC """
+        if operands[0][0] != 0:
+            raise CPUException('Attempt to decrement a non-register.')
+        self.regs[idx, operands[0][1]] -= 1
+    def opcode_0xc(self, idx, operands, next_pc):
+        """ ADD """
+        self.arithmetic(idx, operands, lambda dst, src: src+dst)
+    def opcode_0xd(self, idx, operands, next_pc):
+        """ SUB """
+        self.arithmetic(idx, operands, lambda dst, src: dst-src)
+    def opcode_0xe(self, idx, operands, next_pc):
+        """ TEST """
+        self.compare(idx, operands)
+    def opcode_0xf(self, idx, operands, next_pc):
+        """ JE """
+        return self.jump_if(idx, self.flag(idx, ZF), operands, next_pc)
+    def opcode_0x10(self, idx, operands, next_pc):
+        """ JNE """
+        return self.jump_if(idx, ~self.flag(idx, ZF), operands, next_pc)
+    def opcode_0x11(self, idx, operands, next_pc):
+        """ CMP """
+        self.compare(idx, operands)
+    def opcode_0x12(self, idx, operands, next_pc):
+        """ MUL """
+        self.arithmetic(idx, operands, lambda dst, src: dst*src)
+    def opcode_0x13(self, idx, operands, next_pc):
+        """ DIV """
+        zero = self.resolve(idx, operands[0]) == 0
+        self.fault(idx[zero], 'integer division or modulo by zero')
+        self.arithmetic(idx[~zero], operands, lambda dst, src: dst//src)
+    def opcode_0x14(self, idx, operands, next_pc):
+        """ PUSHF """
+        self.push(idx, self.flags[idx])
+    def opcode_0x15(self, idx, operands, next_pc):
+        """ POPF """
+        idx = self.check_stack(idx)
+        self.flags[idx] = self.pop(idx)
+    def opcode_0x16(self, idx, operands, next_pc):
+        """ AND """
+        self.logic(idx, operands, lambda v, src: v & src)
+    def opcode_0x17(self, idx, operands, next_pc):
+        """ OR """
+        self.logic(idx, operands, lambda v, src: v | src)
+    def opcode_0x18(self, idx, operands, next_pc):
+        """ XOR """
+        self.logic(idx, operands, lambda v, src: v ^ src)
+    def opcode_0x19(self, idx, operands, next_pc):
+        """ NOT """
+        self.logic(idx, operands, lambda v, src: v & ~src)
+    def opcode_0x1a(self, idx, operands, next_pc):
+        """ RET """
+        self.regs[idx, IP] = self.pop(idx)
+        self.regs[idx, CS] = self.pop(idx)
+        return True
+    def opcode_0x1b(self, idx, operands, next_pc):
+        """ JL """
+        return self.jump_if(idx, self.flag(idx, SF) != self.flag(idx, OF), operands, next_pc)
+    def opcode_0x1c(self, idx, operands, next_pc):
+        """ JG """
+        return self.jump_if(idx, ~self.flag(idx, ZF) & (self.flag(idx, SF) == self.flag(idx, OF)), operands, next_pc)
+    def opcode_0x1d(self, idx, operands, next_pc):
+        """ JLE """
+        return self.jump_if(idx, self.flag(idx, ZF) | (self.flag(idx, SF) != self.flag(idx, OF)), operands, next_pc)
+    def opcode_0x1e(self, idx, operands, next_pc):
+        """ JGE """
+        return self.jump_if(idx, self.flag(idx, SF) == self.flag(idx, OF), operands, next_pc)
+    def opcode_0x1f(self, idx, operands, next_pc):
+        """ JB """
+        return self.jump_if(idx, self.flag(idx, CF), operands, next_pc)
+    def opcode_0x20(self, idx, operands, next_pc):
+        """ JA """
+        return self.jump_if(idx, ~self.flag(idx, CF) & ~self.flag(idx, ZF), operands, next_pc)
+    def opcode_0x21(self, idx, operands, next_pc):
+        """ JBE """
+        return self.jump_if(idx, self.flag(idx, CF) | self.flag(idx, ZF), operands, next_pc)
+    def opcode_0x22(self, idx, operands, next_pc):
+        """ JAE """
+        return self.jump_if(idx, ~self.flag(idx, CF), operands, next_pc)
+    def opcode_0x23(self, idx, operands, next_pc):
+        """ TSW """
+        task = self.resolve(idx, operands[0])
+        self.regs[idx, IP] = next_pc-self.regs[idx, CS]
+        current = self.regs[idx, CR]
+        for i in range(len(REGISTERS)):
+            self.write16(idx, current+i*2, self.regs[idx, i])
+        self.write16(idx, current+len(REGISTERS)*2, self.flags[idx])
+        for i in range(len(REGISTERS)):
+            self.regs[idx, i] = self.read16(idx, task+i*2)
+        self.flags[idx] = self.read16(idx, task+len(REGISTERS)*2)
+        self.regs[idx, CR] = task
+        return True
+    def opcode_0x24(self, idx, operands, next_pc):
+        """ CAS """
+        if operands[1][0] not in (4,5,):
+            raise CPUException('Attempted to CAS a location which is not in memory.')
+        src = self.resolve(idx, operands[0])
+        addr = self.regs[idx, DS]+operands[1][1]
+        old, expected = self.read16(idx, addr), self.regs[idx, AX]&0xFFFF
+        equal = old == expected
+        self.write16(idx[equal], addr[equal], src[equal]&0xFFFF)
+        self.regs[idx[~equal], AX] = old[~equal]
+        self.set_flags(idx, old, expected)
+    def check_stack(self, idx):
+        """ Faults the instances with an empty stack, returning the rest. """
+        empty = self.regs[idx, SP] <= 0
+        self.fault(idx[empty], 'Stack out of range.')
+        return idx[~empty]
+    def arithmetic(self, idx, operands, func):
+        if operands[1][0] != 0:
+            raise CPUException('Arithmetic on a memory operand is not supported by the batch engine.')
+        self.set_value(idx, operands[1], func(self.regs[idx, operands[1][1]], self.resolve(idx, operands[0])))
+    def logic(self, idx, operands, func):
+        self.set_value(idx, operands[1], func(self.resolve(idx, operands[1]), self.resolve(idx, operands[0])), [0])
+    def compare(self, idx, operands):
+        """ Sets the flags of a comparison of the second operand with the first, as CPU.flags works them out. """
+        self.set_flags(idx, self.resolve(idx, operands[1])&0xFFFF, self.resolve(idx, operands[0])&0xFFFF)
+    def set_flags(self, idx, a, b):
+        result = (a-b)&0xFFFF
+        flags = numpy.where(result == 0, ZF, 0)|numpy.where(a < b, CF, 0)|numpy.where(result&0x8000, SF, 0)
+        flags |= numpy.where((a^b)&(a^result)&0x8000, OF, 0)
+        self.flags[idx] = self.flags[idx]&~(ZF|CF|SF|OF)|flags
+    def flag(self, idx, bit):
+        return (self.flags[idx]&bit) != 0
+    def jump_if(self, idx, taken, operands, next_pc):
+        return numpy.where(taken, self.regs[idx, CS]+self.resolve(idx, operands[0]), next_pc)
@@ -0,0 +1,148 @@
+import os, time, collections
+from simple_cpu.exceptions import CPUException
+from simple_cpu.devices import BaseCPUDevice
+
+class BlockDevice(BaseCPUDevice):
+    """
+    This is a disk backed by a host image file, which the guest reads and writes a sector at a time over its ports:
+    60 = sector number, 61 = guest memory address, 63 = sector count (default 1), and a command to port 62 (1 = read
+    sectors into memory, 2 = write sectors from memory, 3 = flush).  After a transfer the sector register points past
+    the sectors moved, so sequential access needs no reprogramming.
+    Sectors are kept in a bounded LRU cache, writes stay in the cache until they are flushed (every *flush_interval*
+    seconds, on eviction, on flush and when the CPU stops), and sequential reads fetch *read_ahead* further sectors
+    with the same host read.  The device is also DMA channel 2, where offsets are relative to the current sector.
+    Subclass it and set *filename* to attach an image.
+    """
+    ports = [60, 61, 62, 63]
+    dma_channel = 2
+    filename = None
+    sector_size = 512
+    cache_sectors = 128 #: Most sectors held in memory at once.
+    read_ahead = 8 #: Sectors read past a sequential miss.
+    flush_interval = 1.0
+    READ = 1
+    WRITE = 2
+    FLUSH = 3
+    def __init__(self, cpu):
+        super(BlockDevice, self).__init__(cpu)
+        self.image = open(self.filename, 'r+b')
+        self.sectors = os.path.getsize(self.filename)//self.sector_size
+        self.cache = collections.OrderedDict()
+        self.dirty = set()
+        self.sector = self.addr = 0
+        self.count = 1
+        self.last_miss = None
+        self.last_flush = time.time()
+        self.cycles = 0
+        self.hits = self.misses = self.reads = self.writes = self.flushes = self.evictions = 0
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'host_reads': self.reads,
+            'host_writes': self.writes,
+            'flushes': self.flushes,
+            'evictions': self.evictions,
+            'cached': len(self.cache),
+            'dirty': len(self.dirty),
+        }
+    def out_60(self, sector):
+        self.sector = sector
+    def in_60(self):
+        return self.sector&0xFFFF
+    def out_61(self, addr):
+        self.addr = addr
+    def out_63(self, count):
+        self.count = count
+    def out_62(self, cmd):
+        if cmd == self.READ:
+            for i in range(self.count):
+                self.cpu.mem.writeblock(self.addr+i*self.sector_size, self.get(self.sector+i))
+        elif cmd == self.WRITE:
+            for i in range(self.count):
+                self.put(self.sector+i, self.cpu.mem.readblock(self.addr+i*self.sector_size, self.sector_size))
+        elif cmd == self.FLUSH:
+            self.flush()
+            return
+        else:
+            raise CPUException('Invalid block device command: %s' % cmd)
+        self.sector += self.count
+    def check(self, sector):
+        if sector < 0 or sector >= self.sectors:
+            raise CPUException('Sector %d is beyond the end of the disk.' % sector)
+    def get(self, sector):
+        """ Returns the cached contents of a sector, reading it (and any read-ahead) from the image on a miss. """
+        self.check(sector)
+        try:
+            data = self.cache.pop(sector)
+            self.hits += 1
+            self.insert(sector, data)
+            return data
+        except KeyError:
+            pass
+        self.misses += 1
+        count = 1
+        if self.last_miss is not None and sector == self.last_miss+1:
+            count += min(self.read_ahead, self.sectors-sector-1, self.cache_sectors-1)
+        self.last_miss = sector+count-1
+        self.image.seek(sector*self.sector_size)
+        block = self.image.read(count*self.sector_size)
+        self.reads += 1
+        data = bytearray(block[:self.sector_size])
+        self.insert(sector, data)
+        for i in range(1, count):
+            if sector+i not in self.cache:
+                self.insert(sector+i, bytearray(block[i*self.sector_size:(i+1)*self.sector_size]))
+        return data
+    def put(self, sector, data):
+        self.check(sector)
+        self.cache.pop(sector, None)
+        self.insert(sector, bytearray(data))
+        self.dirty.add(sector)
+    def insert(self, sector, data):
+        self.cache[sector] = data
+        while len(self.cache) > self.cache_sectors:
+            old, block = self.cache.popitem(last=False)
+            self.evictions += 1
+            if old in self.dirty:
+                self.write_back({old: block})
+    def write_back(self, blocks):
+        """ Writes a dict of sectors to the image, with one host write per run of consecutive sectors. """
+        run = []
+        for sector in sorted(blocks) + [None]:
+            if run and sector != run[-1]+1:
+                self.image.seek(run[0]*self.sector_size)
+                self.image.write(''.join(str(blocks[s]) for s in run))
+                self.writes += 1
+                run = []
+            if sector is not None:
+                run.append(sector)
+                self.dirty.discard(sector)
+    def flush(self):
+        """ Writes every dirty sector back to the image. """
+        if self.dirty:
+            self.write_back(dict((sector, self.cache[sector]) for sector in self.dirty))
+            self.image.flush()
+            self.flushes += 1
+        self.last_flush = time.time()
+    def dma_read(self, offset, size):
+        first, start = divmod(offset, self.sector_size)
+        last = (offset+size-1)//self.sector_size
+        data = ''.join(str(self.get(self.sector+i)) for i in range(first, last+1))
+        return data[start:start+size]
+    def dma_write(self, offset, data):
+        data = str(data)
+        pos = 0
+        while pos < len(data):
+            sector, start = divmod(offset+pos, self.sector_size)
+            block = self.get(self.sector+sector)
+            chunk = data[pos:pos+self.sector_size-start]
+            block[start:start+len(chunk)] = chunk
+            self.dirty.add(self.sector+sector)
+            pos += len(chunk)
+    def cycle(self):
+        self.cycles += 1
+        if self.dirty and not self.cycles & 0xFF and time.time()-self.last_flush >= self.flush_interval:
+            self.flush()
+    def stop(self):
+        self.flush()
@@ -1,7 +1,14 @@
-import sys, zlib
-from simple_cpu.exceptions import CPUException
+import sys, os, zlib, threading, struct, bisect
+from simple_cpu.exceptions import CPUException, QuotaExceeded
+from simple_cpu.decoder import FIXED
 from simple_cpu.devices import ConIOHook, HelloWorldHook
-from simple_cpu.memory import UInt16, UInt8, MemoryController, IOMap, MemoryMap
+from simple_cpu.symbols import SymbolTable, symbol_file
+from simple_cpu.memory import UInt16, UInt8, MemoryController, IOMap, MemoryMap, SparseMemoryMap, ROMMap, WindowMap
+
+ZERO, CARRY, SIGN, OVERFLOW = range(4) #: Bit offsets of the flags set by CMP and TEST.
+IMAGE_MAGIC = 'SCPU'
+IMAGE_HEADER = struct.Struct('<4sBBH') #: magic, version, flags, reserved.
+FIXED_WIDTH = 0x1 #: Image flag for code in the fixed-width encoding.
 
 class CPURegisters(object):
     """ This class contains all the CPU registers and manages them. """
@@ -11,6 +18,9 @@ class CPURegisters(object):
         for reg in self.registers:
             setattr(self, reg, UInt16())
 
+#: A task control block as TSW saves and loads it, every register in the order above and then the flags.
+CONTEXT = struct.Struct('<%dH' % (len(CPURegisters.registers)+1))
+
 class CPU(object):
     """
     This class is the core CPU/Virtual Machine class.  It has most of the runtime that should be platform independent.
@@ -18,16 +28,37 @@ class CPU(object):
     Depending on how or where you want the binary data/memory to be located in the host environment, let it be on disk, or in a database,
     you will need to subclass this and enable your specific environment's functionality.
     The other class below this CPU, should work on most operating systems to access standard disk and memory.
+    With sparse set, RAM fills every block of the address space besides the I/O map, but pages are only allocated
+    when first written, so many mostly idle machines can share one host process.
     """
-    def __init__(self):
+    def __init__(self, sparse=False):
         self.regs = CPURegisters()
-        self.flags = UInt8()
+        self.__flags = UInt8()
+        self.__compared = None #: Operands of the last CMP or TEST, until the flags are read.
         self.mem = MemoryController()
         self.iomap = IOMap()
-        self.mem.add_map(0x0, MemoryMap(0x2000))
+        if sparse:
+            for block in (0x0, 0x2, 0x4, 0x6, 0x8, 0xc, 0xe):
+                self.mem.add_map(block, SparseMemoryMap(0x2000))
+        else:
+            self.mem.add_map(0x0, MemoryMap(0x2000))
         self.mem.add_map(0xa, self.iomap)
         self.cpu_hooks = {}
         self.devices = []
+        self.pic = None #: The InterruptController, if one has been added.
+        self.fastforward = None #: The IdleLoopDetector, if idle loops should be fast-forwarded.
+        self.quota = None #: The QuotaDevice, if one has been added, which is charged before any device cycles.
+        self.cycles = 0 #: Instructions executed by the current run.
+        self.halted = False #: True while HLT is waiting for an interrupt.
+        self.fixed = False #: True to execute code in the fixed-width encoding, unless it was loaded from an image with a header.
+        self.encodings = [] #: The (start, end, fixed) of each image loaded with a header, sorted by start.
+        self.symbols = SymbolTable() #: Labels of the code in memory, from the assembler or the symbol files of images.
+        self.__operands = []
+        self.__fixed = False
+        self.__frames = {} #: Struct and registers of each stack frame pushed so far, by the registers it holds.
+        self.__context = [getattr(self.regs, reg) for reg in self.regs.registers]
+        self.wake_event = threading.Event()
+        self.bus_lock = threading.Lock() #: Held by CAS, machines whose CPUs share memory share one lock.
         self.__opcodes = {}
         for name in dir(self.__class__):
             if name[:7] == 'opcode_':
@@ -35,6 +66,27 @@ class CPU(object):
     @property
     def var_map(self):
         return self.regs.registers
+    @property
+    def flags(self):
+        """ The flags register, any flags still pending from the last CMP or TEST are computed when it is read. """
+        if self.__compared is not None:
+            dst, src = self.__compared
+            self.__compared = None
+            a, b = dst&0xFFFF, src&0xFFFF
+            result = (a-b)&0xFFFF
+            flags = self.__flags
+            flags.bit(ZERO, result == 0)
+            flags.bit(CARRY, a < b)
+            flags.bit(SIGN, result&0x8000 != 0)
+            flags.bit(OVERFLOW, (a^b)&(a^result)&0x8000 != 0)
+        return self.__flags
+    @flags.setter
+    def flags(self, value):
+        self.__compared = None
+        self.__flags = value
+    def compare(self, dst, src):
+        """ Records the operands of a comparison of dst with src, the flags are only worked out if something reads them. """
+        self.__compared = (dst, src)
     def __getattr__(self, name):
         if name in self.regs.registers:
             return getattr(self.regs, name)
@@ -46,22 +98,51 @@ class CPU(object):
             self.cpu_hooks.update({port: hook})
         if hasattr(hook, 'io_address'):
             self.iomap.add_map(hook.io_address, hook)
+        if hasattr(hook, 'memory_block'):
+            self.mem.add_map(hook.memory_block, WindowMap(hook.memory_window))
     def clear_registers(self, persistent=[]):
         for reg in self.regs.registers:
             if reg not in persistent:
                 getattr(self.regs, reg).value = 0
+    def snapshot(self):
+        """ Captures the registers, flags and writeable memory, so the machine can be reset cheaply with restore(). """
+        registers = dict((reg, getattr(self.regs, reg).value) for reg in self.regs.registers)
+        return registers, self.flags.value, self.mem.snapshot()
+    def restore(self, snapshot):
+        registers, flags, memory = snapshot
+        for reg, value in registers.items():
+            getattr(self.regs, reg).value = value
+        self.flags.value = flags
+        self.mem.restore(memory)
+    def frame(self, regs):
+        """ Returns the struct and register units of a stack frame holding regs, in the order they are pushed. """
+        regs = tuple(regs)
+        try:
+            return self.__frames[regs]
+        except KeyError:
+            frame = self.__frames[regs] = (struct.Struct('<%dH' % len(regs)), [getattr(self.regs, reg) for reg in regs])
+            return frame
     def push_registers(self, regs=None):
-        if regs is None:
-            regs = self.regs.pushable
-        for reg in regs:
-            self.mem.write16(self.ss+self.sp, getattr(self.regs, reg).b)
-            self.sp.value += 2
+        """ Pushes registers onto the stack, packed by one struct call into a single block write. """
+        frame, units = self.frame(self.regs.pushable if regs is None else regs)
+        self.mem.memwrite(self.ss+self.sp, frame.pack(*[unit.value&0xFFFF for unit in units]))
+        self.sp.value += frame.size
     def pop_registers(self, regs=None):
-        if regs is None:
-            regs = self.regs.pushable.reverse()
-        for reg in regs:
-            self.sp.value -= 2
-            getattr(self.regs, reg).value = self.mem.read16(self.ss+self.sp)
+        """ Pops registers in the order given, which is the reverse of the order push_registers was given them in. """
+        frame, units = self.frame(self.regs.pushable if regs is None else regs[::-1])
+        self.sp.value -= frame.size
+        for unit, value in zip(units, frame.unpack(self.mem.memread(self.ss+self.sp, frame.size))):
+            unit.value = value
+    def save_context(self, addr):
+        """ Stores every register and the flags into the task control block at addr. """
+        self.mem.memwrite(addr, CONTEXT.pack(*[unit.value&0xFFFF for unit in self.__context]+[self.flags.b]))
+    def load_context(self, addr):
+        """ Loads every register and the flags from the task control block at addr, which becomes the current one. """
+        values = CONTEXT.unpack(self.mem.memread(addr, CONTEXT.size))
+        for unit, value in zip(self.__context, values):
+            unit.value = value
+        self.flags.value = values[-1]
+        self.cr.value = addr
     def push_value(self, value):
         try:
             value = int(value)
@@ -86,17 +167,22 @@ class CPU(object):
             value = self.mem.read16(value)
         return value
     def get_value(self, resolve=True):
-        b = self.fetch()
-        typ = b>>4
-        b = b&0xf
-        if typ == 0:
-            value = getattr(self, self.var_map[b])
-        elif typ == 1:
-            value = b
-        elif typ in (2,4,):
-            value = b|self.fetch()<<4
-        elif typ in (3,5,):
-            value = b|self.fetch16()<<4
+        if self.__fixed:
+            typ, value = self.__operands.pop()
+            if typ == 0:
+                value = getattr(self, self.var_map[value])
+        else:
+            b = self.fetch()
+            typ = b>>4
+            b = b&0xf
+            if typ == 0:
+                value = getattr(self, self.var_map[b])
+            elif typ == 1:
+                value = b
+            elif typ in (2,4,):
+                value = b|self.fetch()<<4
+            elif typ in (3,5,):
+                value = b|self.fetch16()<<4
         if resolve:
             return typ, self.resolve(typ, value)
         return typ, value
@@ -124,14 +210,46 @@ class CPU(object):
         self.device_command('stop')
     def device_cycle(self):
         self.device_command('cycle')
+    def next_event(self):
+        """ Returns the seconds until the soonest scheduled device event, or None if no device has one scheduled. """
+        timeouts = [device.next_event() for device in self.devices if hasattr(device, 'next_event')]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        if timeouts:
+            return max(0, min(timeouts))
+        return None
+    def idle(self, timeout=None):
+        """ Sleeps the host until a device calls wake(), or until timeout seconds have passed. """
+        self.wake_event.wait(timeout)
+        self.wake_event.clear()
+    def wake(self):
+        """ Called by devices, possibly from another thread, to end an idle() sleep early. """
+        self.wake_event.set()
+    def interrupt(self, i):
+        """ Calls interrupt *i* through the interrupt table, saving cs and ip on the stack for RET. """
+        self.push_registers(['cs', 'ip'])
+        self.cs.value = self.mem.read16(i*2+self.int_table)
+        self.ip.value = 0
+    def branch(self, jmp):
+        """ Takes a conditional jump, giving the idle loop detector a chance to fast-forward a backward one. """
+        target = self.cs.b+jmp
+        if self.fastforward is not None and target < self.mem.ptr and self.fastforward.backedge(target, self.mem.ptr):
+            return
+        self.mem.ptr = target
     def fetch(self):
         return self.mem.fetch()
     def fetch16(self):
         return self.mem.fetch16()
     def process(self):
-        """ Processes a single bytecode. """
-        self.mem.ptr = self.cs+self.ip
-        op = self.fetch()
+        """ Processes a single bytecode, a fixed-width one is decoded whole and its operands queued for get_value. """
+        pc = self.cs.b+self.ip.b
+        self.__fixed = self.fixed_at(pc) if self.encodings else self.fixed
+        if self.__fixed:
+            op, t1, t2, v1, v2 = FIXED.unpack(self.mem.readblock(pc, FIXED.size))
+            self.__operands = [(t2, v2), (t1, v1)]
+            self.mem.ptr = pc+FIXED.size
+        else:
+            self.mem.ptr = pc
+            op = self.fetch()
         if self.__opcodes.has_key(op):
             if not self.__opcodes[op]():
                 self.ip.value = self.mem.ptr-self.cs.b
@@ -142,11 +260,8 @@ class CPU(object):
     def opcode_0x1(self):
         """ INT """
         i = self.get_value()[1]
-        self.ip.value = self.mem.ptr-self.cs
-        self.push_registers(['cs', 'ip'])
-        jmp = self.mem[i*2+self.int_table:i*2+self.int_table+2]
-        self.regs.cs.value = jmp
-        self.ip.value = 0
+        self.ip.value = self.mem.ptr-self.cs.b
+        self.interrupt(i)
         return True
     def opcode_0x2(self):
         """ MOV """
@@ -167,7 +282,17 @@ class CPU(object):
             self.cpu_hooks[dst].output(dst, src)
     def opcode_0x5(self):
         """ HLT """
-        self.running = False
+        if self.pic is None or not self.pic.wait_on_halt:
+            self.running = False
+            return
+        self.ip.value = self.mem.ptr-self.cs.b
+        serviced = self.pic.serviced
+        self.halted = True
+        while self.running and self.pic.serviced == serviced:
+            self.idle(self.next_event())
+            self.device_cycle()
+        self.halted = False
+        return True
     def opcode_0x6(self):
         """ JMP """
         self.mem.ptr = self.cs.b+self.get_value()[1]
@@ -216,23 +341,22 @@ class CPU(object):
         """ TEST """
         src = self.get_value()[1]
         dst = self.get_value()[1]
-        self.flags.bit(0, src == dst)
+        self.compare(dst, src)
     def opcode_0xf(self):
         """ JE """
         jmp = self.get_value()[1]
-        if self.flags.bit(0):
-            self.mem.ptr = self.cs.b+jmp
+        if self.flags.bit(ZERO):
+            self.branch(jmp)
     def opcode_0x10(self):
         """ JNE """
         jmp = self.get_value()[1]
-        if not self.flags.bit(0):
-            self.mem.ptr = self.cs.b+jmp
+        if not self.flags.bit(ZERO):
+            self.branch(jmp)
     def opcode_0x11(self):
         """ CMP """
         src = self.get_value()[1]
         dst = self.get_value()[1]
-        result = src - dst
-        self.flags.bit(0, True if result == 0 else False)
+        self.compare(dst, src)
     def opcode_0x12(self):
         """ MUL """
         src = self.get_value()[1]
@@ -277,32 +401,167 @@ class CPU(object):
         """ RET """
         self.pop_registers(['ip', 'cs'])
         return True
-    def run(self, cs=0, persistent=[]):
+    def jump_if(self, condition):
+        jmp = self.get_value()[1]
+        if condition:
+            self.branch(jmp)
+    def opcode_0x1b(self):
+        """ JL """
+        flags = self.flags
+        self.jump_if(flags.bit(SIGN) != flags.bit(OVERFLOW))
+    def opcode_0x1c(self):
+        """ JG """
+        flags = self.flags
+        self.jump_if(not flags.bit(ZERO) and flags.bit(SIGN) == flags.bit(OVERFLOW))
+    def opcode_0x1d(self):
+        """ JLE """
+        flags = self.flags
+        self.jump_if(flags.bit(ZERO) or flags.bit(SIGN) != flags.bit(OVERFLOW))
+    def opcode_0x1e(self):
+        """ JGE """
+        flags = self.flags
+        self.jump_if(flags.bit(SIGN) == flags.bit(OVERFLOW))
+    def opcode_0x1f(self):
+        """ JB """
+        self.jump_if(self.flags.bit(CARRY))
+    def opcode_0x20(self):
+        """ JA """
+        flags = self.flags
+        self.jump_if(not flags.bit(CARRY) and not flags.bit(ZERO))
+    def opcode_0x21(self):
+        """ JBE """
+        flags = self.flags
+        self.jump_if(flags.bit(CARRY) or flags.bit(ZERO))
+    def opcode_0x22(self):
+        """ JAE """
+        self.jump_if(not self.flags.bit(CARRY))
+    def opcode_0x23(self):
+        """ TSW """
+        task = self.get_value()[1]
+        self.ip.value = self.mem.ptr-self.cs.b
+        self.save_context(self.cr.b)
+        self.load_context(task)
+        return True
+    def opcode_0x24(self):
+        """ CAS """
+        src = self.get_value()[1]
+        typ, addr = self.get_value(False)
+        if typ not in (4,5,):
+            raise CPUException('Attempted to CAS a location which is not in memory.')
+        expected = self.ax.b&0xFFFF
+        with self.bus_lock:
+            old = self.mem.read16(self.ds+addr)
+            if old == expected:
+                self.mem.write16(self.ds+addr, src&0xFFFF)
+        if old != expected:
+            self.ax.value = old
+        self.compare(old, expected)
+    def prepare(self, cs=0, persistent=[]):
+        """ Clears the registers not in persistent and the cycle count for a run from cs, which resume() executes. """
         self.clear_registers(persistent)
         self.cs.value = cs
         self.mem.ptr = 0
         self.int_table = len(self.mem)-512
-        del persistent
-        del cs
+        self.cycles = 0
+    def run(self, cs=0, persistent=[]):
+        self.prepare(cs, persistent)
+        return self.resume()
+    def resume(self):
+        """
+        Carries on executing from cs:ip, such as after a run was stopped by QuotaExceeded.  However the run ends the
+        devices are stopped and memory maps told the CPU halted, except after QuotaExceeded, as that run may be resumed.
+        """
         self.running = True
-        while self.running:
-            if 'bp' in self.__dict__ and self.bp == self.mem.ptr: break
-            self.device_cycle()
-            self.process()
-        self.stop_devices()
+        resumable = False
+        try:
+            while self.running:
+                if 'bp' in self.__dict__ and self.bp == self.mem.ptr: break
+                if self.quota is not None:
+                    self.quota.charge()
+                self.device_cycle()
+                self.process()
+                self.cycles += 1
+        except CPUException, e:
+            resumable = isinstance(e, QuotaExceeded)
+            if self.symbols:
+                e.args = ('%s (at %s)' % (e, self.symbols.describe(self.cs.b+self.ip.b)),)
+            raise
+        finally:
+            if not resumable:
+                self.stop_devices()
+                self.mem.halt()
         return 0
+    def fixed_at(self, addr):
+        """ Returns True if the code at addr is in the fixed-width encoding, by the image loaded there or else self.fixed. """
+        i = bisect.bisect_right(self.encodings, (addr, sys.maxint, True))-1
+        if i >= 0 and addr < self.encodings[i][1]:
+            return self.encodings[i][2]
+        return self.fixed
+    def set_encoding(self, start, end, fixed):
+        """ Records the encoding of the code from start up to end, replacing that of any image loaded there before. """
+        encodings = []
+        for s, e, f in self.encodings:
+            if s < start:
+                encodings.append((s, min(e, start), f))
+            if e > end:
+                encodings.append((max(s, end), e, f))
+        encodings.append((start, end, fixed))
+        self.encodings = sorted(encodings)
     def loadbin(self, filename, dest, compressed=False):
+        """
+        Loads an image to dest.  An image with a header is code, which runs in the encoding its header gives whatever
+        self.fixed is, while one without, which may be data such as an interrupt table, leaves the encodings alone.
+        """
         if not compressed:
             bindata = open(filename, 'rb').read()
         else:
             bindata = zlib.decompress(open(filename, 'rb').read())
-        self.mem.writeblock(dest, bindata)
+        if bindata[:len(IMAGE_MAGIC)] == IMAGE_MAGIC:
+            magic, version, flags, reserved = IMAGE_HEADER.unpack_from(bindata)
+            if version != 1:
+                raise CPUException('Unsupported image version: %s' % version)
+            fixed = bool(flags & FIXED_WIDTH)
+            if fixed and dest % FIXED.size:
+                raise CPUException('Fixed-width code must be loaded at a multiple of %d.' % FIXED.size)
+            bindata = bindata[IMAGE_HEADER.size:]
+            self.mem.writeblock(dest, bindata)
+            self.set_encoding(dest, dest+len(bindata), fixed)
+        else:
+            self.mem.writeblock(dest, bindata)
+        self.mem.ptr = 0
+        if os.path.exists(symbol_file(filename)):
+            self.symbols.load(symbol_file(filename), dest)
+    def loadrom(self, filename, dest):
+        """
+        Maps filename at dest from a read-only mapping shared with every other CPU in the process which loads it, the
+        block holding dest becomes a ROMMap if it isn't one yet, keeping its current contents.
+        """
+        block, memory, offset = self.mem.find_map(dest)
+        if not isinstance(memory, ROMMap):
+            rom = ROMMap(0x2000)
+            if memory is not None:
+                rom.writeblock(0, memory.readblock(0, len(memory)))
+            self.mem.add_map(block, rom)
+            memory = rom
+        memory.load(filename, offset)
         self.mem.ptr = 0
-    def savebin(self, filename, src, size, compress=False):
+    def savebin(self, filename, src, size, compress=False, code=False):
+        """
+        Saves memory as an image.  With *code* set, it is saved as code, with a header marking it as fixed-width if the
+        code at src is in that encoding, otherwise it is saved as it is.  The labels within it, if any, are saved to a
+        symbol file next to it, otherwise any symbol file left there is removed.
+        """
+        bindata = self.mem.readblock(src, size)
+        if self.symbols.within(src, size):
+            self.symbols.save(symbol_file(filename), src, size)
+        elif os.path.exists(symbol_file(filename)):
+            os.remove(symbol_file(filename))
+        if code and self.fixed_at(src):
+            bindata = IMAGE_HEADER.pack(IMAGE_MAGIC, 1, FIXED_WIDTH, 0)+bindata
         if not compress:
-            open(filename, 'wb').write(self.mem.readblock(src, size))
+            open(filename, 'wb').write(bindata)
         else:
-            open(filename, 'wb').write(zlib.compress(self.mem.readblock(src, size)))
+            open(filename, 'wb').write(zlib.compress(bindata))
 
 def main_old():
     """ Keeping this around until I migrate it over to the new format. """
@@ -0,0 +1,45 @@
+import struct
+from simple_cpu.exceptions import CPUException
+
+#: The number of operands each opcode fetches with CPU.get_value.
+OPERANDS = {
+    0x0: 0, 0x1: 1, 0x2: 2, 0x3: 2, 0x4: 2, 0x5: 0, 0x6: 1, 0x7: 1, 0x8: 1, 0x9: 1,
+    0xa: 1, 0xb: 1, 0xc: 2, 0xd: 2, 0xe: 2, 0xf: 1, 0x10: 1, 0x11: 2, 0x12: 2, 0x13: 2,
+    0x14: 0, 0x15: 0, 0x16: 2, 0x17: 2, 0x18: 2, 0x19: 2, 0x1a: 0, 0x1b: 1, 0x1c: 1, 0x1d: 1,
+    0x1e: 1, 0x1f: 1, 0x20: 1, 0x21: 1, 0x22: 1, 0x23: 1, 0x24: 2,
+}
+
+#: The fixed-width encoding: opcode, the types of both operands, a pad byte, then both values as aligned 16-bit words.
+FIXED = struct.Struct('<BBBxHH')
+
+def decode_operand(read, addr):
+    """ Decodes the operand at addr the same way CPU.get_value does, returning (typ, value, size) without resolving it. """
+    b = read(addr)
+    typ, value = b>>4, b&0xf
+    if typ in (2,4,):
+        return typ, value|read(addr+1)<<4, 2
+    elif typ in (3,5,):
+        return typ, value|(read(addr+1)|read(addr+2)<<8)<<4, 3
+    return typ, value, 1
+
+def decode(read, addr, fixed=False):
+    """
+    Decodes the instruction at addr using the read(addr) callable, usually a MemoryController's read method.
+    Returns (opcode, operands, size), the operands are (typ, value) pairs in the order the opcode fetches them.
+    With fixed set the instruction is decoded from the fixed-width encoding instead.
+    """
+    if fixed:
+        op, t1, t2, v1, v2 = FIXED.unpack(''.join(chr(read(addr+i)) for i in range(FIXED.size)))
+        if op not in OPERANDS:
+            raise CPUException('Invalid OpCode detected: %s' % op)
+        return op, [(t1, v1), (t2, v2)][:OPERANDS[op]], FIXED.size
+    op = read(addr)
+    if op not in OPERANDS:
+        raise CPUException('Invalid OpCode detected: %s' % op)
+    operands = []
+    size = 1
+    for i in range(OPERANDS[op]):
+        typ, value, length = decode_operand(read, addr+size)
+        operands.append((typ, value))
+        size += length
+    return op, operands, size
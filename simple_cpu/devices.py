@@ -1,6 +1,6 @@
 from simple_cpu.exceptions import InvalidInterrupt, CPUException,\
-    MemoryProtectionError
-import sys
+    MemoryProtectionError, ExecutionLimit
+import sys, time
 try:
     import termios
 except ImportError:
@@ -38,28 +38,195 @@ class HelloWorldHook(BaseCPUDevice):
     """ This is an example I/O Hook which demonstrates how the I/O hook system works. """
     ports = [32,33]
     io_address = 0x0
-    def start(self):
-        self.mem = 'Hello World!\x00'
+    def __init__(self, cpu):
+        super(HelloWorldHook, self).__init__(cpu)
+        self.io_buffer = bytearray('Hello World!\x00')
     def out_32(self, addr):
         self.addr = addr
     def in_32(self):
-        self.cpu.mem[self.addr] = "Hello World!"
+        self.cpu.mem.writeblock(self.addr, self.io_buffer[:12])
         return self.addr
     def out_33(self, reg):
         sys.stdout.write("%s\n" % getattr(self.cpu, self.cpu.var_map[reg]).b)
     def in_33(self):
         return self.count
-    def mem_read(self, addr):
-        try:
-            return ord(self.mem[addr])
-        except IndexError:
-            raise MemoryProtectionError('Unable to read from memory address.')
     def mem_write(self, addr, byte):
         raise MemoryProtectionError('Unable to write to memory address.')
 
+class DMAController(BaseCPUDevice):
+    """
+    This device moves whole blocks of data between a device and guest memory, instead of one IN/OUT per 16-bit value.
+    The guest sets the source, destination, length and channel registers, then writes a command to start the transfer.
+    Any device with a *dma_channel* takes part by providing dma_read(offset, size) and dma_write(offset, data).
+    """
+    ports = [40, 41, 42, 43, 44]
+    TO_MEMORY = 1 #: Command to copy from the channel's device into guest memory.
+    FROM_MEMORY = 2 #: Command to copy from guest memory into the channel's device.
+    burst = 0 #: Bytes moved per device cycle, 0 moves the whole block as soon as the command is given.
+    irq = 1 #: IRQ line raised on the interrupt controller, if there is one, when a transfer completes.
+    def __init__(self, cpu):
+        super(DMAController, self).__init__(cpu)
+        self.source = self.dest = self.length = self.channel = 0
+        self.direction = self.done = self.remaining = 0
+        self.transfers = 0
+        self.moved = 0 #: Bytes moved by every transfer so far.
+        self.channels = {}
+    def start(self):
+        for device in self.cpu.devices:
+            if hasattr(device, 'dma_channel'):
+                self.channels.update({device.dma_channel: device})
+    def out_40(self, addr):
+        self.source = addr
+    def out_41(self, addr):
+        self.dest = addr
+    def out_42(self, size):
+        self.length = size
+    def out_43(self, channel):
+        self.channel = channel
+    def out_44(self, cmd):
+        if self.channel not in self.channels:
+            raise CPUException('DMA channel %d is not connected.' % self.channel)
+        if cmd not in (self.TO_MEMORY, self.FROM_MEMORY):
+            raise CPUException('Invalid DMA command: %s' % cmd)
+        self.direction = cmd
+        self.done = 0
+        self.remaining = self.length
+        if self.burst == 0:
+            self.transfer(self.remaining)
+    def in_42(self):
+        return self.remaining
+    def in_44(self):
+        """ Returns 1 while a transfer is in progress, 0 once it has completed. """
+        return 1 if self.remaining else 0
+    def next_event(self):
+        return 0 if self.remaining else None
+    def cycle(self):
+        if self.remaining:
+            self.transfer(min(self.burst, self.remaining))
+    def transfer(self, size):
+        device = self.channels[self.channel]
+        if self.direction == self.TO_MEMORY:
+            self.cpu.mem.writeblock(self.dest+self.done, device.dma_read(self.source+self.done, size))
+        else:
+            device.dma_write(self.dest+self.done, self.cpu.mem.readblock(self.source+self.done, size))
+        self.done += size
+        self.remaining -= size
+        self.moved += size
+        if not self.remaining:
+            self.transfers += 1
+            if self.cpu.pic is not None:
+                self.cpu.pic.raise_irq(self.irq)
+
+class InterruptController(BaseCPUDevice):
+    """
+    This is a programmable interrupt controller.  Devices raise numbered IRQ lines, and between instructions the highest
+    priority (lowest numbered) unmasked line is serviced through the same interrupt table INT uses, at vector base+line.
+    The handler must write to the EOI port before another IRQ is serviced, then RET as from a software interrupt.  Only
+    cs and ip are saved, so a handler which changes the flags must PUSHF and POPF around its work.
+    """
+    ports = [20, 21, 22, 23]
+    base = 32 #: Interrupt vector used for IRQ line 0.
+    def __init__(self, cpu):
+        super(InterruptController, self).__init__(cpu)
+        self.mask = 0
+        self.pending = 0
+        self.in_service = False
+        self.wait_on_halt = False #: When set, HLT sleeps the host until an IRQ is serviced instead of stopping the CPU.
+        self.serviced = 0
+        cpu.pic = self
+    def raise_irq(self, line):
+        """ Requests an interrupt on *line*, this may be called from another thread. """
+        self.pending |= 1<<line
+        self.cpu.wake()
+    def out_20(self, base):
+        self.base = base
+    def out_21(self, mask):
+        self.mask = mask
+    def in_21(self):
+        return self.mask
+    def out_22(self, value):
+        """ End of interrupt. """
+        self.in_service = False
+    def in_22(self):
+        return self.pending
+    def out_23(self, value):
+        self.wait_on_halt = bool(value)
+    def cycle(self):
+        if self.pending & ~self.mask and not self.in_service:
+            self.service()
+    def service(self):
+        requests = self.pending & ~self.mask
+        line = 0
+        while not requests & (1<<line):
+            line += 1
+        self.pending &= ~(1<<line)
+        self.in_service = True
+        self.serviced += 1
+        self.cpu.interrupt(self.base+line)
+        return self.base+line
+
+class TimerDevice(BaseCPUDevice):
+    """ This is an interval timer which raises an IRQ every *period* milliseconds, as written to its port. """
+    ports = [30]
+    irq = 0
+    def __init__(self, cpu):
+        super(TimerDevice, self).__init__(cpu)
+        self.period = 0
+        self.deadline = None
+        self.ticks = 0
+    def out_30(self, ms):
+        self.period = ms/1000.0
+        self.deadline = time.time()+self.period if ms else None
+    def in_30(self):
+        return self.ticks&0xFFFF
+    def next_event(self):
+        if self.deadline is None:
+            return None
+        return self.deadline-time.time()
+    def cycle(self):
+        if self.deadline is not None:
+            now = time.time()
+            if now >= self.deadline:
+                self.ticks += 1
+                self.deadline += self.period
+                if self.deadline <= now:
+                    self.deadline = now+self.period
+                if self.cpu.pic is not None:
+                    self.cpu.pic.raise_irq(self.irq)
+
+class WatchdogDevice(BaseCPUDevice):
+    """
+    This device stops a run which goes on for too long, by raising ExecutionLimit out of CPU.run once *instructions*
+    cycles or *seconds* of host time have passed since it was last armed.  Either budget may be None to disable it.
+    """
+    ports = []
+    instructions = None
+    seconds = None
+    def __init__(self, cpu):
+        super(WatchdogDevice, self).__init__(cpu)
+        self.arm()
+    def arm(self):
+        self.count = 0
+        self.limit = None if self.instructions is None else self.instructions+1
+        self.deadline = None if self.seconds is None else time.time()+self.seconds
+    def start(self):
+        self.arm()
+    def next_event(self):
+        """ The time budget is an event, so that a HLT waiting for an interrupt wakes up to enforce it. """
+        if self.deadline is None:
+            return None
+        return self.deadline-time.time()
+    def cycle(self):
+        self.count += 1
+        if self.count == self.limit:
+            raise ExecutionLimit('Instruction budget of %d exceeded.' % self.instructions)
+        if self.deadline is not None and not self.count & 0xFF and time.time() > self.deadline:
+            raise ExecutionLimit('Time budget of %s seconds exceeded.' % self.seconds)
+
 class ConIOHook(BaseCPUDevice):
     """ This implements a basic tty-based display and keyboard for basic input/output operations from the CPU. """
     ports = [8000, 4000]
+    dma_channel = 1
     def start(self):
         """ This will set-up the Linux terminal to noncanonical mode, which is needed by this module to process RAW keyboard buffer. """
         if termios:
@@ -82,3 +249,7 @@ class ConIOHook(BaseCPUDevice):
             return ord(sys.stdin.read(1))
         else:
             raise CPUException("CPU: Single key input not supported on this platform.")
+    def dma_read(self, offset, size):
+        return sys.stdin.read(size)
+    def dma_write(self, offset, data):
+        sys.stdout.write(data)
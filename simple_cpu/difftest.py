@@ -0,0 +1,228 @@
+import sys, hashlib, collections
+from simple_cpu.exceptions import CPUException
+from simple_cpu.cpu import CPU, CPURegisters
+from simple_cpu.decoder import decode
+
+REGISTERS = CPURegisters.registers
+REGIONS = [(0x0, 0x2000)] #: Memory compared by default, the RAM every CPU has.
+
+def disassemble(op, operands):
+    """ Returns an instruction as text, named by the docstring of its CPU opcode method. """
+    method = getattr(CPU, 'opcode_%s' % hex(op), None)
+    name = method.__doc__.strip().split()[0].lower() if method is not None and method.__doc__ else hex(op)
+    args = []
+    for typ, value in operands[::-1]:
+        if typ == 0:
+            args.append(REGISTERS[value] if value < len(REGISTERS) else '?')
+        elif typ in (4,5,):
+            args.append('&h%x' % value)
+        else:
+            args.append(str(value))
+    return ('%s %s' % (name, ','.join(args))).strip()
+
+class CPUEngine(object):
+    """
+    This steps a CPU the same way CPU.run does, through whatever wraps its process() method, such as a Fuser.
+    Instructions an IdleLoopDetector skips are counted as executed, so both sides of a test agree on the count.  Any
+    error stops the engine and is kept as its state, so a host error in either side is reported like a guest fault.
+    """
+    def __init__(self, cpu, cs=0, persistent=[]):
+        self.cpu = cpu
+        self.error = None
+        cpu.prepare(cs, persistent)
+        cpu.running = True
+    @property
+    def cycles(self):
+        skipped = self.cpu.fastforward.skipped if self.cpu.fastforward is not None else 0
+        return self.cpu.cycles+skipped
+    @property
+    def active(self):
+        return self.cpu.running and self.error is None
+    @property
+    def pc(self):
+        return self.cpu.cs.b+self.cpu.ip.b
+    def step(self):
+        cpu = self.cpu
+        try:
+            if cpu.quota is not None:
+                cpu.quota.charge()
+            cpu.device_cycle()
+            cpu.process()
+            cpu.cycles += 1
+        except Exception, e:
+            self.error = '%s: %s' % (e.__class__.__name__, e)
+    def registers(self):
+        return [getattr(self.cpu.regs, reg).b&0xFFFF for reg in REGISTERS]
+    def flags(self):
+        return self.cpu.flags.b
+    def read(self, addr, size):
+        return self.cpu.mem.readrange(addr, size)
+    def instruction(self):
+        try:
+            return disassemble(*decode(self.cpu.mem.read, self.pc, self.cpu.fixed_at(self.pc))[:2])
+        except (CPUException, KeyError, IndexError):
+            return '??'
+    def describe(self, addr):
+        return self.cpu.symbols.describe(addr) if self.cpu.symbols else hex(addr)
+
+class BatchEngine(object):
+    """ This steps one instance of a BatchCPU, which should be the only instance so that it never shares a step. """
+    def __init__(self, batch, cs=0, persistent=[], index=0):
+        self.batch = batch
+        self.index = index
+        batch.prepare(cs, persistent)
+    @property
+    def cycles(self):
+        return self.batch.steps
+    @property
+    def active(self):
+        return bool(self.batch.running[self.index])
+    @property
+    def error(self):
+        return self.batch.errors.get(self.index)
+    @property
+    def pc(self):
+        regs = self.batch.regs[self.index]
+        return int(regs[REGISTERS.index('cs')]+regs[REGISTERS.index('ip')])
+    def step(self):
+        self.batch.step()
+    def registers(self):
+        return [int(value)&0xFFFF for value in self.batch.regs[self.index]]
+    def flags(self):
+        return int(self.batch.flags[self.index])
+    def read(self, addr, size):
+        return self.batch.readblock(self.index, addr, size)
+    def instruction(self):
+        try:
+            return disassemble(*decode(lambda addr: int(self.batch.mem[self.index, addr]), self.pc)[:2])
+        except (CPUException, IndexError):
+            return '??'
+    def describe(self, addr):
+        return hex(addr)
+
+class Divergence(object):
+    """ The first point at which a candidate engine was seen to differ from the reference, with a trace leading to it. """
+    def __init__(self, cycles, differences, trace, reference, candidate):
+        self.cycles = cycles
+        self.differences = differences
+        self.trace = trace
+        self.reference = reference
+        self.candidate = candidate
+    def __str__(self):
+        lines = ['Divergence after %d instructions:' % self.cycles]
+        lines.extend('  %s' % difference for difference in self.differences)
+        lines.append('Reference trace:')
+        lines.extend('  %8d  %-12s %s' % entry for entry in self.trace)
+        lines.append('Reference is at %s, candidate is at %s.' % (self.reference, self.candidate))
+        return '\n'.join(lines)
+
+class DifferentialTest(object):
+    """
+    This runs the same program on the reference interpreter and on an optimized engine in lockstep, comparing the
+    registers, flags and a hash of each memory region every *every* instructions, and once either side stops.  Both
+    reference and candidate are callables returning a new CPUEngine or BatchEngine, so that each gets its own machine;
+    give both a ReplayDevice for the same log to feed them identical device input.  A fast engine may execute several
+    instructions in one step, such as a fused sequence, so the reference catches up before each comparison, and one
+    is made at the first point both sides agree on after each interval.  When a difference is found, the test runs again
+    comparing after every instruction, to find the first instruction that went wrong.
+    """
+    def __init__(self, reference, candidate, every=1000, regions=REGIONS, context=16):
+        self.reference = reference
+        self.candidate = candidate
+        self.every = every
+        self.regions = regions
+        self.context = context #: Reference instructions shown before a divergence.
+    def run(self, limit=None):
+        """ Returns the first Divergence, or None if both sides agree until they stop or reach limit instructions. """
+        divergence = self.lockstep(self.every, limit)
+        if divergence is not None and self.every > 1:
+            first = self.lockstep(1, divergence.cycles)
+            if first is not None:
+                return first
+        return divergence
+    def lockstep(self, every, limit):
+        reference, candidate = self.reference(), self.candidate()
+        trace = collections.deque(maxlen=self.context)
+        checkpoint = every
+        while True:
+            if candidate.active:
+                candidate.step()
+            while reference.active and reference.cycles < candidate.cycles or \
+                  candidate.error is not None and reference.active and reference.cycles == candidate.cycles:
+                # A faulting instruction isn't counted, so the reference also runs the one the candidate faulted on.
+                trace.append((reference.cycles, reference.describe(reference.pc), reference.instruction()))
+                reference.step()
+            finished = not reference.active or not candidate.active
+            if finished or reference.cycles == candidate.cycles and reference.cycles >= checkpoint:
+                differences = self.compare(reference, candidate)
+                if differences:
+                    return Divergence(reference.cycles, differences, list(trace),
+                                      reference.describe(reference.pc), candidate.describe(candidate.pc))
+                checkpoint = reference.cycles-reference.cycles%every+every
+            if finished:
+                return None
+            if limit is not None and reference.cycles >= limit:
+                return None
+    def compare(self, reference, candidate):
+        """ Returns a description of each difference between the two sides, an empty list if they agree. """
+        differences = []
+        if reference.cycles != candidate.cycles:
+            differences.append('instructions: %d != %d' % (reference.cycles, candidate.cycles))
+        states = [(engine.error or ('running' if engine.active else 'halted')) for engine in (reference, candidate)]
+        if states[0] != states[1]:
+            differences.append('state: %s != %s' % tuple(states))
+        for reg, a, b in zip(REGISTERS, reference.registers(), candidate.registers()):
+            if a != b:
+                differences.append('%s: %s != %s' % (reg, hex(a), hex(b)))
+        if reference.flags() != candidate.flags():
+            differences.append('flags: %s != %s' % (bin(reference.flags()), bin(candidate.flags())))
+        for addr, size in self.regions:
+            a, b = reference.read(addr, size), candidate.read(addr, size)
+            if hashlib.md5(a).digest() != hashlib.md5(b).digest():
+                first = next(i for i in range(min(len(a), len(b))) if a[i] != b[i])
+                differences.append('memory at %s: %s != %s' % (reference.describe(addr+first), hex(ord(a[first])), hex(ord(b[first]))))
+        return differences
+
+def main():
+    """ Runs a binary on the reference interpreter and an optimized engine in lockstep, reporting any divergence. """
+    from optparse import OptionParser
+    from simple_cpu.replay import replay
+    parser = OptionParser('%prog [options] BINARY')
+    parser.add_option('-e', '--engine', dest='engine', default='fusion', help='Engine to check: fusion, fastforward or batch')
+    parser.add_option('-l', '--log', dest='log', help='Feed both sides the device input recorded in LOG')
+    parser.add_option('-n', '--every', type='int', dest='every', default=1000, help='Instructions between comparisons')
+    parser.add_option('--limit', type='int', dest='limit', help='Stop after LIMIT instructions')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Please specify a binary.')
+    if options.engine not in ('fusion', 'fastforward', 'batch',):
+        parser.error('Unknown engine: %s' % options.engine)
+    def machine(engine=None):
+        cpu = CPU()
+        if options.log:
+            replay(cpu, options.log)
+        cpu.loadbin(args[0], 0)
+        if engine == 'fusion':
+            from simple_cpu.fusion import Fuser
+            Fuser(cpu)
+        elif engine == 'fastforward':
+            from simple_cpu.fastforward import IdleLoopDetector
+            IdleLoopDetector(cpu)
+        return CPUEngine(cpu)
+    def batch():
+        from simple_cpu.batch import BatchCPU
+        engine = BatchCPU(1)
+        engine.loadbin(args[0], 0)
+        return BatchEngine(engine)
+    if options.engine == 'batch' and options.log:
+        parser.error('The batch engine has no devices to replay a log into.')
+    candidate = batch if options.engine == 'batch' else lambda: machine(options.engine)
+    divergence = DifferentialTest(machine, candidate, options.every).run(options.limit)
+    if divergence is None:
+        sys.stdout.write('No divergence found.\n')
+        sys.exit(0)
+    sys.stdout.write('%s\n' % divergence)
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -10,3 +10,11 @@ class InvalidInterrupt(CPUException):
 class MemoryProtectionError(CPUException):
     """ This exception is raised if the user's code attempts to read or write from protected memory it cannot access. """
     pass
+
+class ExecutionLimit(CPUException):
+    """ This exception is raised when the user's code runs past the instruction or time budget given to the CPU. """
+    pass
+
+class QuotaExceeded(ExecutionLimit):
+    """ This exception is raised when the next instruction would cost more than the budget left, CPU.resume() continues the run. """
+    pass
@@ -0,0 +1,86 @@
+import time
+from simple_cpu.exceptions import CPUException
+from simple_cpu.decoder import decode
+
+class IdleLoopDetector(object):
+    """
+    This watches the backward conditional jumps a CPU takes and recognizes two kinds of tight loop from their bodies.
+    A counter loop (INC/DEC a register, CMP it with a constant, JNE back) is jumped straight to its final state.
+    A polling loop (IN a register from a port, CMP/TEST it with a constant, JE/JNE back) cannot change until a device
+    does something, so once it has spun for a while the host sleeps until the next device event between polls.  Each
+    loop's body is kept with its classification and compared before it is used, so code written over it is classified
+    again.
+    """
+    poll_threshold = 100 #: Iterations of the same polling loop before the host starts sleeping.
+    max_sleep = 0.01 #: Longest sleep between polls, for devices which change state without calling wake().
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.loops = {} #: The body and classification of each loop seen, keyed by (start, end) address.
+        self.skipped = 0 #: Instructions which were not executed because a counter loop was fast-forwarded.
+        self.sleeps = 0
+        self.idle_time = 0.0
+        self.polling = None
+        self.spins = 0
+        cpu.fastforward = self
+    def classify(self, start, end):
+        """ Decodes the loop body from start up to end, returning a description of a known loop or None. """
+        body = []
+        addr = start
+        try:
+            while addr < end and len(body) < 3:
+                op, operands, size = decode(self.cpu.mem.read, addr, self.cpu.fixed_at(addr))
+                body.append((op, operands))
+                addr += size
+        except (CPUException, KeyError):
+            return None
+        if addr != end or len(body) != 3:
+            return None
+        (op1, args1), (op2, args2), (op3, args3) = body
+        if op2 not in (0xe, 0x11,):
+            return None
+        regs = [value for typ, value in args2 if typ == 0]
+        consts = [value for typ, value in args2 if typ in (1,2,3,)]
+        if len(regs) != 1 or len(consts) != 1:
+            return None
+        if op1 in (0xa, 0xb,) and op2 == 0x11 and op3 == 0x10 and args1 == [(0, regs[0])]:
+            return ('counter', self.cpu.var_map[regs[0]], 1 if op1 == 0xa else -1, consts[0])
+        if op1 == 0x3 and op3 in (0xf, 0x10,) and args1[1] == (0, regs[0]):
+            return ('poll',)
+        return None
+    def backedge(self, start, end):
+        """ Called for a backward conditional jump about to be taken, returns True if the CPU state was fast-forwarded. """
+        key = (start, end)
+        code = self.cpu.mem.readrange(start, end-start)
+        entry = self.loops.get(key)
+        if entry is None or entry[0] != code:
+            entry = self.loops[key] = (code, self.classify(start, end))
+        loop = entry[1]
+        if loop is None:
+            return False
+        if loop[0] == 'counter':
+            return self.fast_forward(end, *loop[1:])
+        self.poll(key)
+        return False
+    def fast_forward(self, end, reg, step, limit):
+        register = getattr(self.cpu.regs, reg)
+        remaining = (limit-register.b)*step
+        if remaining <= 0:
+            return False
+        register.value = limit
+        self.cpu.compare(limit, limit)
+        self.cpu.mem.ptr = end
+        self.skipped += 3*remaining
+        return True
+    def poll(self, key):
+        if key != self.polling:
+            self.polling, self.spins = key, 0
+            return
+        self.spins += 1
+        if self.spins < self.poll_threshold:
+            return
+        timeout = self.cpu.next_event()
+        timeout = self.max_sleep if timeout is None else min(timeout, self.max_sleep)
+        start = time.time()
+        self.cpu.idle(timeout)
+        self.idle_time += time.time()-start
+        self.sleeps += 1
@@ -1,32 +1,34 @@
 from simple_cpu.devices import BaseCPUDevice
-from simple_cpu.memory import MemoryMap
+from simple_cpu.memory import WindowMap
 import vgaconsole, pygame
 
-class Framebuffer(MemoryMap):
+class Framebuffer(WindowMap):
+    """ The VGA text buffer mapped straight into guest memory, guest writes land in the console's own buffer. """
     def __init__(self, vgabuf):
-        super(Framebuffer, self).__init__(0x1)
-        self.mem = vgabuf
-        self.size = 4000
-        self.__read = True
-        self.__write = True
-        self.__execute = False
+        super(Framebuffer, self).__init__(vgabuf)
 
 class VGAConsoleDevice(BaseCPUDevice):
     """ This virtual device will allow you to easily interface with my VGAConsole project. """
     ports = [7777]
+    dma_channel = 3
     def start(self):
         """ This will initialize the actual framebuffer device. """
         pygame.display.init()
         self.screen = pygame.display.set_mode((640,400),0,8)
         pygame.display.set_caption('Simple CPU Simulator framebuffer')
         self.vga = vgaconsole.VGAConsole(self.screen)
-        self.cpu.mem.add_map(0xc, Framebuffer(self.vga.vgabuf))
+        self.framebuffer = Framebuffer(self.vga.vgabuf)
+        self.cpu.mem.add_map(0xc, self.framebuffer)
         self.vga.foreground = 7
         self.vga.background = 0
         self.vga.draw()
         pygame.display.update()
     def stop(self):
         pygame.quit()
+    def dma_read(self, offset, size):
+        return self.framebuffer.readblock(offset, size)
+    def dma_write(self, offset, data):
+        self.framebuffer.writeblock(offset, data)
     def cycle(self):
         vgaconsole.clock.tick(30)
         events = pygame.event.get()
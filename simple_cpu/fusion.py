@@ -0,0 +1,152 @@
+from simple_cpu.exceptions import CPUException
+from simple_cpu.decoder import decode
+
+signed = lambda v: v-0x10000 if v&0x8000 else v
+
+#: The condition each conditional jump tests, worked out straight from the compared values instead of the flags.
+CONDITIONS = {
+    0xf: lambda a, b: a == b,
+    0x10: lambda a, b: a != b,
+    0x1b: lambda a, b: signed(a) < signed(b),
+    0x1c: lambda a, b: signed(a) > signed(b),
+    0x1d: lambda a, b: signed(a) <= signed(b),
+    0x1e: lambda a, b: signed(a) >= signed(b),
+    0x1f: lambda a, b: a < b,
+    0x20: lambda a, b: a > b,
+    0x21: lambda a, b: a <= b,
+    0x22: lambda a, b: a >= b,
+}
+COMPARES = (0xe, 0x11,)
+STEPS = (0xa, 0xb,)
+MOV = 0x2
+
+class Fuser(object):
+    """
+    This dispatches common instruction sequences as one fused handler, by wrapping a CPU's process() method the same
+    way the Profiler does: CMP or TEST followed by a conditional jump, INC or DEC followed by those two, and a pair of
+    MOVs.  Each sequence is decoded once into a closure over its operands, cached by address and checked against the
+    bytes in memory before it runs, so self-modifying code is still seen.  A jump into the middle of a sequence lands
+    on an address of its own, which runs unfused or as a sequence starting there, and a breakpoint inside a sequence
+    stops it from being fused.  A fused sequence counts as all of its instructions, but devices cycle once for it,
+    so an interrupt can no longer arrive between a comparison and its jump.  Set *enabled* to False to compare.
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.enabled = True
+        self.cache = {}
+        self.fused = 0 #: Instructions executed as part of a fused sequence.
+        self.process = cpu.process
+        cpu.process = self.step
+    def detach(self):
+        del self.cpu.process
+    def step(self):
+        cpu = self.cpu
+        if not self.enabled:
+            return self.process()
+        pc = cpu.cs.b+cpu.ip.b
+        try:
+            entry = self.cache[pc]
+        except KeyError:
+            entry = self.cache[pc] = self.compile(pc)
+        if entry is None:
+            return self.process()
+        code, count, handler = entry
+        if cpu.mem.readblock(pc, len(code)) != code:
+            entry = self.cache[pc] = self.compile(pc)
+            if entry is None:
+                return self.process()
+            code, count, handler = entry
+        if 'bp' in cpu.__dict__ and pc < cpu.bp < pc+len(code):
+            return self.process()
+        handler(pc)
+        cpu.cycles += count-1
+        self.fused += count
+    def compile(self, pc):
+        """ Decodes the sequence at pc, returning (code, instruction count, handler), or None if it isn't one. """
+        cpu = self.cpu
+        try:
+            body = []
+            addr = pc
+            for i in range(3):
+                op, operands, size = decode(cpu.mem.read, addr, cpu.fixed_at(addr))
+                body.append((op, operands, addr, size))
+                addr += size
+                if i == 1 and body[0][0] in COMPARES+(MOV,):
+                    break
+            ops = [item[0] for item in body]
+            if ops[0] in COMPARES and ops[1] in CONDITIONS:
+                handler = self.compare_jump(body[0], body[1])
+            elif ops[0] in STEPS and ops[1] == 0x11 and ops[2] in CONDITIONS:
+                handler = self.step_compare_jump(*body)
+            elif ops == [MOV, MOV]:
+                handler = self.mov_mov(*body)
+            else:
+                return None
+            if handler is None:
+                return None
+            code = cpu.mem.readblock(pc, addr-pc)
+        except (CPUException, KeyError, IndexError):
+            return None
+        if len(code) != addr-pc:
+            return None
+        return code, len(body), handler
+    def operand(self, typ, value):
+        """ Returns a function reading an operand the way CPU.get_value and CPU.resolve would. """
+        cpu = self.cpu
+        if typ == 0:
+            register = getattr(cpu.regs, cpu.var_map[value])
+            return lambda: register.b
+        elif typ == 4:
+            return lambda: cpu.mem.read(value)
+        elif typ == 5:
+            return lambda: cpu.mem.read16(value)
+        elif typ in (1,2,3,):
+            return lambda: value
+        raise CPUException('Invalid operand type: %s' % typ)
+    def destination(self, typ, value):
+        return (typ, getattr(self.cpu.regs, self.cpu.var_map[value]) if typ == 0 else value)
+    def jump(self, compare, jump):
+        """ Returns a function which compares and then jumps, given the address just past the jump. """
+        cpu = self.cpu
+        src, dst = [self.operand(*operand) for operand in compare[1]]
+        target = self.operand(*jump[1][0])
+        condition = CONDITIONS[jump[0]]
+        def compare_jump(end):
+            a, b = dst(), src()
+            cpu.compare(a, b)
+            jmp = target()
+            cpu.mem.ptr = end
+            if condition(a&0xFFFF, b&0xFFFF):
+                cpu.branch(jmp)
+            cpu.ip.value = cpu.mem.ptr-cpu.cs.b
+        return compare_jump
+    def compare_jump(self, compare, jump):
+        run = self.jump(compare, jump)
+        end = jump[2]+jump[3]-compare[2]
+        return lambda pc: run(pc+end)
+    def step_compare_jump(self, step, compare, jump):
+        cpu = self.cpu
+        typ, value = step[1][0]
+        if typ != 0:
+            return None
+        register = getattr(cpu.regs, cpu.var_map[value])
+        delta = 1 if step[0] == 0xa else -1
+        run = self.jump(compare, jump)
+        end = jump[2]+jump[3]-step[2]
+        def handler(pc):
+            register.value += delta
+            run(pc+end)
+        return handler
+    def mov_mov(self, first, second):
+        cpu = self.cpu
+        src1, src2 = self.operand(*first[1][0]), self.operand(*second[1][0])
+        dst1, dst2 = self.destination(*first[1][1]), self.destination(*second[1][1])
+        middle = first[3]
+        end = first[3]+second[3]
+        def handler(pc):
+            cpu.set_value(dst1, src1())
+            cpu.ip.value = pc+middle-cpu.cs.b
+            cpu.set_value(dst2, src2())
+            cpu.mem.ptr = pc+end
+            cpu.ip.value = cpu.mem.ptr-cpu.cs.b
+        return handler
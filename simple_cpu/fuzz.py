@@ -0,0 +1,209 @@
+import os, re, sys, time, random, hashlib, struct
+from simple_cpu.exceptions import ExecutionLimit
+from simple_cpu.cpu import CPU
+from simple_cpu.devices import BaseCPUDevice, WatchdogDevice
+from simple_cpu.memory import MemoryMap
+from simple_cpu.decoder import OPERANDS
+
+MAP_SIZE = 0x2000 #: Size of the coverage bitmap, in bytes.
+BRANCHES = set([0x1, 0x5, 0x6, 0x9, 0xf, 0x10, 0x1a]+range(0x1b, 0x24)) #: Opcodes which end a basic block.
+
+def pack_input(code, data=''):
+    """ A fuzz input is the guest program followed by the bytes its devices will read. """
+    return struct.pack('<H', len(code))+code+data
+
+def unpack_input(buf):
+    if len(buf) < 2:
+        return buf, ''
+    size = struct.unpack('<H', buf[:2])[0]
+    return buf[2:2+size], buf[2+size:]
+
+class FuzzInputDevice(BaseCPUDevice):
+    """ This stands in for the console, feeding keyboard reads from the fuzz input and discarding output. """
+    ports = [4000, 8000]
+    def feed(self, data):
+        self.data = data
+        self.offset = 0
+    def in_4000(self):
+        if self.offset >= len(self.data):
+            return 0
+        self.offset += 1
+        return ord(self.data[self.offset-1])
+    def out_8000(self, value):
+        pass
+
+class CoverageTracer(object):
+    """
+    This records the edges between basic blocks which a CPU takes into a compact hit count bitmap, by wrapping its
+    process() method the same way the Profiler does.  *touched* lists the bitmap entries hit since the last reset().
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.bitmap = bytearray(MAP_SIZE)
+        self.touched = []
+        self.process = cpu.process
+        cpu.process = self.step
+        self.reset()
+    def reset(self):
+        for i in self.touched:
+            self.bitmap[i] = 0
+        self.touched = []
+        self.prev = 0
+    def step(self):
+        cpu = self.cpu
+        op = cpu.mem.read(cpu.cs.b+cpu.ip.b)
+        result = self.process()
+        if op in BRANCHES:
+            loc = (cpu.cs.b+cpu.ip.b)*0x9E37&(MAP_SIZE-1)
+            i = loc^self.prev
+            if not self.bitmap[i]:
+                self.touched.append(i)
+            if self.bitmap[i] < 255:
+                self.bitmap[i] += 1
+            self.prev = loc>>1
+        return result
+
+class Fuzzer(object):
+    """
+    This is a coverage guided fuzzer for guest programs and for the interpreter itself.  Inputs from the corpus are
+    mutated and run on one CPU, which is reset from a snapshot between runs instead of being rebuilt, under the
+    instruction and time budgets of a WatchdogDevice.  Inputs which reach new coverage join the corpus, and inputs
+    which raise an exception (a crash) or exceed a budget (a hang) are saved into the output directory.
+    """
+    instructions = 1000
+    seconds = 0.1
+    max_size = 0x1000
+    def __init__(self, output, seeds=None, seed=None):
+        self.output = output
+        for name in ('queue', 'crashes', 'hangs'):
+            path = os.path.join(output, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.random = random.Random(seed)
+        self.cpu = CPU()
+        self.cpu.mem.add_map(0xe, MemoryMap(0x2000))
+        self.cpu.add_device(FuzzInputDevice)
+        self.cpu.add_device(type('FuzzWatchdog', (WatchdogDevice,), {'instructions': self.instructions, 'seconds': self.seconds}))
+        self.input, self.watchdog = self.cpu.devices
+        self.tracer = CoverageTracer(self.cpu)
+        self.clean = self.cpu.snapshot()
+        self.virgin = bytearray(MAP_SIZE)
+        self.corpus = []
+        self.crashes = {}
+        self.hangs = {}
+        self.execs = 0
+        self.started = time.time()
+        for buf in seeds or [pack_input('\x05')]:
+            self.run_one(buf)
+            if buf not in self.corpus:
+                self.corpus.append(buf)
+    def execute(self, buf):
+        """ Runs one input on the reset machine, returning None, or the exception which ended the run. """
+        code, data = unpack_input(buf)
+        self.cpu.restore(self.clean)
+        self.cpu.mem.writeblock(0, code[:self.max_size])
+        self.input.feed(data)
+        self.watchdog.arm()
+        self.tracer.reset()
+        self.execs += 1
+        try:
+            self.cpu.run()
+        except Exception, e:
+            return e
+        return None
+    def run_one(self, buf):
+        """ Runs an input, saves it if it crashed, hung or found new coverage, and returns True if it was new. """
+        error = self.execute(buf)
+        if error is not None:
+            kind, found = ('hangs', self.hangs) if isinstance(error, ExecutionLimit) else ('crashes', self.crashes)
+            signature = '%s: %s' % (error.__class__.__name__, re.sub(r'\d+', 'N', str(error)))
+            if signature not in found:
+                found[signature] = self.save(kind, buf, signature)
+            return False
+        new = False
+        for i in self.tracer.touched:
+            bucket = 1<<min(self.tracer.bitmap[i].bit_length()-1, 7)
+            if not self.virgin[i] & bucket:
+                self.virgin[i] |= bucket
+                new = True
+        if new:
+            self.corpus.append(buf)
+            self.save('queue', buf)
+        return new
+    def save(self, kind, buf, note=None):
+        name = hashlib.sha1(buf).hexdigest()[:16]
+        path = os.path.join(self.output, kind, name)
+        open(path, 'wb').write(buf)
+        if note is not None:
+            open(path+'.txt', 'w').write(note+'\n')
+        return path
+    def mutate(self, buf):
+        code, data = unpack_input(buf)
+        rnd = self.random
+        for i in range(rnd.randint(1, 4)):
+            target = rnd.randint(0, 3) if data else rnd.randint(0, 2)
+            if target == 3:
+                data = self.mutate_bytes(data)
+            elif target == 2 and len(self.corpus) > 1:
+                other = unpack_input(rnd.choice(self.corpus))[0]
+                cut = rnd.randint(0, len(code))
+                code = code[:cut]+other[rnd.randint(0, len(other)):]
+            elif target == 1:
+                cut = rnd.randint(0, len(code))
+                op = rnd.choice(OPERANDS.keys())
+                operands = ''.join(chr(rnd.randint(0, 0x1f)) for n in range(OPERANDS[op]))
+                code = code[:cut]+chr(op)+operands+code[cut:]
+            else:
+                code = self.mutate_bytes(code)
+        return pack_input(code[:self.max_size], data)
+    def mutate_bytes(self, buf):
+        rnd = self.random
+        if not buf:
+            return chr(rnd.randint(0, 255))
+        pos = rnd.randint(0, len(buf)-1)
+        choice = rnd.randint(0, 3)
+        if choice == 0:
+            return buf[:pos]+chr(ord(buf[pos])^1<<rnd.randint(0, 7))+buf[pos+1:]
+        elif choice == 1:
+            return buf[:pos]+chr(rnd.randint(0, 255))+buf[pos+1:]
+        elif choice == 2:
+            return buf[:pos]+chr(rnd.randint(0, 255))+buf[pos:]
+        return buf[:pos]+buf[pos+1:]
+    def fuzz(self, iterations=None, duration=None):
+        """ Mutates and runs inputs until *iterations* executions or *duration* seconds, whichever comes first. """
+        started = time.time()
+        count = 0
+        while (iterations is None or count < iterations) and (duration is None or time.time()-started < duration):
+            self.run_one(self.mutate(self.random.choice(self.corpus)))
+            count += 1
+    @property
+    def edges(self):
+        return len([b for b in self.virgin if b])
+    def stats(self):
+        elapsed = time.time()-self.started
+        return {
+            'execs': self.execs,
+            'execs_per_sec': self.execs/elapsed if elapsed else 0.0,
+            'corpus': len(self.corpus),
+            'edges': self.edges,
+            'crashes': len(self.crashes),
+            'hangs': len(self.hangs),
+        }
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser('%prog [options] OUTPUT [SEED...]')
+    parser.add_option('-n', '--iterations', type='int', dest='iterations', help='Stop after this many executions')
+    parser.add_option('-t', '--time', type='float', dest='duration', default=60.0, help='Stop after this many seconds')
+    parser.add_option('--seed', type='int', dest='seed', help='Seed for the random number generator')
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error('Please specify an output directory.')
+    seeds = [pack_input(open(filename, 'rb').read()) for filename in args[1:]]
+    fuzzer = Fuzzer(args[0], seeds or None, options.seed)
+    fuzzer.fuzz(options.iterations, options.duration)
+    for key, value in sorted(fuzzer.stats().items()):
+        sys.stdout.write('%s: %s\n' % (key, value))
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-import mmap, struct, math
+import os, mmap, struct, math, threading
 from simple_cpu.exceptions import MemoryProtectionError
 
 class Unit(object):
@@ -89,10 +89,12 @@ class UInt32(Unit):
     """ This is a Unit that only supports 32-bit integers. This is not used much in the code at all, as the VM isn't really 32-bit address enabled. """
     fmt = 'L'
 
+PAGE_SIZE = 0x100 #: Granularity at which resident memory is counted and sparse memory is allocated.
+
 class MemoryMap(object):
     """ This class controls a segment of memory. """
-    def __init__(self, size):
-        self.mem = mmap.mmap(-1, size)
+    def __init__(self, size, mem=None):
+        self.mem = mmap.mmap(-1, size) if mem is None else mem
         self.size = size
         self.__read = True
         self.__write = True
@@ -149,12 +151,18 @@ class MemoryMap(object):
             self.write(addr&0xFF)
             self.write(addr>>8)
     def readblock(self, addr, size):
-        self.mem.seek(addr)
-        return self.mem.read(size)
+        if not self.__read:
+            raise MemoryProtectionError('Attempted to read from protected memory space: %s' % addr)
+        return self.mem[addr:addr+size]
     def writeblock(self, addr, block):
-        self.mem.seek(addr)
-        self.mem.write(block)
+        if not self.__write:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        if not isinstance(block, str):
+            block = memoryview(block).tobytes()
+        self.mem[addr:addr+len(block)] = block
     def clearblock(self, addr, size):
+        if not self.__write:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
         self.mem.seek(addr)
         self.mem.write('\x00' * size)
     def write_protect(self):
@@ -168,45 +176,310 @@ class MemoryMap(object):
     def readable(self):
         return self.__read
     @property
+    def resident_pages(self):
+        """ The number of pages of host memory this map holds, which is all of them for an eagerly allocated map. """
+        return (self.size+PAGE_SIZE-1)//PAGE_SIZE
+    @property
     def ptr(self):
         return self.mem.tell()
     @ptr.setter
     def ptr(self, value):
         self.mem.seek(value)
 
+ZERO_PAGE = bytearray(PAGE_SIZE) #: Shared by every untouched sparse page, it must never be written to.
+
+class SparseMemoryMap(MemoryMap):
+    """
+    This memory map allocates its pages on first write.  Every page starts out as the one shared ZERO_PAGE, so a large
+    mostly idle address space costs a list entry per page until the guest touches it.  Writing zeros to a page which
+    was never allocated, and clearing whole pages, do not keep any memory resident.  Only bytearray pages are private
+    to the map, any other page (such as a ROMMap image page) is shared read-only and copied when it is first written.
+    """
+    def __init__(self, size):
+        super(SparseMemoryMap, self).__init__(size, [ZERO_PAGE]*((size+PAGE_SIZE-1)//PAGE_SIZE))
+        self.pages = self.mem
+        self.__ptr = 0
+    def clear(self):
+        self.pages[:] = [ZERO_PAGE]*len(self.pages)
+        self.__ptr = 0
+    def __check_addr(self, addr):
+        if addr < 0 or addr > self.size-1:
+            raise IndexError
+    def page(self, addr):
+        """ Returns the private page holding addr, allocating or copying it if it is still shared. """
+        page = self.pages[addr//PAGE_SIZE]
+        if page is ZERO_PAGE or not isinstance(page, bytearray):
+            page = self.pages[addr//PAGE_SIZE] = bytearray(page[0:PAGE_SIZE])
+        return page
+    def fetch(self):
+        addr = self.__ptr
+        self.__ptr += 1
+        self.__check_addr(addr)
+        return self.pages[addr//PAGE_SIZE][addr%PAGE_SIZE]
+    def read(self, addr=None):
+        if not self.readable:
+            raise MemoryProtectionError('Attempted to read from protected memory space: %s' % addr)
+        if addr is None:
+            addr = self.__ptr
+            self.__ptr += 1
+        self.__check_addr(addr)
+        return self.pages[addr//PAGE_SIZE][addr%PAGE_SIZE]
+    def write(self, addr, byte=None):
+        if not self.writeable:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        if byte is None:
+            addr, byte = self.__ptr, addr
+            self.__ptr += 1
+        self.__check_addr(addr)
+        if isinstance(byte, str):
+            byte = ord(byte)
+        if byte or self.pages[addr//PAGE_SIZE] is not ZERO_PAGE:
+            self.page(addr)[addr%PAGE_SIZE] = byte
+    def readblock(self, addr, size):
+        size = max(0, min(size, self.size-addr))
+        chunks = []
+        while size > 0:
+            offset = addr%PAGE_SIZE
+            count = min(size, PAGE_SIZE-offset)
+            chunks.append(str(self.pages[addr//PAGE_SIZE][offset:offset+count]))
+            addr += count
+            size -= count
+        return ''.join(chunks)
+    def writeblock(self, addr, block):
+        if not self.writeable:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        if not isinstance(block, str):
+            block = memoryview(block).tobytes()
+        if addr+len(block) > self.size:
+            raise IndexError
+        pos = 0
+        while pos < len(block):
+            offset = addr%PAGE_SIZE
+            chunk = block[pos:pos+PAGE_SIZE-offset]
+            page = self.pages[addr//PAGE_SIZE]
+            if not chunk.strip('\x00'):
+                self.clearblock(addr, len(chunk))
+            elif isinstance(page, bytearray) or page[offset:offset+len(chunk)] != chunk:
+                self.page(addr)[offset:offset+len(chunk)] = chunk
+            addr += len(chunk)
+            pos += len(chunk)
+    def clearblock(self, addr, size):
+        if not self.writeable:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        end = min(addr+size, self.size)
+        while addr < end:
+            offset = addr%PAGE_SIZE
+            count = min(end-addr, PAGE_SIZE-offset)
+            if count == PAGE_SIZE:
+                self.pages[addr//PAGE_SIZE] = ZERO_PAGE
+            elif self.pages[addr//PAGE_SIZE] is not ZERO_PAGE:
+                self.page(addr)[offset:offset+count] = ZERO_PAGE[:count]
+            addr += count
+    @property
+    def resident_pages(self):
+        return len([page for page in self.pages if page is not ZERO_PAGE and isinstance(page, bytearray)])
+    @property
+    def ptr(self):
+        return self.__ptr
+    @ptr.setter
+    def ptr(self, value):
+        self.__ptr = value
+
+class FileMemoryMap(MemoryMap):
+    """
+    This memory map is backed by a shared mapping of a file, so the host pages it in on demand and only dirty pages are
+    ever written back.  The flush policy decides when they are: 'halt' flushes when the CPU halts, 'periodic' flushes
+    every *flush_interval* seconds from a background thread, and 'explicit' only when flush() is called.
+    The file is created, or grown, to size bytes.
+    """
+    flush_interval = 5.0
+    policies = ('halt', 'periodic', 'explicit',)
+    def __init__(self, filename, size=0x2000, flush_policy='halt'):
+        if flush_policy not in self.policies:
+            raise ValueError('Unknown flush policy: %s' % flush_policy)
+        self.file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+        if os.path.getsize(filename) < size:
+            self.file.truncate(size)
+        super(FileMemoryMap, self).__init__(size, mmap.mmap(self.file.fileno(), size))
+        self.flush_policy = flush_policy
+        self.flushes = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        if flush_policy == 'periodic':
+            thread = threading.Thread(target=self.flusher)
+            thread.daemon = True
+            thread.start()
+    def flusher(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+    def flush(self):
+        """ Writes the pages changed since the last flush back to the file. """
+        with self.lock:
+            if not self.closed.is_set():
+                self.mem.flush()
+                self.flushes += 1
+    def halt(self):
+        """ Called by the MemoryController when the CPU halts. """
+        if self.flush_policy == 'halt':
+            self.flush()
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.flush()
+        with self.lock:
+            self.closed.set()
+            self.mem.close()
+            self.file.close()
+
+shared_images = {} #: Read-only mappings of image files, keyed by path and modification time.
+
+def shared_image(filename):
+    """ Returns a read-only mmap of filename, which is opened once and shared by every map of the same file. """
+    path = os.path.realpath(filename)
+    key = (path, os.stat(path).st_mtime)
+    if key not in shared_images:
+        f = open(path, 'rb')
+        try:
+            shared_images[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else ''
+        finally:
+            f.close()
+    return shared_images[key]
+
+class ImagePage(object):
+    """ A page of a shared image, it is indexed like a bytearray page but cannot be written to. """
+    def __init__(self, image, start):
+        self.image = image
+        self.start = start
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(PAGE_SIZE)
+            return self.image[self.start+start:self.start+stop]
+        return ord(self.image[self.start+i])
+
+class ROMMap(SparseMemoryMap):
+    """
+    This memory map serves images such as interrupt.bin, the interrupt table or a program straight out of one read-only
+    mmap of the file, shared by every CPU which loads the same file.  Pages a guest writes to are copied privately, so
+    other machines never see the change.  Call write_protect() to make writes an error instead.
+    """
+    def load(self, filename, dest=0):
+        """ Maps the contents of filename at dest. Pages only partly covered by the image are copied. """
+        image = shared_image(filename)
+        if dest < 0 or dest+len(image) > self.size:
+            raise IndexError('Image %s does not fit at %s.' % (filename, dest))
+        end = dest+len(image)
+        addr = dest
+        while addr < end:
+            offset = addr%PAGE_SIZE
+            count = min(end-addr, PAGE_SIZE-offset)
+            if count == PAGE_SIZE:
+                self.pages[addr//PAGE_SIZE] = ImagePage(image, addr-dest)
+            else:
+                self.page(addr)[offset:offset+count] = image[addr-dest:addr-dest+count]
+            addr += count
+
+class WindowMap(MemoryMap):
+    """
+    This memory map exposes a buffer owned by a device, such as a bytearray, directly in the guest address space.
+    Guest writes land in the device's storage with no copy, and bulk transfers are slice assignments on a memoryview of it.
+    """
+    def __init__(self, buf, execute=False):
+        super(WindowMap, self).__init__(len(buf), memoryview(buf))
+        self.buf = buf
+        self.__ptr = 0
+        self.__execute = execute
+    def clear(self):
+        self.clearblock(0, self.size)
+        self.__ptr = 0
+    def fetch(self):
+        if not self.__execute:
+            raise MemoryProtectionError('Attempted to execute code from protected memory space!')
+        self.__ptr += 1
+        return self.buf[self.__ptr-1]
+    def read(self, addr=None):
+        if not self.readable:
+            raise MemoryProtectionError('Attempted to read from protected memory space: %s' % addr)
+        if addr is None:
+            self.__ptr += 1
+            return self.buf[self.__ptr-1]
+        return self.buf[addr]
+    def write(self, addr, byte=None):
+        if not self.writeable:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        if byte is None:
+            addr, byte = self.__ptr, addr
+            self.__ptr += 1
+        if isinstance(byte, str):
+            byte = ord(byte)
+        self.buf[addr] = byte
+    def readblock(self, addr, size):
+        return self.mem[addr:addr+size].tobytes()
+    def writeblock(self, addr, block):
+        if not self.writeable:
+            raise MemoryProtectionError('Attempted to write to protected memory space: %s' % addr)
+        self.mem[addr:addr+len(block)] = block
+    def clearblock(self, addr, size):
+        self.writeblock(addr, '\x00' * size)
+    @property
+    def ptr(self):
+        return self.__ptr
+    @ptr.setter
+    def ptr(self, value):
+        self.__ptr = value
+
 class IOMap(object):
-    """ This is the memory mapped I/O interface class, which controls access to I/O devices. """
+    """
+    This is the memory mapped I/O interface class, which controls access to I/O devices.
+    Each 256 byte I/O page is resolved to a bound handler once, when the device is mapped, so an access is a single list lookup.
+    A device may declare an *io_buffer* (a bytearray) which is read directly, only *mem_read* and *mem_write* callbacks run Python code.
+    """
     readable = True
     writeable = True
     def __init__(self, size=0x2000):
         self.__map = {} #: This is the memory mapping hash.
         self.__size = size
         self.__habit = 8
-        self.__bitmask = 0x1ff
+        self.__bitmask = 0xff
+        pages = size>>self.__habit
+        self.__readers = [self.__unmapped]*pages #: Resolved read handler for each I/O page.
+        self.__writers = [self.__unmapped]*pages #: Resolved write handler for each I/O page.
+    def __unmapped(self, addr, byte=None):
+        raise MemoryProtectionError('No I/O device is mapped at this address.')
     def add_map(self, block, memory):
-        if not getattr(memory, 'mem_read', None):
-            raise
+        buf = getattr(memory, 'io_buffer', None)
+        if buf is not None:
+            reader = buf.__getitem__
+            writer = getattr(memory, 'mem_write', buf.__setitem__)
+        elif getattr(memory, 'mem_read', None):
+            reader = memory.mem_read
+            writer = getattr(memory, 'mem_write', self.__unmapped)
+        else:
+            raise TypeError('I/O device must provide either an io_buffer or a mem_read handler.')
+        self.__readers[block] = reader
+        self.__writers[block] = writer
         self.__map.update({block:memory})
     @property
     def memory_map(self):
         mapping = {}
         for block, memory in self.__map.items():
-            mapping.update({hex(block): [memory.readable, memory.writeable]})
+            mapping.update({hex(block): [True, self.__writers[block] != self.__unmapped]})
         return mapping
     def __len__(self):
-        return self.size
+        return self.__size
     def mem_read(self, addr):
-        ha = (addr>>self.__habit)
         try:
-            return self.__map[ha].mem_read(addr&self.__bitmask)
-        except:
-            raise
+            return self.__readers[addr>>self.__habit](addr&self.__bitmask)
+        except IndexError:
+            raise MemoryProtectionError('Unable to read from I/O address: %s' % addr)
     def mem_write(self, addr, byte):
-        ha = (addr>>self.__habit)
         try:
-            self.__map[ha].mem_write(addr&self.__bitmask, byte)
-        except:
-            raise
+            self.__writers[addr>>self.__habit](addr&self.__bitmask, byte)
+        except IndexError:
+            raise MemoryProtectionError('Unable to write to I/O address: %s' % addr)
+    read = mem_read
+    write = mem_write
+    def fetch(self):
+        raise MemoryProtectionError('Attempted to execute code from an I/O map!')
     def readblock(self, addr, size):
         raise MemoryProtectionError('Unsupported operation by I/O map.')
     def writeblock(self, addr, block):
@@ -241,6 +514,10 @@ class MemoryController(object):
         if not getattr(memory, 'read', None):
             raise
         self.__map.update({block:memory})
+    def find_map(self, addr):
+        """ Returns the block holding addr, with the memory mapped there or None, and the offset of addr within it. """
+        ha = (addr>>self.__habit)&self.__blksize
+        return ha, self.__map.get(ha), addr&self.__bitmask
     @property
     def memory_map(self):
         mapping = {}
@@ -249,6 +526,71 @@ class MemoryController(object):
         return mapping
     def __len__(self):
         return self.__size
+    @property
+    def resident_pages(self):
+        """ The pages of host memory held by all mapped memory, as reported by each map. """
+        return sum(getattr(memory, 'resident_pages', 0) for memory in self.__map.values())
+    def snapshot(self):
+        """ Returns a copy of the contents of every writeable memory map, which restore() puts back. """
+        snapshot = {}
+        for block, memory in self.__map.items():
+            if isinstance(memory, MemoryMap) and memory.writeable:
+                snapshot.update({block: memory.readblock(0, len(memory))})
+        return snapshot
+    def restore(self, snapshot):
+        for block, data in snapshot.items():
+            self.__map[block].writeblock(0, data)
+    def readrange(self, addr, size, fill='\x00'):
+        """
+        Reads size bytes from addr onwards, across as many memory maps as needed, with one readblock per map.
+        Unmapped blocks, I/O maps and read protected maps read as *fill*, so nothing here can trigger a device.
+        """
+        chunks = []
+        for memory, offset, count in self.spans(addr, min(size, self.__size+1-addr), False):
+            if isinstance(memory, MemoryMap) and memory.readable:
+                data = memory.readblock(offset, count)
+                chunks.append(data+fill*(count-len(data)))
+            else:
+                chunks.append(fill*count)
+        return ''.join(chunks)
+    def search(self, pattern, start=0, stop=None):
+        """ Returns the address of every occurrence of the byte string pattern between start and stop. """
+        if stop is None:
+            stop = self.__size+1
+        data = self.readrange(start, stop-start)
+        found = []
+        i = data.find(pattern)
+        while i != -1 and pattern:
+            found.append(start+i)
+            i = data.find(pattern, i+1)
+        return found
+    def diff(self, snapshot):
+        """ Compares memory with a snapshot(), returning (address, old bytes, new bytes) for each run of changes. """
+        changes = []
+        for block, old in sorted(snapshot.items()):
+            base = block<<self.__habit
+            new = self.readrange(base, len(old))
+            if new == old:
+                continue
+            runs = []
+            for chunk in range(0, len(old), PAGE_SIZE):
+                if old[chunk:chunk+PAGE_SIZE] == new[chunk:chunk+PAGE_SIZE]:
+                    continue
+                for i in range(chunk, min(chunk+PAGE_SIZE, len(old))):
+                    if old[i] == new[i]:
+                        continue
+                    if runs and runs[-1][1] == i:
+                        runs[-1][1] = i+1
+                    else:
+                        runs.append([i, i+1])
+            for first, last in runs:
+                changes.append((base+first, old[first:last], new[first:last]))
+        return changes
+    def halt(self):
+        """ Lets memory maps which need to, such as a FileMemoryMap, act on the CPU halting. """
+        for memory in self.__map.values():
+            if hasattr(memory, 'halt'):
+                memory.halt()
     def fetch(self):
         return self.__map[self.__bank].fetch()
     def fetch16(self):
@@ -295,19 +637,69 @@ class MemoryController(object):
             self.__map[ha].writeblock(addr&self.__bitmask, block)
         except:
             raise
+    def spans(self, addr, size, mapped=True):
+        """
+        Splits a range of addresses into (memory map, offset, count) for each map it covers.  An unmapped block raises
+        MemoryProtectionError, or is given as a span of None when *mapped* is False.
+        """
+        end = addr+size
+        while addr < end:
+            ha = (addr>>self.__habit)&self.__blksize
+            offset = addr&self.__bitmask
+            count = min(end-addr, self.__bitmask+1-offset)
+            if mapped and ha not in self.__map:
+                raise MemoryProtectionError('No memory is mapped at address: %s' % addr)
+            yield self.__map.get(ha), offset, count
+            addr += count
+    def memread(self, addr, size):
+        """ Reads a range of memory which may cross memory maps, each map is read in a single operation. """
+        return ''.join(memory.readblock(offset, count) for memory, offset, count in self.spans(addr, size))
+    def memwrite(self, addr, block):
+        if not isinstance(block, str):
+            block = memoryview(block).tobytes()
+        pos = 0
+        for memory, offset, count in self.spans(addr, len(block)):
+            memory.writeblock(offset, block[pos:pos+count])
+            pos += count
     def memcopy(self, src, dest, size):
-        ha_src = (src>>self.__habit)&self.__blksize
-        ha_dst = (dest>>self.__habit)&self.__blksize
-        try:
-            buf = self.__map[ha_src].readblock(src&self.__bitmask, size)
-        except:
-            raise
-        try:
-            self.__map[ha_dst].writeblock(dest&self.__bitmask, buf)
-        except:
-            raise
+        """ Copies size bytes from src to dest, the source is read in full first so the ranges may overlap. """
+        self.memwrite(dest, self.memread(src, size))
     def memmove(self, src, dest, size):
-        ha = (src>>self.__habit)&self.__blksize
-        self.memcopy(src, dest, size)
-        self.__map[ha].clearblock(dest&self.__bitmask, size)
-    
\ No newline at end of file
+        """
+        Moves size bytes from src to dest, clearing whatever part of the source the destination doesn't cover.  Every
+        map written to is checked first, so a move which would fault changes nothing.
+        """
+        buf = self.memread(src, size)
+        uncovered = [(src, min(size, dest-src)), (max(src, dest+size), src+size-max(src, dest+size))]
+        uncovered = [(addr, count) for addr, count in uncovered if count > 0]
+        for addr, count in [(dest, size)]+uncovered:
+            if not all(memory.writeable for memory, offset, length in self.spans(addr, count)):
+                raise MemoryProtectionError('Attempted to move into protected memory space: %s' % addr)
+        self.memwrite(dest, buf)
+        for addr, count in uncovered:
+            self.memclear(addr, count)
+    def memfill(self, addr, size, byte):
+        for memory, offset, count in self.spans(addr, size):
+            if byte == 0:
+                memory.clearblock(offset, count)
+            else:
+                memory.writeblock(offset, chr(byte)*count)
+    def memclear(self, addr, size):
+        self.memfill(addr, size, 0)
+    def memcompare(self, addr1, addr2, size):
+        """ Compares two ranges of memory like INT 8, returning 0 if they match, or else the difference of the first bytes which differ. """
+        a, b = self.memread(addr1, size), self.memread(addr2, size)
+        if a == b:
+            return 0
+        for chunk in range(0, size, PAGE_SIZE):
+            if a[chunk:chunk+PAGE_SIZE] != b[chunk:chunk+PAGE_SIZE]:
+                break
+        for i in range(chunk, size):
+            if a[i] != b[i]:
+                return ord(a[i])-ord(b[i])
+    def memfind(self, addr, size, pattern):
+        """ Returns the address of the first occurrence of a byte value or a byte string in a range, or -1. """
+        if isinstance(pattern, int):
+            pattern = chr(pattern)
+        i = self.memread(addr, size).find(pattern)
+        return -1 if i == -1 else addr+i
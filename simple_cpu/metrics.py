@@ -0,0 +1,185 @@
+import os, time, threading, collections
+from simple_cpu.exceptions import CPUException
+from simple_cpu.memory import PAGE_SIZE
+
+class VMMetrics(object):
+    """
+    This counts what a CPU does by wrapping its methods at instance level, the same way the Profiler wraps process():
+    instructions executed across runs, IN and OUT per port, the size of every image loaded, and the CPUExceptions its
+    runs raised.  With *memory* set it also counts reads and writes per PAGE_SIZE page of the address space, which
+    slows every access down, so it is off by default.  Create it after adding the devices whose ports it should count.
+    """
+    def __init__(self, cpu, name='vm', memory=False):
+        self.cpu = cpu
+        self.name = name
+        self.completed = 0 #: Instructions executed by earlier runs, cpu.cycles counts the current one.
+        self.ports = {} #: Accesses by (port, 'in' or 'out').
+        self.pages = {} #: Accesses by (page, 'read' or 'write').
+        self.images = {} #: Size in bytes of each image loaded, by filename.
+        self.exceptions = {} #: Exceptions raised out of a run, by class name.
+        self.last = (time.time(), 0)
+        self.wrap('run', self.run)
+        self.wrap('resume', self.resume)
+        self.wrap('loadbin', self.loadbin)
+        self.wrap('loadrom', self.loadbin)
+        for device in set(cpu.cpu_hooks.values()):
+            self.wrap_device(device)
+        if memory:
+            for method in ('read', 'readblock', 'memread'):
+                self.wrap_memory(method, 'read')
+            for method in ('write', 'writeblock', 'memwrite'):
+                self.wrap_memory(method, 'write')
+    def wrap(self, method, wrapper):
+        original = getattr(self.cpu, method)
+        setattr(self.cpu, method, lambda *args, **kwargs: wrapper(original, *args, **kwargs))
+    def wrap_device(self, device):
+        read, write = device.input, device.output
+        def input(port):
+            self.count(self.ports, (port, 'in'))
+            return read(port)
+        def output(port, value):
+            self.count(self.ports, (port, 'out'))
+            write(port, value)
+        device.input, device.output = input, output
+    def wrap_memory(self, method, access):
+        mem = self.cpu.mem
+        original = getattr(mem, method)
+        def counted(addr, *args):
+            self.count(self.pages, ((addr if args or access == 'read' else mem.ptr)//PAGE_SIZE, access))
+            return original(addr, *args)
+        setattr(mem, method, counted)
+    def count(self, counters, key):
+        counters[key] = counters.get(key, 0)+1
+    def run(self, original, *args, **kwargs):
+        self.completed += self.cpu.cycles
+        return original(*args, **kwargs)
+    def resume(self, original):
+        try:
+            return original()
+        except CPUException, e:
+            self.count(self.exceptions, e.__class__.__name__)
+            raise
+    def loadbin(self, original, filename, *args, **kwargs):
+        result = original(filename, *args, **kwargs)
+        self.images[filename] = os.path.getsize(filename)
+        return result
+    @property
+    def instructions(self):
+        return self.completed+self.cpu.cycles
+    def sample(self):
+        """
+        Returns every counter as a dictionary, with the instructions per second since the previous sample.  This is
+        the Python API to the metrics, the Registry renders the same samples.
+        """
+        now, instructions = time.time(), self.instructions
+        then, before = self.last
+        self.last = (now, instructions)
+        return {
+            'instructions': instructions,
+            'instructions_per_second': (instructions-before)/(now-then) if now > then else 0.0,
+            'ports': self.ports.copy(),
+            'pages': self.pages.copy(),
+            'images': self.images.copy(),
+            'exceptions': self.exceptions.copy(),
+        }
+
+#: Name, type, help and the sample key and labels of each metric the Registry exports.
+METRICS = (
+    ('simple_cpu_instructions_total', 'counter', 'Instructions executed.', 'instructions', ()),
+    ('simple_cpu_instructions_per_second', 'gauge', 'Instructions executed per second since the previous export.', 'instructions_per_second', ()),
+    ('simple_cpu_port_accesses_total', 'counter', 'Device IN and OUT instructions by port.', 'ports', ('port', 'direction',)),
+    ('simple_cpu_memory_accesses_total', 'counter', 'Memory reads and writes by page.', 'pages', ('page', 'access',)),
+    ('simple_cpu_image_bytes', 'gauge', 'Size of each loaded image.', 'images', ('image',)),
+    ('simple_cpu_exceptions_total', 'counter', 'CPUExceptions raised out of a run, by type.', 'exceptions', ('type',)),
+)
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def merge(samples):
+    """
+    Returns the (name, sample) pairs with the samples of VMs sharing a name added together, in the order each name was
+    first seen, as an export may hold only one series for each set of labels.  Image sizes are taken from the latest.
+    """
+    totals = collections.OrderedDict()
+    for name, sample in samples:
+        total = totals.get(name)
+        if total is None:
+            totals[name] = dict((key, value.copy() if isinstance(value, dict) else value) for key, value in sample.items())
+            continue
+        for key, value in sample.items():
+            if key == 'images':
+                total[key].update(value)
+            elif isinstance(value, dict):
+                for item, count in value.items():
+                    total[key][item] = total[key].get(item, 0)+count
+            else:
+                total[key] += value
+    return totals.items()
+
+class Registry(object):
+    """
+    This holds the VMMetrics of every VM in the process, and renders them in the Prometheus text format.  VMs with the
+    same name are exported as one, their counters added together.  A VM that is removed has its final counters kept in
+    the total for its name, so a run that finished between two writes is still reported and the counters of a name
+    never go down, while the registry only grows with the number of names.  start()
+    writes the text to a file every *interval* seconds from a background thread, replacing the file in one rename so a
+    collector such as the node exporter's textfile collector never reads half of it.
+    """
+    interval = 15.0
+    def __init__(self):
+        self.vms = []
+        self.finished = {} #: The counters of the VMs removed, added together by name.
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+    def add(self, cpu, name='vm', memory=False):
+        """ Starts counting for cpu, returning its VMMetrics. """
+        metrics = VMMetrics(cpu, name, memory)
+        with self.lock:
+            self.vms.append(metrics)
+        return metrics
+    def remove(self, metrics):
+        """ Stops counting for a VM, adding its counters, which no longer change, to the total for its name. """
+        sample = metrics.sample()
+        sample['instructions_per_second'] = 0.0
+        with self.lock:
+            self.vms.remove(metrics)
+            self.finished = dict(merge(self.finished.items()+[(metrics.name, sample)]))
+    def text(self):
+        with self.lock:
+            samples = merge(sorted(self.finished.items())+[(metrics.name, metrics.sample()) for metrics in self.vms])
+        lines = []
+        for name, typ, help, key, labels in METRICS:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, typ))
+            for vm, sample in samples:
+                values = sample[key] if labels else {(): sample[key]}
+                for item, value in sorted(values.items()):
+                    item = item if isinstance(item, tuple) else (item,)
+                    pairs = [('vm', vm)]+zip(labels, item)
+                    lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (label, label_value(v)) for label, v in pairs), value))
+        return '\n'.join(lines)+'\n'
+    def write(self, filename):
+        """ Writes every metric to filename, through a temporary file in the same directory. """
+        temp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temp, 'w') as f:
+            f.write(self.text())
+        os.rename(temp, filename)
+    def start(self, filename, interval=None):
+        """ Writes the metrics to filename every interval seconds until stop(). """
+        interval = self.interval if interval is None else interval
+        def writer():
+            while not self.stopped.wait(interval):
+                self.write(filename)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=writer)
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+registry = Registry() #: The registry of the process, which the runner exports.
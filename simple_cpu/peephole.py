@@ -0,0 +1,241 @@
+import shlex, re
+from simple_cpu.decoder import OPERANDS, FIXED
+
+JUMPS = ('jmp', 'call', 'je', 'jne', 'jl', 'jg', 'jle', 'jge', 'jb', 'ja', 'jbe', 'jae',)
+WRITES = ('mov', 'in', 'pop', 'inc', 'dec', 'add', 'sub', 'mul', 'div', 'and', 'or', 'xor', 'not',) #: Opcodes which write their first operand.
+TERMINATORS = ('jmp', 'ret',) #: HLT isn't one, with an InterruptController it returns once an interrupt is serviced.
+FOLDS = {
+    'add': lambda a, b: a+b,
+    'sub': lambda a, b: a-b,
+    'mul': lambda a, b: a*b,
+}
+MAX_VALUE = 0xFFFFF #: Largest immediate the assembler can encode.
+CONSTANT = re.compile(r'^(h[0-9a-fA-F]+|[0-9]+)$')
+
+class Unsupported(Exception):
+    """ Raised when a source uses something the optimizer can't follow, such as a computed jump. """
+    pass
+
+class PeepholeOptimizer(object):
+    """
+    This is an optional pass over a source file, which the assembler runs before assembling it with the -O option.
+    It removes redundant MOVs, folds constant arithmetic into MOVs and ADDs, removes unreachable code after JMP and
+    RET, and drops jumps to the next instruction.  Labels and data are barriers which no pattern crosses, and jumps to
+    literal addresses are turned into labels first, so they still land on the same instruction.  Finally every label
+    is resolved, repeating until the layout settles, so forward references get the shortest encoding as well.
+    Immediate values are assumed to be values rather than addresses, refer to code and data through labels instead.
+    After optimize(), *report* holds the instructions and bytes before and after, or why the source was left alone.
+    """
+    def __init__(self, coder):
+        self.coder = coder
+        self.report = {}
+    def optimize(self, lines):
+        """ Returns the optimized lines of source, or the original ones if the source can't be optimized. """
+        try:
+            statements = self.parse(lines)
+            before = self.measure(statements, None)
+            statements = self.implicit_labels(statements)
+        except Unsupported, e:
+            self.report = {'skipped': str(e)}
+            return list(lines)
+        changed = True
+        while changed:
+            statements, changed = self.peephole(statements)
+        values = self.relax(statements)
+        after = self.measure(statements, values)
+        self.report = {'instructions': (before[0], after[0]), 'bytes': (before[1], after[1])}
+        return self.emit(statements, values)
+    def parse(self, lines):
+        """ Splits source into ('op', op, args), ('label', name) and ('data', line, size) statements. """
+        statements = []
+        for line in lines:
+            line = line.strip()
+            if line == '.':
+                break
+            if line == '' or line.startswith('#'):
+                continue
+            cmd = self.coder.parseline(line)[0]
+            if cmd and hasattr(self.coder, 'do_'+cmd):
+                arg = line[len(cmd):].strip()
+                if cmd == 'label':
+                    statements.append(('label', arg))
+                elif cmd == 'data':
+                    s = shlex.split(arg)
+                    size = len(s[0].replace('\\n', '\n').replace('\\x00', '\x00'))+1 if s else 0
+                    statements.append(('data', line, size))
+                else:
+                    raise Unsupported('the %s command moves code around' % cmd)
+                continue
+            s = shlex.split(line)
+            if len(s) > 2 or s[0] not in self.coder.bc_map:
+                raise Unsupported('%s is not an instruction' % line)
+            args = s[1].split(',') if len(s) > 1 else []
+            if len(args) != OPERANDS[self.coder.bc_map[s[0]]]:
+                raise Unsupported('%s has the wrong number of operands' % line)
+            if s[0] in WRITES and args[0] in ('ip', 'cs',):
+                raise Unsupported('%s is a computed jump' % line)
+            if s[0] in JUMPS and (args[0] in self.coder.var_map or args[0].startswith('&')):
+                raise Unsupported('%s is a computed jump' % line)
+            statements.append(('op', s[0], args))
+        return statements
+    def implicit_labels(self, statements):
+        """ Replaces literal jump targets with labels at the instructions they jump to. """
+        addresses, csegs, labels, size = self.layout(statements, None)
+        targets = {}
+        statements = list(statements)
+        for i, st in enumerate(statements):
+            if st[0] == 'op' and st[1] in JUMPS and CONSTANT.match(st[2][0]):
+                target = self.coder.get_int(st[2][0])+csegs[i]
+                if target not in addresses+[size]:
+                    raise Unsupported('%s jumps into the middle of an instruction' % self.line(st))
+                targets[target] = '@%d' % target
+                statements[i] = ('op', st[1], ['*@%d' % target])
+        result = []
+        for i, st in enumerate(statements):
+            if addresses[i] in targets:
+                result.append(('label', targets.pop(addresses[i])))
+            result.append(st)
+        result.extend(('label', name) for name in targets.values())
+        return result
+    def constant(self, arg):
+        return self.coder.get_int(arg) if CONSTANT.match(arg) else None
+    def is_register(self, arg):
+        return arg in self.coder.var_map
+    def peephole(self, statements):
+        """ Applies every pattern once, returning the new statements and whether anything changed. """
+        out = []
+        changed = False
+        dead = False
+        for st in statements:
+            if dead and st[0] == 'op':
+                changed = True
+                continue
+            dead = st[0] == 'op' and st[1] in TERMINATORS
+            if st[0] == 'label' and out and out[-1][:2] == ('op', 'jmp') and out[-1][2][0] == '*'+st[1]:
+                out.pop()
+                changed = True
+            out.append(st)
+            while self.reduce(out):
+                changed = True
+        return out, changed
+    def reduce(self, out):
+        """ Rewrites the end of out if it matches a pattern, returning True if it did. """
+        if not out or out[-1][0] != 'op':
+            return False
+        op, args = out[-1][1:]
+        if op == 'mov' and args[0] == args[1]:
+            out.pop()
+            return True
+        if op in ('add', 'sub',) and self.constant(args[1]) == 0 or op == 'mul' and self.constant(args[1]) == 1:
+            if self.is_register(args[0]):
+                out.pop()
+                return True
+        if len(out) < 2 or out[-2][0] != 'op':
+            return False
+        prev, pargs = out[-2][1:]
+        if prev == 'mov' and op == 'mov' and pargs == args[::-1] and self.is_register(args[0]) and self.is_register(args[1]):
+            out.pop()
+            return True
+        if not pargs or not args or pargs[0] != args[0] or not self.is_register(args[0]):
+            return False
+        register = args[0]
+        if prev == 'mov' and op == 'mov' and args[1] != register and not pargs[1].startswith('&'):
+            del out[-2]
+            return True
+        if (prev, op) in (('inc', 'dec'), ('dec', 'inc')):
+            del out[-2:]
+            return True
+        value = self.constant(pargs[1]) if prev == 'mov' else None
+        if value is not None and op in ('inc', 'dec', 'add', 'sub', 'mul'):
+            if op in ('inc', 'dec'):
+                value += 1 if op == 'inc' else -1
+            elif self.constant(args[1]) is None:
+                return False
+            else:
+                value = FOLDS[op](value, self.constant(args[1]))
+            if 0 <= value <= MAX_VALUE:
+                out[-2:] = [('op', 'mov', [register, str(value)])]
+                return True
+        if prev in ('add', 'sub',) and op in ('add', 'sub',):
+            first, second = self.constant(pargs[1]), self.constant(args[1])
+            if first is None or second is None:
+                return False
+            value = (first if prev == 'add' else -first)+(second if op == 'add' else -second)
+            if abs(value) <= MAX_VALUE:
+                out[-2:] = [('op', 'add' if value >= 0 else 'sub', [register, str(abs(value))])] if value else []
+                return True
+        return False
+    def operand_size(self, arg, labels, defined):
+        """
+        Returns how many bytes Coder.write_value writes for arg, with labels missing from labels being forward.  Memory
+        operands always go by the labels defined so far, as a forward one is a word access and a near one isn't.
+        """
+        if arg in self.coder.var_map:
+            return 1
+        memory = arg.startswith('&')
+        if memory:
+            arg = arg[1:]
+        if arg.startswith('*'):
+            value = (defined if memory else labels).get(arg[1:])
+            if value is None:
+                return 3
+        elif memory:
+            value = int(arg[1:], 16)
+        else:
+            value = self.coder.get_int(arg)
+        if value < 16 and not memory:
+            return 1
+        elif value < 4096:
+            return 2
+        elif value < 1048576:
+            return 3
+        raise Unsupported('%s is too large to encode' % arg)
+    def layout(self, statements, values):
+        """
+        Returns the address of each statement, the cseg at each statement, the labels and the total size, sizing label
+        references from values, or as the Coder would if values is None.
+        """
+        addresses, csegs, labels = [], [], {}
+        ptr = cseg = 0
+        for st in statements:
+            addresses.append(ptr)
+            csegs.append(cseg)
+            if st[0] == 'label':
+                if st[1].startswith('!'):
+                    cseg = 0
+                labels[st[1]] = ptr-cseg
+                if st[1].startswith('!'):
+                    cseg = ptr
+            elif st[0] == 'data':
+                ptr += -(-st[2]//FIXED.size)*FIXED.size if self.coder.cpu.fixed else st[2]
+            elif self.coder.cpu.fixed:
+                ptr += FIXED.size
+            else:
+                ptr += 1+sum(self.operand_size(arg, labels if values is None else values, labels) for arg in st[2])
+        return addresses, csegs, labels, ptr
+    def relax(self, statements, attempts=16):
+        """ Returns the value of every label once the layout settles, or None if it never does. """
+        values = self.layout(statements, None)[2]
+        for attempt in range(attempts):
+            labels = self.layout(statements, values)[2]
+            if labels == values:
+                return values
+            values = labels
+        return None
+    def measure(self, statements, values):
+        return len([st for st in statements if st[0] == 'op']), self.layout(statements, values)[3]
+    def line(self, st, values=None):
+        if st[0] == 'label':
+            return 'label %s' % st[1]
+        elif st[0] == 'data':
+            return st[1]
+        args = st[2]
+        if values is not None:
+            args = [self.resolve(arg, values) for arg in args]
+        return ('%s %s' % (st[1], ','.join(args))).strip()
+    def resolve(self, arg, values):
+        if arg.startswith('*') and arg[1:] in values:
+            return str(values[arg[1:]])
+        return arg
+    def emit(self, statements, values):
+        return [self.line(st, values) for st in statements]
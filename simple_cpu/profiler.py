@@ -0,0 +1,53 @@
+import sys, time
+
+class Profiler(object):
+    """
+    This counts the opcodes a CPU executes by wrapping its process() method, and reports them together with the
+    instructions the CPU skipped, or the host time it slept, while fast-forwarding idle loops.  When the CPU has
+    symbols, the report also lists the labels whose code ran the most.
+    """
+    hotspots = 10 #: Labels listed in the report.
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.counts = {}
+        self.addresses = {} #: Instructions executed at each address.
+        self.started = time.time()
+        self.process = cpu.process
+        cpu.process = self.step
+    def step(self):
+        pc = self.cpu.cs.b+self.cpu.ip.b
+        op = self.cpu.mem.read(pc)
+        self.counts[op] = self.counts.get(op, 0)+1
+        self.addresses[pc] = self.addresses.get(pc, 0)+1
+        return self.process()
+    def detach(self):
+        del self.cpu.process
+    def labels(self):
+        """ Returns the instructions executed under each label, the most first, with None for code before any label. """
+        counts = {}
+        for pc, count in self.addresses.items():
+            found = self.cpu.symbols.lookup(pc)
+            label = found[0] if found else None
+            counts[label] = counts.get(label, 0)+count
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    @property
+    def executed(self):
+        return sum(self.counts.values())
+    @property
+    def skipped(self):
+        if self.cpu.fastforward is None:
+            return 0
+        return self.cpu.fastforward.skipped
+    def report(self, out=sys.stdout):
+        elapsed = time.time()-self.started
+        out.write('Executed %d instructions in %.3f seconds.\n' % (self.executed, elapsed))
+        for op, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+            out.write('  %s\t%d\n' % (hex(op), count))
+        if self.cpu.symbols:
+            out.write('Hot spots:\n')
+            for label, count in self.labels()[:self.hotspots]:
+                out.write('  %s\t%d\n' % (label, count))
+        detector = self.cpu.fastforward
+        if detector is not None:
+            out.write('Skipped %d instructions in fast-forwarded loops.\n' % detector.skipped)
+            out.write('Slept %d times for %.3f seconds in polling loops.\n' % (detector.sleeps, detector.idle_time))
@@ -0,0 +1,59 @@
+from simple_cpu.exceptions import QuotaExceeded
+from simple_cpu.devices import BaseCPUDevice
+
+IO_OPCODES = (0x3, 0x4,) #: IN and OUT, which cost io_cost on top of their weight.
+
+class QuotaDevice(BaseCPUDevice):
+    """
+    This charges every instruction a CPU runs against a budget, so that one guest among many can be stopped before it
+    starves the others, and billed for what it used.  An opcode costs its entry in *weights*, or 1, IN and OUT cost
+    *io_cost* more, and DMA transfers cost *dma_cost* for every *dma_chunk* bytes moved.  When the next instruction
+    would take the cost past the budget, QuotaExceeded is raised out of CPU.run before the instruction runs and without
+    charging it, so after grant() adds to the budget, CPU.resume() carries on exactly where the guest stopped.  The CPU
+    charges the quota before any device cycles, so no device sees an instruction twice across a resume, and an
+    instruction which an IRQ interrupts is charged again when it runs.  With a *budget* of None the device only counts.
+    A sequence run fused by a Fuser is charged as its first instruction.
+    """
+    ports = []
+    budget = None
+    weights = {}
+    io_cost = 10
+    dma_cost = 1
+    dma_chunk = 64
+    def __init__(self, cpu):
+        super(QuotaDevice, self).__init__(cpu)
+        cpu.quota = self
+        self.limit = self.budget
+        self.used = 0
+        self.instructions = 0
+        self.io = 0
+        self.dma_bytes = 0
+        self.exceeded = 0 #: Times the guest has run out of budget.
+        self.dma = []
+    def start(self):
+        self.dma = [device for device in self.cpu.devices if hasattr(device, 'moved')]
+    def grant(self, cost):
+        """ Adds cost to the budget, so a run stopped by QuotaExceeded can be resumed. """
+        self.limit = cost if self.limit is None else self.limit+cost
+    def charge(self):
+        """ Charges the instruction at cs:ip, raising QuotaExceeded if it would take the cost past the budget. """
+        cpu = self.cpu
+        op = cpu.mem.read(cpu.cs.b+cpu.ip.b)
+        cost = self.weights.get(op, 1)
+        io = op in IO_OPCODES
+        if io:
+            cost += self.io_cost
+        moved = sum(device.moved for device in self.dma) if self.dma else 0
+        if moved != self.dma_bytes:
+            cost += (moved//self.dma_chunk-self.dma_bytes//self.dma_chunk)*self.dma_cost
+        if self.limit is not None and self.used+cost > self.limit:
+            self.exceeded += 1
+            raise QuotaExceeded('Quota of %d exceeded after %d instructions.' % (self.limit, self.instructions))
+        self.used += cost
+        self.instructions += 1
+        self.io += io
+        self.dma_bytes = moved
+    def usage(self):
+        """ Returns the counters of this guest, for enforcing fair shares or billing. """
+        return {'cost': self.used, 'budget': self.limit, 'instructions': self.instructions, 'io': self.io,
+                'dma_bytes': self.dma_bytes, 'exceeded': self.exceeded}
@@ -0,0 +1,182 @@
+import sys, time, struct, collections
+from simple_cpu.exceptions import CPUException
+from simple_cpu.devices import BaseCPUDevice, InterruptController
+
+MAGIC = 'SCRL\x01'
+RECORD = struct.Struct('<BLHl') #: kind, instruction count, port (or data length), value (or address).
+IN, OUT, MEMORY, IRQ, STOP = range(1, 6)
+
+class ReplayDivergence(CPUException):
+    """ This exception is raised when a replayed guest does not perform the I/O that was recorded. """
+    pass
+
+class Recorder(object):
+    """
+    This logs every value which crosses the device boundary of a CPU into a compact binary file, each tagged with the
+    instruction count at which it happened: IN results, OUT values, memory written by devices (such as DMA), interrupts
+    serviced by the InterruptController and runs stopped by a device's cycle.  Create it once all devices are added.
+    """
+    def __init__(self, cpu, filename):
+        self.cpu = cpu
+        self.log = open(filename, 'wb')
+        self.log.write(MAGIC)
+        self.depth = 0
+        self.after = 0
+        for device in cpu.devices:
+            device.input = self.wrap_input(device.input)
+            device.output = self.wrap_output(device.output)
+            device.cycle = self.wrap_cycle(device.cycle)
+            if isinstance(device, InterruptController):
+                device.service = self.wrap_service(device.service)
+        self.write = cpu.mem.write
+        self.writeblock = cpu.mem.writeblock
+        cpu.mem.write = self.mem_write
+        cpu.mem.writeblock = self.mem_writeblock
+    def record(self, kind, port, value, data=''):
+        """ Events from inside an instruction (IN, OUT or a waiting HLT) are logged against the next instruction. """
+        count = self.cpu.cycles
+        if kind not in (IN, OUT,) and (self.after or self.cpu.halted):
+            count += 1
+        self.log.write(RECORD.pack(kind, count, port, value))
+        if data:
+            self.log.write(data)
+    def close(self):
+        del self.cpu.mem.write
+        del self.cpu.mem.writeblock
+        self.log.close()
+    def device_call(self, func, after, *args):
+        self.depth += 1
+        self.after = after
+        try:
+            return func(*args)
+        finally:
+            self.depth -= 1
+            self.after = 0
+    def wrap_input(self, func):
+        def input(i):
+            value = self.device_call(func, 1, i)
+            self.record(IN, i, value)
+            return value
+        return input
+    def wrap_output(self, func):
+        def output(i, v):
+            self.record(OUT, i, v)
+            self.device_call(func, 1, i, v)
+        return output
+    def wrap_cycle(self, func):
+        def cycle():
+            running = self.cpu.running
+            self.device_call(func, 0)
+            if running and not self.cpu.running:
+                self.record(STOP, 0, 0)
+        return cycle
+    def wrap_service(self, func):
+        def service():
+            depth, self.depth = self.depth, 0
+            try:
+                vector = func()
+            finally:
+                self.depth = depth
+            self.record(IRQ, 0, vector)
+            return vector
+        return service
+    def mem_write(self, addr, byte=None):
+        if self.depth and byte is not None:
+            self.record(MEMORY, 1, addr, chr(int(byte)&0xFF))
+        self.write(addr, byte)
+    def mem_writeblock(self, addr, block):
+        if self.depth:
+            if not isinstance(block, str):
+                block = memoryview(block).tobytes()
+            self.record(MEMORY, len(block), addr, block)
+        self.writeblock(addr, block)
+
+def read_log(filename):
+    """ Yields (kind, count, port, value, data) for each record in a log written by a Recorder. """
+    log = open(filename, 'rb')
+    if log.read(len(MAGIC)) != MAGIC:
+        raise CPUException('%s is not a device I/O log.' % filename)
+    while True:
+        record = log.read(RECORD.size)
+        if len(record) < RECORD.size:
+            break
+        kind, count, port, value = RECORD.unpack(record)
+        data = log.read(port) if kind == MEMORY else ''
+        yield kind, count, port, value, data
+
+class ReplayDevice(BaseCPUDevice):
+    """
+    This stands in for every device of a recorded session, including the interrupt controller.  IN reads return the
+    recorded values, OUT writes are checked against the log, and device memory writes, interrupts and stops are applied
+    when the CPU reaches their instruction count.  Nothing waits on real time, so the guest runs at full speed.
+    Use replay() to attach one to a CPU.
+    """
+    filename = None
+    def __init__(self, cpu):
+        super(ReplayDevice, self).__init__(cpu)
+        self.io = collections.deque()
+        self.timed = collections.deque()
+        for kind, count, port, value, data in read_log(self.filename):
+            if kind in (IN, OUT,):
+                self.io.append((kind, count, port, value))
+            else:
+                self.timed.append((kind, count, value, data))
+        self.ports = sorted(set(event[2] for event in self.io))
+        self.serviced = 0
+        cpu.pic = self
+    @property
+    def wait_on_halt(self):
+        """ A recorded HLT only waited if an interrupt came after it. """
+        return any(event[0] == IRQ for event in self.timed)
+    def next_io(self, kind, i):
+        if not self.io:
+            raise ReplayDivergence('Guest performed I/O on port %d after the end of the log.' % i)
+        event = self.io.popleft()
+        if event[:3] != (kind, self.cpu.cycles, i):
+            raise ReplayDivergence('Expected %s but the guest did %s.' % (event[:3], (kind, self.cpu.cycles, i)))
+        return event[3]
+    def input(self, i):
+        return self.next_io(IN, i)
+    def output(self, i, v):
+        if self.next_io(OUT, i) != v:
+            raise ReplayDivergence('Guest wrote %s to port %d, which differs from the log.' % (v, i))
+    def next_event(self):
+        return 0
+    def cycle(self):
+        limit = self.cpu.cycles+1 if self.cpu.halted else self.cpu.cycles
+        while self.timed and self.timed[0][1] <= limit:
+            kind, count, value, data = self.timed.popleft()
+            if kind == MEMORY:
+                self.cpu.mem.writeblock(value, data)
+            elif kind == IRQ:
+                self.serviced += 1
+                self.cpu.interrupt(value)
+            elif kind == STOP:
+                self.cpu.running = False
+
+def replay(cpu, filename):
+    """ Attaches a ReplayDevice for the log in filename to a CPU, which should have no other devices. """
+    cpu.add_device(type('ReplayDevice', (ReplayDevice,), {'filename': filename}))
+    return cpu.devices[-1]
+
+def main():
+    """ Re-runs a recorded session headlessly and reports how fast it ran. """
+    from optparse import OptionParser
+    from simple_cpu.cpu import CPU
+    parser = OptionParser('%prog LOG BINARY')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('Please specify the log and binary to replay.')
+    c = CPU()
+    replay(c, args[0])
+    c.loadbin(args[1], 0x0)
+    started = time.time()
+    try:
+        c.run()
+    except CPUException, e:
+        sys.stderr.write('%s\n' % e)
+    elapsed = time.time()-started
+    sys.stdout.write('%d instructions in %.3f seconds (%.0f per second)\n' % (c.cycles, elapsed, c.cycles/elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+    main()
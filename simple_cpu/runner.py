@@ -0,0 +1,111 @@
+import time
+STARTED = time.time()
+import sys, os, json
+from simple_cpu.exceptions import ExecutionLimit
+from simple_cpu.cpu import CPU
+from simple_cpu.devices import WatchdogDevice
+
+device_classes = {}
+
+def load_device(name):
+    """ Returns the device class called name, importing its module the first time it is needed. """
+    if name not in device_classes:
+        module, dot, klass = name.rpartition('.')
+        module = module or 'simple_cpu.devices'
+        device_classes[name] = getattr(__import__(module, fromlist=[klass]), klass)
+    return device_classes[name]
+
+def execute(run, base='.', registry=None):
+    """ Runs one manifest entry on a new CPU, returning its result as a dictionary, counted in registry while it runs. """
+    path = lambda filename: os.path.join(base, filename)
+    result = {'name': run.get('name', run.get('binary')), 'binary': run.get('binary')}
+    started = time.time()
+    cpu = quota = metrics = None
+    try:
+        cpu = CPU(sparse=run.get('sparse', False))
+        for name in run.get('devices', []):
+            cpu.add_device(load_device(name))
+        if 'instructions' in run or 'seconds' in run:
+            cpu.add_device(type('RunWatchdog', (WatchdogDevice,), {'instructions': run.get('instructions'), 'seconds': run.get('seconds')}))
+        if 'quota' in run or 'weights' in run:
+            weights = dict((int(op, 0), cost) for op, cost in run.get('weights', {}).items())
+            cpu.add_device(type('RunQuota', (load_device('simple_cpu.quota.QuotaDevice'),), {'budget': run.get('quota'), 'weights': weights}))
+            quota = cpu.devices[-1]
+        if registry is not None:
+            metrics = registry.add(cpu, result['name'])
+        for filename, addr in run.get('load', []):
+            cpu.loadbin(path(filename), addr)
+        cpu.loadbin(path(run['binary']), run.get('cs', 0), run.get('compressed', False))
+        cpu.ds.value = run.get('ds', 0)
+        cpu.ss.value = run.get('ss', 0)
+        cpu.start_devices()
+        cpu.run(run.get('cs', 0), ['ds', 'ss'])
+        result['state'] = 'halted'
+    except ExecutionLimit, e:
+        result.update({'state': 'limit', 'error': str(e)})
+    except Exception, e:
+        result.update({'state': 'error', 'error': '%s: %s' % (e.__class__.__name__, e)})
+    else:
+        result['registers'] = dict((reg, getattr(cpu, reg).b) for reg in cpu.var_map)
+    finally:
+        if metrics is not None:
+            registry.remove(metrics)
+    result['instructions'] = cpu.cycles if cpu is not None else 0
+    if quota is not None:
+        result['usage'] = quota.usage()
+    result['wall_time'] = time.time()-started
+    return result
+
+def run_manifest(manifest, base='.', registry=None):
+    """
+    Yields the result of every run in a manifest, which looks like this:
+
+        {"defaults": {"devices": ["HelloWorldHook"], "instructions": 100000, "sparse": true},
+         "runs": [{"name": "hello", "binary": "hello.bin", "ds": 3000, "ss": 2900,
+                   "load": [["interrupt.bin", 1000], ["interrupt.tbl", 65023]]}]}
+
+    Devices are named by class for those in simple_cpu.devices, or as module.Class, and are imported when a run first
+    asks for them.  Each run may also set cs, compressed, and a seconds budget, and the defaults apply to every run
+    which doesn't set a key itself.  Relative paths are relative to base.  A quota budget, and weights mapping opcodes
+    such as "0x4" to their cost, charge the run through a QuotaDevice and add its usage counters to the result.
+    """
+    defaults = manifest.get('defaults', {})
+    for entry in manifest.get('runs', []):
+        run = dict(defaults)
+        run.update(entry)
+        yield execute(run, base, registry)
+
+def main():
+    """ Runs a manifest headlessly, importing only the interpreter core, and reports the startup time on stderr. """
+    from optparse import OptionParser
+    parser = OptionParser('%prog [options] MANIFEST')
+    parser.add_option('-o', '--output', dest='output', help='Write each result to OUTPUT/NAME.json instead of stdout')
+    parser.add_option('-m', '--metrics', dest='metrics', help='Write metrics of the running VMs to METRICS in the Prometheus text format')
+    parser.add_option('--metrics-interval', type='float', dest='interval', default=15.0, help='Seconds between metrics writes')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Please specify a manifest.')
+    manifest = json.load(open(args[0]))
+    if options.output and not os.path.isdir(options.output):
+        os.makedirs(options.output)
+    registry = None
+    if options.metrics:
+        from simple_cpu.metrics import registry
+        registry.start(options.metrics, options.interval)
+    summary = {'startup': time.time()-STARTED, 'runs': 0, 'halted': 0}
+    for result in run_manifest(manifest, os.path.dirname(os.path.abspath(args[0])), registry):
+        summary['runs'] += 1
+        summary['halted'] += result['state'] == 'halted'
+        if options.output:
+            json.dump(result, open(os.path.join(options.output, '%s.json' % result['name']), 'w'), sort_keys=True)
+        else:
+            sys.stdout.write(json.dumps(result, sort_keys=True)+'\n')
+    if registry is not None:
+        registry.stop()
+        registry.write(options.metrics)
+    summary['total'] = time.time()-STARTED
+    sys.stderr.write(json.dumps(summary, sort_keys=True)+'\n')
+    sys.exit(0 if summary['halted'] == summary['runs'] else 1)
+
+if __name__ == '__main__':
+    main()
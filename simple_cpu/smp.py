@@ -0,0 +1,123 @@
+import multiprocessing, Queue, time
+from simple_cpu.exceptions import CPUException, ExecutionLimit
+from simple_cpu.cpu import CPU
+from simple_cpu.devices import BaseCPUDevice, InterruptController
+from simple_cpu.memory import MemoryController, MemoryMap
+
+class IPIDevice(BaseCPUDevice):
+    """
+    This sends inter-processor interrupts between the cores of an SMPMachine.  Writing a core number to port 50 raises
+    IRQ *irq* on that core, port 51 reads the number of the core the guest runs on and port 52 the number of cores.
+    Each core has a pending flag in the shared *mailbox*, so IPIs sent before a core takes one are merged into it.
+    """
+    ports = [50, 51, 52]
+    irq = 2
+    poll = 0.001 #: Seconds a halted core sleeps between looks at its mailbox.
+    core = 0
+    mailbox = None
+    def out_50(self, core):
+        if not 0 <= core < len(self.mailbox):
+            raise CPUException('There is no core %s to interrupt.' % core)
+        self.mailbox[core] = 1
+    def in_51(self):
+        return self.core
+    def in_52(self):
+        return len(self.mailbox)
+    def next_event(self):
+        return self.poll
+    def cycle(self):
+        if self.mailbox[self.core]:
+            self.mailbox[self.core] = 0
+            self.cpu.pic.raise_irq(self.irq)
+
+class SMPMachine(object):
+    """
+    This is a machine with several cores sharing one physical memory, each core a CPU running in a host process of its
+    own, so guest code which divides its work between cores also divides it between host CPUs.  The shared memory is
+    an anonymous mmap made before the cores are forked, RAM at block 0x0 and the interrupt table's block 0xe, unless
+    other maps such as a FileMemoryMap are given.  Every core starts at the same cs, and reads its number from the
+    IPIDevice to pick its own stack and work.  CAS is atomic between the cores, as they all hold the same bus lock.
+    Each core has an InterruptController, the IPIDevice and every class in *devices*.
+    """
+    devices = []
+    poll = 0.05 #: Seconds run() waits for a result before looking for cores which exited without one.
+    def __init__(self, cores, maps=None):
+        self.cores = cores
+        self.maps = {0x0: MemoryMap(0x2000), 0xe: MemoryMap(0x2000)} if maps is None else maps
+        self.mem = MemoryController()
+        for block, memory in self.maps.items():
+            self.mem.add_map(block, memory)
+        self.bus_lock = multiprocessing.Lock()
+        self.mailbox = multiprocessing.RawArray('B', cores)
+        self.fixed = False
+        self.encodings = [] #: The encoding of each image loaded with a header, which every core is given.
+    def core(self, number):
+        """ Returns a new CPU for core *number*, with the shared memory mapped in. """
+        cpu = CPU()
+        for block, memory in self.maps.items():
+            cpu.mem.add_map(block, memory)
+        cpu.bus_lock = self.bus_lock
+        cpu.fixed = self.fixed
+        cpu.encodings = list(self.encodings)
+        cpu.add_device(InterruptController)
+        cpu.add_device(type('CoreIPI', (IPIDevice,), {'core': number, 'mailbox': self.mailbox}))
+        for klass in self.devices:
+            cpu.add_device(klass)
+        return cpu
+    def loadbin(self, filename, dest, compressed=False):
+        """ Loads an image into the shared memory, every core runs the code of an image with a header in its encoding. """
+        cpu = self.core(0)
+        cpu.loadbin(filename, dest, compressed)
+        self.encodings = cpu.encodings
+    def start(self, number, cs, results):
+        """
+        Runs core *number* until it halts, this is the body of each core's process.  Any error is put on results, as
+        nothing else would tell run() why the core stopped.
+        """
+        cpu = self.core(number)
+        result = {'core': number}
+        try:
+            cpu.start_devices()
+            cpu.run(cs)
+            result['state'] = 'halted'
+            result['registers'] = dict((reg, getattr(cpu, reg).b) for reg in cpu.var_map)
+        except ExecutionLimit, e:
+            result.update({'state': 'limit', 'error': str(e)})
+        except Exception, e:
+            result.update({'state': 'error', 'error': '%s: %s' % (e.__class__.__name__, e)})
+        result['instructions'] = cpu.cycles
+        results.put(result)
+    def run(self, cs=0, timeout=None):
+        """
+        Runs every core from cs until all of them have halted, returning the result of each core as a dictionary in the
+        same form the runner reports.  Cores still running after *timeout* seconds are terminated, and a core whose
+        process exits without a result, such as one killed by a signal, is reported as an error.
+        """
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=self.start, args=(number, cs, results)) for number in range(self.cores)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        deadline = None if timeout is None else time.time()+timeout
+        collected, exited = {}, {}
+        try:
+            while len(collected)+len(exited) < self.cores:
+                # A process flushes its result before it exits, so a core already dead when the queue is found empty
+                # never reported one.
+                dead = [number for number, process in enumerate(processes) if number not in collected and not process.is_alive()]
+                try:
+                    result = results.get(timeout=self.poll if deadline is None else max(0, min(self.poll, deadline-time.time())))
+                except Queue.Empty:
+                    exited.update((number, processes[number].exitcode) for number in dead)
+                    if deadline is not None and time.time() >= deadline:
+                        break
+                    continue
+                collected[result['core']] = result
+        finally:
+            for number, process in enumerate(processes):
+                if number not in collected:
+                    process.terminate()
+                process.join()
+        for number, code in exited.items():
+            collected[number] = {'core': number, 'state': 'error', 'error': 'Core exited with code %s without a result.' % code}
+        return [collected.get(number, {'core': number, 'state': 'timeout'}) for number in range(self.cores)]
@@ -0,0 +1,62 @@
+import os, bisect
+
+def symbol_file(filename):
+    """ Returns the name of the symbol file kept next to the binary image filename. """
+    return os.path.splitext(filename)[0]+'.sym'
+
+class SymbolTable(object):
+    """
+    This maps labels to absolute addresses and back.  The addresses are kept sorted, so lookup() finds the label at or
+    before an address with a binary search, however many labels an image has.  A symbol file has a line per label, its
+    address in hex relative to the start of the image, then its name, and is written next to the binary by savebin.
+    """
+    def __init__(self):
+        self.names = {}
+        self.addresses = []
+        self.labels = []
+    def __len__(self):
+        return len(self.names)
+    def add(self, name, addr):
+        if name in self.names:
+            self.remove(name)
+        i = bisect.bisect_right(self.addresses, addr)
+        self.addresses.insert(i, addr)
+        self.labels.insert(i, name)
+        self.names[name] = addr
+    def remove(self, name):
+        i = bisect.bisect_left(self.addresses, self.names.pop(name))
+        i += self.labels[i:].index(name)
+        del self.addresses[i]
+        del self.labels[i]
+    def address(self, name):
+        """ Returns the address of label name, or None if there is no such label. """
+        return self.names.get(name)
+    def lookup(self, addr):
+        """ Returns the label at or before addr and the offset of addr from it, or None if no label comes before. """
+        i = bisect.bisect_right(self.addresses, addr)-1
+        if i < 0:
+            return None
+        return self.labels[i], addr-self.addresses[i]
+    def describe(self, addr):
+        """ Returns addr as label+offset, or in hex if no label comes before it. """
+        found = self.lookup(addr)
+        if found is None:
+            return hex(addr)
+        name, offset = found
+        return '%s+%s' % (name, hex(offset)) if offset else name
+    def load(self, filename, base=0):
+        """ Adds the labels of a symbol file, for an image loaded at base. """
+        for line in open(filename, 'r'):
+            s = line.split()
+            if len(s) == 2:
+                self.add(s[1], int(s[0], 16)+base)
+    def within(self, start=0, size=None):
+        """ Returns the address and name of every label from start up to and including start+size. """
+        first = bisect.bisect_left(self.addresses, start)
+        last = len(self.addresses) if size is None else bisect.bisect_right(self.addresses, start+size)
+        return zip(self.addresses[first:last], self.labels[first:last])
+    def save(self, filename, start=0, size=None):
+        """ Writes the labels from start up to and including start+size to a symbol file, relative to start. """
+        with open(filename, 'w') as f:
+            for addr, name in self.within(start, size):
+                f.write('%04x %s\n' % (addr-start, name))
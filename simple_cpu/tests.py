@@ -1,7 +1,37 @@
-import unittest, sys
+import unittest, sys, threading, tempfile, shutil, os, time, StringIO, json, subprocess
 sys.path.append('.')
-from simple_cpu.exceptions import MemoryProtectionError
-from simple_cpu.memory import UInt8, MemoryMap, MemoryController
+from simple_cpu.exceptions import CPUException, ExecutionLimit, MemoryProtectionError, QuotaExceeded
+from simple_cpu.memory import UInt8, MemoryMap, SparseMemoryMap, ROMMap, FileMemoryMap, MemoryController
+from simple_cpu.cpu import CPU
+from simple_cpu.devices import BaseCPUDevice, HelloWorldHook, DMAController, InterruptController, TimerDevice, WatchdogDevice
+from simple_cpu.asm import Coder
+from simple_cpu.peephole import PeepholeOptimizer
+from simple_cpu.decoder import decode
+from simple_cpu.fastforward import IdleLoopDetector
+from simple_cpu.profiler import Profiler
+from simple_cpu.fusion import Fuser
+from simple_cpu import batch
+from simple_cpu.fuzz import Fuzzer, pack_input
+from simple_cpu.replay import Recorder, ReplayDivergence, replay
+from simple_cpu.blockdev import BlockDevice
+from simple_cpu import runner
+from simple_cpu.smp import SMPMachine
+from simple_cpu.quota import QuotaDevice
+from simple_cpu.metrics import Registry
+from simple_cpu.symbols import SymbolTable, symbol_file
+from simple_cpu.difftest import DifferentialTest, CPUEngine, BatchEngine
+
+def assemble(cpu, source, ptr=0):
+    """ Assembles the lines of source at ptr, returning the address of each line. """
+    coder = Coder()
+    coder.configure(cpu)
+    cpu.mem.ptr = ptr
+    addresses = []
+    for line in source.strip().splitlines():
+        addresses.append(cpu.mem.ptr)
+        coder.onecmd(line.strip())
+        coder.postcmd(None, line)
+    return addresses
 
 class TestMemoryClass(unittest.TestCase):
     def setUp(self):
@@ -51,6 +81,1048 @@ class TestMemoryClass(unittest.TestCase):
         self.assertEqual(self.mc.ptr, 0x3)
         self.assertEqual(self.mc[0x100], 65)
         self.assertEqual(self.mc.ptr, 0x3)
+    def test_sparse_memorymap(self):
+        mem = SparseMemoryMap(0x2000)
+        self.assertEqual(mem.read(0x1fff), 0)
+        mem.write(0x300, 0)
+        mem.writeblock(0x400, '\x00'*0x200)
+        self.assertEqual(mem.resident_pages, 0)
+        mem.writeblock(0xfe, 'abcd')
+        mem[0x1fff] = 65
+        self.assertEqual(mem.resident_pages, 3)
+        self.assertEqual(mem.readblock(0xfc, 8), '\x00\x00abcd\x00\x00')
+        mem.ptr = 0xff
+        self.assertEqual(mem.fetch16(), ord('b')|ord('c')<<8)
+        mem.clearblock(0, 0x200)
+        self.assertEqual(mem.resident_pages, 1)
+        self.assertRaises(IndexError, mem.read, 0x2000)
+    def test_sparse_cpu(self):
+        cpu = CPU(sparse=True)
+        assemble(cpu, "mov ax,300\nmov &h64,ax\nhlt")
+        cpu.mem.write16(len(cpu.mem)-512, 0x1234)
+        cpu.run()
+        self.assertEqual(cpu.mem.read16(0x64), 300)
+        self.assertEqual(cpu.mem.read16(0x9000), 0)
+        self.assertEqual(cpu.mem.resident_pages, 3)
+        self.assertEqual(CPU().mem.resident_pages, 0x20)
+
+class TestMemoryInspection(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.cpu.mem.add_map(0x2, SparseMemoryMap(0x2000))
+        self.cpu.mem.writeblock(0x1ffe, 'AB')
+        self.cpu.mem.writeblock(0x2000, 'CD')
+        self.cpu.mem.write(0x3000, 0x41)
+    def test_readrange(self):
+        self.assertEqual(self.cpu.mem.readrange(0x1ffc, 8), '\x00\x00ABCD\x00\x00')
+        self.assertEqual(self.cpu.mem.readrange(0x3fff, 3, '?'), '\x00??')
+        self.assertEqual(self.cpu.mem.readrange(0xa000, 4, '?'), '????')
+        self.assertEqual(len(self.cpu.mem.readrange(0, 0x10000)), 0x10000)
+        self.assertEqual(self.cpu.mem.search('ABC'), [0x1ffe])
+        self.assertEqual(self.cpu.mem.search('A'), [0x1ffe, 0x3000])
+        self.assertEqual(self.cpu.mem.search('A', 0x2000), [0x3000])
+    def test_diff(self):
+        snapshot = self.cpu.mem.snapshot()
+        self.cpu.mem.writeblock(0x10, 'xy')
+        self.cpu.mem.write(0x13, 0x7a)
+        self.cpu.mem.write(0x2001, 0)
+        self.assertEqual(self.cpu.mem.diff(snapshot), [(0x10, '\x00\x00', 'xy'), (0x13, '\x00', 'z'), (0x2001, 'D', '\x00')])
+    def test_bulk_primitives(self):
+        mem = self.cpu.mem
+        mem.memfill(0x1ff0, 0x20, 0x2e)
+        self.assertEqual(mem.memread(0x1fee, 4), '\x00\x00..')
+        self.assertEqual(mem.memfind(0, 0x4000, 0x2e), 0x1ff0)
+        self.assertEqual(mem.memfind(0x1ff0, 0x10, 'A'), -1)
+        mem.memclear(0x1ff0, 0x20)
+        self.assertEqual(mem.memfind(0, 0x4000, 'A'), 0x3000)
+        mem.memwrite(0x100, 'HELLO')
+        mem.memwrite(0x200, 'HELP!')
+        self.assertEqual(mem.memcompare(0x100, 0x200, 5), ord('L')-ord('P'))
+        self.assertEqual(mem.memcompare(0x100, 0x200, 3), 0)
+        mem.memmove(0x100, 0x102, 5)
+        self.assertEqual(mem.memread(0x100, 7), '\x00\x00HELLO')
+        mem.memcopy(0x102, 0x1ffe, 5)
+        self.assertEqual(mem.memread(0x1ffe, 5), 'HELLO')
+        self.assertRaises(MemoryProtectionError, mem.memmove, 0x100, 0x5ffe, 4)
+        self.assertEqual(mem.memread(0x102, 2), 'HE')
+        protected = MemoryMap(0x2000)
+        protected.write_protect()
+        mem.add_map(0x4, protected)
+        self.assertRaises(MemoryProtectionError, mem.memmove, 0x102, 0x3ffe, 4)
+        self.assertEqual((mem.memread(0x102, 4), mem.memread(0x3ffe, 2)), ('HELL', '\x00\x00'))
+        for klass in (MemoryMap, SparseMemoryMap):
+            rom = klass(0x2000)
+            rom.writeblock(0, 'ABCD')
+            rom.write_protect()
+            mem.add_map(0x4, rom)
+            self.assertRaises(MemoryProtectionError, mem.memclear, 0x4000, 4)
+            self.assertEqual(mem.memread(0x4000, 4), 'ABCD')
+        coder = Coder(stdout=StringIO.StringIO())
+        coder.configure(self.cpu)
+        coder.onecmd('memclear 258 5')
+        self.assertEqual(mem.memread(0x100, 8), '\x00'*8)
+    def test_debugger_commands(self):
+        out = StringIO.StringIO()
+        coder = Coder(stdout=out)
+        coder.configure(self.cpu)
+        coder.onecmd('search "BC"')
+        coder.onecmd('search 41')
+        coder.onecmd('diff')
+        coder.onecmd('snapshot')
+        coder.onecmd('poke 2000,0')
+        coder.onecmd('diff')
+        coder.onecmd('hexdump 1ff8')
+        self.assertEqual(out.getvalue().splitlines(), [
+            '0x1fff',
+            '0x1ffe  0x3000',
+            'Please take a snapshot first.',
+            'Snapshot taken of 2 memory blocks.',
+            '0x2000: 0x43 -> 0x0',
+            '0x1ff8: ' + '0x0  '*6 + '0x41  0x42  0x0  0x44  ' + '0x0  '*6,
+        ])
+
+class TestROMMap(unittest.TestCase):
+    def setUp(self):
+        fd, self.image = tempfile.mkstemp()
+        os.write(fd, ''.join(chr(i&0xff) for i in range(0x300)))
+        os.close(fd)
+    def tearDown(self):
+        os.unlink(self.image)
+    def test_copy_on_write(self):
+        cpus = [CPU(), CPU()]
+        for cpu in cpus:
+            cpu.loadrom(self.image, 0x180)
+        first, second = [cpu.mem.find_map(0)[1] for cpu in cpus]
+        self.assertTrue(isinstance(first, ROMMap))
+        self.assertTrue(first.pages[2].image is second.pages[2].image)
+        self.assertEqual(first.resident_pages, 2)
+        self.assertEqual(cpus[0].mem.read(0x181), 1)
+        self.assertEqual(cpus[0].mem.readblock(0x2fe, 4), '\x7e\x7f\x80\x81')
+        cpus[0].mem.writeblock(0x200, ''.join(chr(i) for i in range(0x80, 0x90)))
+        self.assertEqual(first.resident_pages, 2)
+        cpus[0].mem.write(0x300, 0xff)
+        self.assertEqual(first.resident_pages, 3)
+        self.assertEqual(cpus[0].mem.read(0x300), 0xff)
+        self.assertEqual(cpus[1].mem.read(0x300), 0x80)
+        second.write_protect()
+        self.assertRaises(MemoryProtectionError, cpus[1].mem.write, 0x300, 0)
+    def test_run_from_rom(self):
+        cpu = CPU()
+        assemble(cpu, "inc ax\ninc ax\nhlt")
+        open(self.image, 'wb').write(cpu.mem.readblock(0, 5))
+        copy = CPU()
+        copy.loadrom(self.image, 0)
+        copy.run()
+        self.assertEqual(copy.ax.b, 2)
+
+class TestFileMemoryMap(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'ram.img')
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def test_persistence(self):
+        cpu = CPU()
+        ram = FileMemoryMap(self.filename)
+        cpu.mem.add_map(0x2, ram)
+        assemble(cpu, "mov ds,8192\nmov ax,300\nmov &h64,ax\nhlt")
+        cpu.run()
+        self.assertEqual(ram.flushes, 1)
+        self.assertEqual(open(self.filename, 'rb').read()[0x64:0x66], '\x2c\x01')
+        ram.close()
+        copy = CPU()
+        copy.mem.add_map(0x2, FileMemoryMap(self.filename, flush_policy='explicit'))
+        self.assertEqual(copy.mem.read16(0x2064), 300)
+        self.assertEqual(os.path.getsize(self.filename), 0x2000)
+    def test_flush_on_error(self):
+        cpu = CPU()
+        ram = FileMemoryMap(self.filename)
+        cpu.mem.add_map(0x2, ram)
+        cpu.add_device(type('Quota', (QuotaDevice,), {'budget': 3}))
+        assemble(cpu, "mov ds,8192\nmov ax,300\nmov &h64,ax\nmov bx,&h6000\nhlt")
+        self.assertRaises(QuotaExceeded, cpu.run)
+        self.assertEqual(ram.flushes, 0)
+        cpu.quota.grant(10)
+        self.assertRaises(KeyError, cpu.resume)
+        self.assertEqual(ram.flushes, 1)
+        ram.close()
+        self.assertEqual(open(self.filename, 'rb').read()[0x64:0x66], '\x2c\x01')
+    def test_flush_policies(self):
+        self.assertRaises(ValueError, FileMemoryMap, self.filename, flush_policy='never')
+        ram = type('FastFlush', (FileMemoryMap,), {'flush_interval': 0.001})(self.filename, flush_policy='periodic')
+        ram.write(0, 65)
+        ram.halt()
+        deadline = time.time()+5
+        while not ram.flushes and time.time() < deadline:
+            time.sleep(0.001)
+        ram.close()
+        self.assertTrue(ram.flushes > 0)
+        self.assertEqual(open(self.filename, 'rb').read(1), 'A')
+
+class TestIOMap(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.cpu.add_device(HelloWorldHook)
+    def test_buffer_region(self):
+        self.assertEqual(self.cpu.mem[0xa000], ord('H'))
+        self.assertEqual(self.cpu.mem.read16(0xa00a), ord('d')|ord('!')<<8)
+        self.assertEqual(self.cpu.mem[0xa00c], 0)
+        self.assertRaises(MemoryProtectionError, self.cpu.mem.read, 0xa00d)
+        self.assertRaises(MemoryProtectionError, self.cpu.mem.write, 0xa000, 65)
+    def test_unmapped_page(self):
+        self.assertRaises(MemoryProtectionError, self.cpu.mem.read, 0xa100)
+        self.assertEqual(self.cpu.iomap.memory_map, {'0x0': [True, True]})
+
+class WindowDevice(BaseCPUDevice):
+    ports = []
+    memory_block = 0xc
+    def __init__(self, cpu):
+        super(WindowDevice, self).__init__(cpu)
+        self.memory_window = bytearray(0x100)
+
+class TestWindowMap(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.cpu.add_device(WindowDevice)
+        self.device = self.cpu.devices[0]
+    def test_shared_storage(self):
+        self.cpu.mem[0xc010] = 65
+        self.cpu.mem.write16(0xc011, 0x4342)
+        self.assertEqual(self.device.memory_window[0x10:0x13], bytearray('ABC'))
+        self.device.memory_window[0x20] = 90
+        self.assertEqual(self.cpu.mem[0xc020], 90)
+    def test_bulk_transfer(self):
+        self.cpu.mem.writeblock(0x100, 'Hello')
+        self.device.memory_window[0:5] = self.cpu.mem.readblock(0x100, 5)
+        self.assertEqual(self.cpu.mem.readblock(0xc000, 5), 'Hello')
+        self.cpu.mem.writeblock(0x200, memoryview(self.device.memory_window)[1:4])
+        self.assertEqual(self.cpu.mem.readblock(0x200, 3), 'ell')
+    def test_hello_world_copy(self):
+        self.cpu.add_device(HelloWorldHook)
+        self.cpu.cpu_hooks[32].output(32, 0x300)
+        self.cpu.cpu_hooks[32].input(32)
+        self.assertEqual(self.cpu.mem.readblock(0x300, 12), 'Hello World!')
+
+class BufferDevice(BaseCPUDevice):
+    ports = []
+    dma_channel = 2
+    def __init__(self, cpu):
+        super(BufferDevice, self).__init__(cpu)
+        self.data = bytearray('0123456789abcdef')
+    def dma_read(self, offset, size):
+        return self.data[offset:offset+size]
+    def dma_write(self, offset, data):
+        self.data[offset:offset+len(data)] = data
+
+class TestDMAController(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.cpu.add_device(BufferDevice)
+        self.cpu.add_device(DMAController)
+        self.cpu.start_devices()
+        self.device, self.dma = self.cpu.devices
+    def program(self, src, dest, size, cmd):
+        for port, value in ((40, src), (41, dest), (42, size), (43, 2), (44, cmd)):
+            self.dma.output(port, value)
+    def test_transfer(self):
+        self.program(4, 0x100, 8, DMAController.TO_MEMORY)
+        self.assertEqual(self.dma.input(44), 0)
+        self.assertEqual(self.cpu.mem.readblock(0x100, 8), '456789ab')
+        self.program(0x101, 0, 3, DMAController.FROM_MEMORY)
+        self.assertEqual(str(self.device.data[:4]), '5673')
+        self.assertEqual(self.dma.transfers, 2)
+    def test_burst(self):
+        self.dma.burst = 4
+        self.program(0, 0x100, 10, DMAController.TO_MEMORY)
+        self.assertEqual(self.dma.input(44), 1)
+        self.cpu.device_cycle()
+        self.cpu.device_cycle()
+        self.assertEqual(self.dma.input(42), 2)
+        self.cpu.device_cycle()
+        self.assertEqual(self.dma.input(44), 0)
+        self.assertEqual(self.cpu.mem.readblock(0x100, 10), '0123456789')
+
+class TestBlockDevice(unittest.TestCase):
+    def setUp(self):
+        fd, self.image = tempfile.mkstemp()
+        os.write(fd, ''.join(chr(i)*512 for i in range(64)))
+        os.close(fd)
+        self.cpu = CPU()
+        self.cpu.add_device(type('Disk', (BlockDevice,), {'filename': self.image, 'cache_sectors': 8}))
+        self.disk = self.cpu.devices[0]
+    def tearDown(self):
+        self.disk.image.close()
+        os.unlink(self.image)
+    def test_guest_transfer(self):
+        assemble(self.cpu, """
+            out 60,3
+            out 61,4096
+            out 62,1
+            out 60,10
+            out 62,2
+            hlt
+        """)
+        self.cpu.run()
+        self.assertEqual(self.cpu.mem.readblock(0x1000, 512), '\x03'*512)
+        self.assertEqual(self.disk.sector, 11)
+        self.assertEqual(self.disk.flushes, 1)
+        self.assertEqual(open(self.image, 'rb').read()[10*512:11*512], '\x03'*512)
+    def test_cache(self):
+        for sector in range(20, 30):
+            self.assertEqual(str(self.disk.get(sector)), chr(sector)*512)
+        stats = self.disk.stats()
+        self.assertEqual((stats['misses'], stats['hits'], stats['host_reads']), (3, 7, 3))
+        self.assertEqual(stats['cached'], 8)
+        self.disk.dma_write(510, 'abcd')
+        self.disk.sector = 40
+        self.disk.dma_write(0, 'x')
+        self.disk.get(0)
+        self.disk.flush()
+        self.assertEqual(self.disk.dma_read(0, 2), 'x\x28')
+        data = open(self.image, 'rb').read()
+        self.assertEqual(data[510:514], 'abcd')
+        self.assertEqual(data[40*512], 'x')
+        self.assertEqual(self.disk.stats()['dirty'], 0)
+        self.assertRaises(CPUException, self.disk.get, 64)
+
+class TestInterrupts(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.cpu.mem.add_map(0xe, MemoryMap(0x2000))
+        self.cpu.add_device(InterruptController)
+        self.cpu.add_device(TimerDevice)
+        self.cpu.mem.write16(len(self.cpu.mem)-512+InterruptController.base*2, 0x100)
+        assemble(self.cpu, """
+            inc bx
+            out 22,ax
+            ret
+        """, 0x100)
+    def test_software_interrupt(self):
+        self.cpu.mem.write16(len(self.cpu.mem)-512+10*2, 0x200)
+        assemble(self.cpu, "inc cx\nret", 0x200)
+        assemble(self.cpu, "mov ss,4096\nint 10\nint 10\nhlt")
+        self.cpu.run()
+        self.assertEqual(self.cpu.cx.b, 2)
+        self.assertEqual(self.cpu.sp.b, 0)
+    def test_watchdog_wakes_halt(self):
+        self.cpu.add_device(type('Watchdog', (WatchdogDevice,), {'seconds': 0.1}))
+        assemble(self.cpu, "mov ax,1\nout 23,ax\nhlt")
+        raised = []
+        def run():
+            try:
+                self.cpu.run()
+            except ExecutionLimit, e:
+                raised.append(e)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEqual(len(raised), 1)
+    def test_timer_wakes_halt(self):
+        assemble(self.cpu, """
+            mov ss,4096
+            mov ax,1
+            out 23,ax
+            mov ax,5
+            out 30,ax
+            hlt
+            cmp bx,3
+            jne 19
+            mov ax,0
+            out 23,ax
+            hlt
+        """)
+        self.cpu.run()
+        self.assertEqual(self.cpu.bx.b, 3)
+        self.assertEqual(self.cpu.devices[1].ticks, 3)
+        self.assertFalse(self.cpu.pic.in_service)
+    def test_bulk_registers(self):
+        cpu = self.cpu
+        cpu.ss.value = 0x1000
+        for i, reg in enumerate(cpu.regs.pushable):
+            getattr(cpu, reg).value = i+1
+        cpu.push_registers()
+        self.assertEqual(cpu.mem.read16(0x1002), 2)
+        cpu.clear_registers(['ss', 'sp'])
+        cpu.pop_registers()
+        self.assertEqual([getattr(cpu, reg).b for reg in cpu.regs.pushable], range(1, 11))
+        self.assertEqual(cpu.sp.b, 0)
+    def test_task_switch(self):
+        assemble(self.cpu, """
+            cseg 256
+            pushf
+            push ax
+            mov ax,1024
+            cmp cr,ax
+            jne *switch
+            mov ax,1056
+            label switch
+            out 22,ax
+            tsw ax
+            pop ax
+            popf
+            ret
+        """, 0x100)
+        assemble(self.cpu, "label b\ninc bx\njmp *b", 0x300)
+        for reg, value in (('ip', 0x300), ('ss', 0x1800), ('cr', 1056)):
+            self.cpu.mem.write16(1056+self.cpu.regs.registers.index(reg)*2, value)
+        assemble(self.cpu, """
+            mov ss,4096
+            mov cr,1024
+            mov ax,1
+            out 30,ax
+            mov ax,0
+            label loop
+            inc ax
+            cmp ax,3000
+            jne *loop
+            hlt
+        """)
+        self.cpu.run()
+        self.assertEqual(self.cpu.ax.b, 3000)
+        self.assertEqual(self.cpu.cr.b, 1024)
+        self.assertEqual(self.cpu.sp.b, 0)
+        self.assertTrue(self.cpu.mem.read16(1056+4) > 0)
+        self.assertEqual(self.cpu.mem.read16(1056+9*2), 0x100)
+
+class PollDevice(BaseCPUDevice):
+    ports = [50]
+    value = 0
+    def in_50(self):
+        return self.value
+
+class TestIdleLoops(unittest.TestCase):
+    def setUp(self):
+        self.cpu = CPU()
+        self.detector = IdleLoopDetector(self.cpu)
+        self.profiler = Profiler(self.cpu)
+    def test_counter_loop(self):
+        assemble(self.cpu, """
+            mov cx,0
+            inc cx
+            cmp cx,1000
+            jne 3
+            hlt
+        """)
+        self.cpu.run()
+        self.assertEqual(self.cpu.cx.b, 1000)
+        self.assertTrue(self.cpu.flags.bit(0))
+        self.assertEqual(self.profiler.executed, 5)
+        self.assertEqual(self.cpu.cycles, 5)
+        self.assertEqual(self.detector.skipped, 3*999)
+        assemble(self.cpu, "mov cx,0\ninc cx\ncmp cx,16\njne 3\nhlt")
+        self.cpu.run()
+        self.assertEqual(self.cpu.cx.b, 16)
+    def test_polling_loop(self):
+        self.cpu.add_device(PollDevice)
+        device = self.cpu.devices[0]
+        def ready():
+            device.value = 1
+            self.cpu.wake()
+        timer = threading.Timer(0.05, ready)
+        timer.start()
+        assemble(self.cpu, """
+            in ax,50
+            cmp ax,0
+            je 0
+            hlt
+        """)
+        self.cpu.run()
+        timer.join()
+        self.assertEqual(self.cpu.ax.b, 1)
+        self.assertTrue(self.detector.sleeps > 0)
+        self.assertTrue(self.cpu.cycles < 3*(IdleLoopDetector.poll_threshold+self.detector.sleeps+10))
+
+@unittest.skipIf(batch.numpy is None, 'NumPy is not installed.')
+class TestBatchCPU(unittest.TestCase):
+    source = """
+        mov cx,0
+        mov bx,0
+        add bx,cx
+        inc cx
+        cmp cx,ax
+        jne 6
+        mov &h64,bx
+        pop dx
+        hlt
+    """
+    def reference(self, ax):
+        cpu = CPU()
+        assemble(cpu, self.source)
+        cpu.ax.value = ax
+        cpu.ds.value = 0x800
+        cpu.sp.value = 2
+        cpu.run(0, ['ax', 'ds', 'sp'])
+        return cpu.bx.b, cpu.mem.read16(0x864), cpu.ip.b
+    def test_lockstep_matches_cpu(self):
+        cpu = CPU()
+        assemble(cpu, self.source)
+        engine = batch.BatchCPU(20)
+        engine.writeblock(0, cpu.mem.readblock(0, 0x20))
+        engine.register('ax')[:] = range(1, 21)
+        engine.register('ds')[:] = 0x800
+        engine.register('sp')[:] = 2
+        engine.run(0, ['ax', 'ds', 'sp'])
+        self.assertEqual(engine.errors, {})
+        for i in (0, 7, 19):
+            state = (engine.register('bx')[i], engine.read16([i], 0x864)[0], engine.register('ip')[i])
+            self.assertEqual(state, self.reference(i+1))
+    def test_faults_are_per_instance(self):
+        cpu = CPU()
+        assemble(cpu, "pop ax\nhlt")
+        engine = batch.BatchCPU(4)
+        engine.writeblock(0, cpu.mem.readblock(0, 4))
+        engine.register('ss')[:] = 0x100
+        engine.register('sp')[:] = [0, 2, 0, 2]
+        engine.run(0, ['ss', 'sp'])
+        self.assertEqual(engine.errors, {0: 'Stack out of range.', 2: 'Stack out of range.'})
+        self.assertEqual(list(engine.register('ip')), [0, 3, 0, 3])
+
+class TestFlags(unittest.TestCase):
+    pairs = [(5, 7), (7, 5), (5, 5), (0xffff, 1), (1, 0xffff), (0x8000, 1), (0x7fff, 0xffff)]
+    jumps = {
+        'je': lambda a, b, sa, sb: a == b,
+        'jne': lambda a, b, sa, sb: a != b,
+        'jl': lambda a, b, sa, sb: sa < sb,
+        'jg': lambda a, b, sa, sb: sa > sb,
+        'jle': lambda a, b, sa, sb: sa <= sb,
+        'jge': lambda a, b, sa, sb: sa >= sb,
+        'jb': lambda a, b, sa, sb: a < b,
+        'ja': lambda a, b, sa, sb: a > b,
+        'jbe': lambda a, b, sa, sb: a <= b,
+        'jae': lambda a, b, sa, sb: a >= b,
+    }
+    def program(self, cpu, jump):
+        assemble(cpu, "cmp ax,bx\n%s 8\nmov cx,1\nhlt" % jump)
+    def test_conditional_jumps(self):
+        signed = lambda v: v-0x10000 if v&0x8000 else v
+        for jump, expected in self.jumps.items():
+            for a, b in self.pairs:
+                cpu = CPU()
+                self.program(cpu, jump)
+                cpu.ax.value, cpu.bx.value = a, b
+                cpu.run(0, ['ax', 'bx'])
+                self.assertEqual(cpu.cx.b == 0, expected(a, b, signed(a), signed(b)), (jump, a, b))
+    def test_lazy_flags(self):
+        cpu = CPU()
+        cpu.flags.value = 0x80
+        cpu.compare(1, 2)
+        self.assertEqual(cpu.flags.value, 0x80|0x6)
+        cpu.compare(3, 3)
+        cpu.flags.bit(7, False)
+        self.assertEqual(cpu.flags.value, 0x1)
+        assemble(cpu, "cmp ax,1\npushf\nhlt")
+        cpu.ss.value = 0x100
+        cpu.run(0, ['ss'])
+        self.assertEqual(cpu.mem.read16(0x100), 0x6)
+    @unittest.skipIf(batch.numpy is None, 'NumPy is not installed')
+    def test_batch_flags(self):
+        for jump, expected in self.jumps.items():
+            cpu = CPU()
+            self.program(cpu, jump)
+            engine = batch.BatchCPU(len(self.pairs))
+            engine.writeblock(0, cpu.mem.readblock(0, 0x10))
+            engine.register('ax')[:] = [a for a, b in self.pairs]
+            engine.register('bx')[:] = [b for a, b in self.pairs]
+            engine.run(0, ['ax', 'bx'])
+            for i, (a, b) in enumerate(self.pairs):
+                cpu.ax.value, cpu.bx.value = a, b
+                cpu.run(0, ['ax', 'bx'])
+                self.assertEqual(engine.register('cx')[i], cpu.cx.b, (jump, a, b))
+                self.assertEqual(engine.flags[i], cpu.flags.value)
+
+class TestFusion(unittest.TestCase):
+    loop = "mov ax,0\nmov bx,3\nmov cx,ax\nmov dx,bx\ninc ax\ncmp ax,%d\njl %d\nhlt"
+    def execute(self, source, enabled, modify=None):
+        cpu = CPU()
+        addresses = assemble(cpu, source)
+        fuser = Fuser(cpu)
+        fuser.enabled = enabled
+        cpu.run()
+        if modify is not None:
+            modify(cpu, addresses)
+            cpu.run()
+        return [getattr(cpu, reg).b for reg in cpu.var_map]+[cpu.flags.value, cpu.cycles], fuser.fused
+    def test_fused_matches_unfused(self):
+        cpu = CPU()
+        source = self.loop % (300, assemble(cpu, self.loop % (300, 0))[2])
+        plain, fused = self.execute(source, False)
+        self.assertEqual(fused, 0)
+        state, fused = self.execute(source, True)
+        self.assertEqual(state, plain)
+        self.assertEqual(fused, 2+5*300)
+    def test_jump_into_pair_and_modified_code(self):
+        cpu = CPU()
+        source = "cmp ax,1\njmp %d\ncmp ax,0\njne %d\nmov cx,1\nhlt"
+        addresses = assemble(cpu, source % (0, 0))
+        source = source % (addresses[3], addresses[5])
+        self.assertEqual(self.execute(source, True), (self.execute(source, False)[0], 0))
+        source = "cmp ax,%d\nje %d\nmov cx,1\nhlt"
+        addresses = assemble(cpu, source % (0, 0))
+        source = source % (0, addresses[3])
+        modify = lambda cpu, addresses: cpu.mem.write(addresses[0]+1, 0x11)
+        state = self.execute(source, True, modify)[0]
+        self.assertEqual(state, self.execute(source, False, modify)[0])
+        self.assertEqual(state[cpu.var_map.index('cx')], 1)
+
+class TestPeephole(unittest.TestCase):
+    source = """
+    mov ax,5
+    mov bx,ax
+    mov ax,bx
+    add ax,3
+    sub ax,1
+    mov cx,1
+    mov cx,2
+    inc cx
+    dec cx
+    jmp *skip
+    mov dx,99
+    label skip
+    cmp cx,%d
+    jne *done
+    mov &h5,cx
+    mov dx,h10
+    mul dx,4
+    jmp *done
+    label done
+    mov bx,&*tail
+    hlt
+    label tail
+    data AB
+    """
+    def execute(self, source):
+        cpu = CPU()
+        assemble(cpu, source)
+        size = cpu.mem.ptr
+        cpu.run()
+        return [getattr(cpu, reg).b for reg in ('ax', 'bx', 'cx', 'dx')]+[cpu.mem.read(5)], size
+    def optimize(self, source):
+        coder = Coder()
+        coder.configure(CPU())
+        optimizer = PeepholeOptimizer(coder)
+        return '\n'.join(optimizer.optimize(source.strip().splitlines())), optimizer.report
+    def test_forward_labels(self):
+        cpu = CPU()
+        assemble(cpu, "jmp *end\nmov ax,&*end\nmov &h5,*end\nlabel end\nhlt")
+        self.assertEqual(decode(cpu.mem.read, 0), (6, [(3, 15)], 4))
+        self.assertEqual(decode(cpu.mem.read, 4), (2, [(5, 15), (0, 1)], 5))
+        self.assertEqual(decode(cpu.mem.read, 9), (2, [(3, 15), (4, 5)], 6))
+    def test_optimizer(self):
+        for value in (2, 3):
+            source = self.source % value
+            optimized, report = self.optimize(source)
+            state, size = self.execute(source)
+            self.assertEqual(self.execute(optimized)[0], state)
+            self.assertEqual(report['bytes'], (size, 35))
+            self.assertEqual(report['instructions'], (19, 10))
+        loop = "mov ax,0\nmov ax,0\nadd ax,1\ncmp ax,5\njne 6\nhlt"
+        optimized, report = self.optimize(loop)
+        self.assertEqual(optimized, "mov ax,0\nlabel @6\nadd ax,1\ncmp ax,5\njne 3\nhlt")
+        self.assertEqual(self.execute(optimized)[0], self.execute(loop)[0])
+        self.assertEqual(self.optimize("jmp 1\nhlt")[1], {'skipped': 'jmp 1 jumps into the middle of an instruction'})
+
+class TestFixedWidth(unittest.TestCase):
+    source = "mov ds,cs\njmp *main\nlabel msg\ndata Hi\nlabel main\nmov ax,&*msg\nmov cx,300\ninc bx\ncmp bx,cx\njne *main\nhlt"
+    def assemble(self, fixed):
+        cpu = CPU()
+        cpu.fixed = fixed
+        addresses = assemble(cpu, self.source)
+        return cpu, [addr for i, addr in enumerate(addresses) if i not in (2, 3)]
+    def test_encodings_match(self):
+        results = []
+        for fixed in (False, True):
+            cpu, addresses = self.assemble(fixed)
+            decoded = [decode(cpu.mem.read, addr, fixed) for addr in addresses]
+            results.append([(op, [1 if typ in (2,3,) else typ for typ, value in operands]) for op, operands, size in decoded])
+            cpu.run()
+            results.append([getattr(cpu, reg).b for reg in cpu.var_map if reg != 'ip']+[cpu.cycles])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1], results[3])
+        self.assertEqual(results[1][:3], [ord('H'), 300, 300])
+        self.assertEqual(addresses[2] % 8, 0)
+    def test_image_header(self):
+        cpu, addresses = self.assemble(True)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cpu.savebin(filename, 0, cpu.mem.ptr)
+            self.assertNotEqual(open(filename, 'rb').read(4), 'SCPU')
+            cpu.savebin(filename, 0, cpu.mem.ptr, code=True)
+            self.assertEqual(open(filename, 'rb').read(6), 'SCPU\x01\x01')
+            cpu = CPU()
+            cpu.loadbin(filename, 0)
+            self.assertEqual((cpu.fixed, cpu.fixed_at(0), cpu.fixed_at(os.path.getsize(filename))), (False, True, False))
+            cpu.run()
+            self.assertEqual(cpu.bx.b, 300)
+            self.assertRaises(CPUException, CPU().loadbin, filename, 4)
+        finally:
+            os.unlink(filename)
+    def test_mixed_encodings(self):
+        directory = tempfile.mkdtemp()
+        try:
+            handler, program, table = [os.path.join(directory, name) for name in ('interrupt.bin', 'main.bin', 'interrupt.tbl')]
+            cpu = CPU()
+            assemble(cpu, "mov bx,7\nret")
+            cpu.savebin(handler, 0, cpu.mem.ptr, code=True)
+            cpu = CPU()
+            cpu.fixed = True
+            assemble(cpu, "mov ss,4096\nmov ax,3\nint 10\ninc ax\nhlt")
+            cpu.savebin(program, 0, cpu.mem.ptr, code=True)
+            open(table, 'wb').write('\x00'*20+'\x00\x02'+'\x00'*490)
+            int_table = len(cpu.mem)-512
+            for order in ((program, 0), (table, int_table), (handler, 0x200)), ((handler, 0x200), (table, int_table), (program, 0)):
+                cpu = CPU(sparse=True)
+                for filename, dest in order:
+                    cpu.loadbin(filename, dest)
+                cpu.run()
+                self.assertEqual((cpu.ax.b, cpu.bx.b, cpu.fixed_at(0), cpu.fixed_at(0x200)), (4, 7, True, False))
+        finally:
+            shutil.rmtree(directory)
+
+class TestFuzzer(unittest.TestCase):
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.output)
+    def test_snapshot_restore(self):
+        cpu = CPU()
+        clean = cpu.snapshot()
+        assemble(cpu, "mov ax,300\nmov &h64,ax\nhlt")
+        cpu.run()
+        self.assertEqual(cpu.mem.read16(0x64), 300)
+        cpu.restore(clean)
+        self.assertEqual(cpu.mem.read16(0x64), 0)
+        self.assertEqual(cpu.mem.readblock(0, 8), '\x00'*8)
+        self.assertEqual(cpu.ax.b, 0)
+    def test_crashes_and_hangs(self):
+        seeds = [pack_input('\x05'), pack_input('\xff'), pack_input('\x06\x10'), pack_input('\x03\x30\xfa\x00\x01\x05', 'A')]
+        fuzzer = Fuzzer(self.output, seeds, seed=1)
+        self.assertEqual(fuzzer.crashes.keys(), ['CPUException: Invalid OpCode detected: N'])
+        self.assertEqual(fuzzer.hangs.keys(), ['ExecutionLimit: Instruction budget of N exceeded.'])
+        self.assertEqual(open(fuzzer.crashes.values()[0], 'rb').read(), seeds[1])
+        self.assertEqual(fuzzer.cpu.ax.b, ord('A'))
+        fuzzer.fuzz(iterations=50)
+        self.assertEqual(fuzzer.execs, 54)
+        self.assertTrue(fuzzer.edges > 0)
+        self.assertEqual(len(os.listdir(os.path.join(self.output, 'queue'))), len(fuzzer.corpus)-2)
+
+class TestReplay(unittest.TestCase):
+    program = """
+        mov ss,4096
+        in dx,50
+        mov ax,1
+        out 23,ax
+        mov ax,5
+        out 30,ax
+        hlt
+        cmp bx,3
+        jne 23
+        out 41,256
+        out 42,8
+        out 43,2
+        out 44,1
+        mov ax,0
+        out 23,ax
+        hlt
+    """
+    def setUp(self):
+        fd, self.log = tempfile.mkstemp()
+        os.close(fd)
+    def tearDown(self):
+        os.unlink(self.log)
+    def machine(self, devices, program=None):
+        cpu = CPU()
+        cpu.mem.add_map(0xe, MemoryMap(0x2000))
+        for device in devices:
+            cpu.add_device(device)
+        for line in (TimerDevice.irq, DMAController.irq):
+            cpu.mem.write16(len(cpu.mem)-512+(InterruptController.base+line)*2, 0x200)
+        assemble(cpu, "inc bx\nout 22,ax\nret", 0x200)
+        assemble(cpu, program or self.program)
+        cpu.start_devices()
+        return cpu
+    def test_replay_matches_recording(self):
+        PollDevice.value = 7
+        cpu = self.machine([InterruptController, TimerDevice, PollDevice, BufferDevice, DMAController])
+        recorder = Recorder(cpu, self.log)
+        cpu.run()
+        recorder.close()
+        self.assertEqual(cpu.mem.readblock(0x100, 8), '01234567')
+        copy = self.machine([])
+        device = replay(copy, self.log)
+        copy.run()
+        self.assertFalse(device.io or device.timed)
+        for reg in ('ax', 'bx', 'dx', 'ip', 'sp'):
+            self.assertEqual(getattr(copy, reg).b, getattr(cpu, reg).b)
+        self.assertEqual(copy.cycles, cpu.cycles)
+        self.assertEqual(copy.mem.readblock(0, 0x200), cpu.mem.readblock(0, 0x200))
+    def test_divergence(self):
+        PollDevice.value = 7
+        cpu = self.machine([PollDevice], "in dx,50\nhlt")
+        recorder = Recorder(cpu, self.log)
+        cpu.run()
+        recorder.close()
+        copy = self.machine([], "inc dx\nin dx,50\nhlt")
+        replay(copy, self.log)
+        self.assertRaises(ReplayDivergence, copy.run)
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name, source in (('inc.bin', "inc ax\ninc ax\nmov bx,ds\nhlt"), ('spin.bin', "jmp 0")):
+            cpu = CPU()
+            assemble(cpu, source)
+            cpu.savebin(os.path.join(self.dir, name), 0, cpu.mem.ptr)
+        self.manifest = os.path.join(self.dir, 'manifest.json')
+        json.dump({'defaults': {'instructions': 50, 'ds': 300}, 'runs': [
+            {'name': 'inc', 'binary': 'inc.bin', 'devices': ['TimerDevice']},
+            {'name': 'spin', 'binary': 'spin.bin'},
+            {'name': 'missing', 'binary': 'missing.bin', 'devices': ['NoSuchDevice']},
+        ]}, open(self.manifest, 'w'))
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def test_manifest(self):
+        inc, spin, missing = runner.run_manifest(json.load(open(self.manifest)), self.dir)
+        self.assertEqual((inc['state'], inc['instructions'], inc['registers']['ax'], inc['registers']['bx']), ('halted', 4, 2, 300))
+        self.assertEqual((spin['state'], spin['instructions']), ('limit', 50))
+        self.assertEqual(missing['state'], 'error')
+        self.assertTrue(missing['error'].startswith('AttributeError'))
+    def test_host_errors(self):
+        cpu = CPU()
+        assemble(cpu, "mov ax,5\ndiv ax,0\nhlt")
+        cpu.savebin(os.path.join(self.dir, 'div.bin'), 0, cpu.mem.ptr)
+        results = list(runner.run_manifest({'runs': [{'binary': 'div.bin'}, {'binary': 'inc.bin'}]}, self.dir))
+        self.assertEqual([result['state'] for result in results], ['error', 'halted'])
+        self.assertTrue(results[0]['error'].startswith('ZeroDivisionError'))
+    def test_headless_imports(self):
+        output = os.path.join(self.dir, 'results')
+        script = 'import sys; sys.argv[1:] = %r; from simple_cpu import runner\ntry: runner.main()\nexcept SystemExit: pass\n' \
+                 'print sorted(name for name in ("cmd", "readline", "simple_cpu.asm", "simple_cpu.framebuffer") if name in sys.modules)'
+        process = subprocess.Popen([sys.executable, '-c', script % [self.manifest, '-o', output]], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(stdout.strip(), '[]')
+        self.assertEqual(json.loads(stderr)['runs'], 3)
+        self.assertEqual(json.load(open(os.path.join(output, 'spin.json')))['state'], 'limit')
+    def test_metrics(self):
+        metrics = os.path.join(self.dir, 'runs.prom')
+        script = 'import sys; sys.argv[1:] = %r; from simple_cpu import runner\ntry: runner.main()\nexcept SystemExit: pass\n'
+        process = subprocess.Popen([sys.executable, '-c', script % [self.manifest, '-o', self.dir, '-m', metrics]], stderr=subprocess.PIPE)
+        process.communicate()
+        text = open(metrics).read().splitlines()
+        self.assertIn('simple_cpu_instructions_total{vm="inc"} 4', text)
+        self.assertIn('simple_cpu_instructions_total{vm="spin"} 50', text)
+
+class TestQuota(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        cpu = CPU()
+        assemble(cpu, "jmp 0")
+        cpu.savebin(os.path.join(self.dir, 'spin.bin'), 0, cpu.mem.ptr)
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def test_resume(self):
+        cpu = CPU()
+        cpu.add_device(WatchdogDevice)
+        cpu.add_device(type('Quota', (QuotaDevice,), {'budget': 50, 'weights': {0x11: 2}}))
+        assemble(cpu, "mov cx,0\nlabel loop\ninc cx\nout 99,cx\ncmp cx,10\njne *loop\nhlt")
+        self.assertRaises(QuotaExceeded, cpu.run)
+        watchdog, quota = cpu.devices
+        self.assertEqual((cpu.cx.b, quota.used), (4, 47))
+        while True:
+            quota.grant(50)
+            try:
+                cpu.resume()
+                break
+            except QuotaExceeded:
+                pass
+        self.assertEqual((cpu.cx.b, watchdog.count), (10, 42))
+        self.assertEqual(quota.usage(), {'cost': 152, 'budget': 200, 'instructions': 42, 'io': 10, 'dma_bytes': 0, 'exceeded': 3})
+    def test_manifest(self):
+        result = runner.execute({'binary': 'spin.bin', 'quota': 100, 'weights': {'0x6': 3}}, self.dir)
+        self.assertEqual((result['state'], result['instructions'], result['usage']['cost']), ('limit', 33, 99))
+
+class TestMetrics(unittest.TestCase):
+    def test_sample(self):
+        cpu = CPU()
+        cpu.add_device(TimerDevice)
+        metrics = Registry().add(cpu, 'timer', memory=True)
+        assemble(cpu, "mov ax,5\nout 30,ax\nin bx,30\nmov &h1000,ax\nhlt")
+        cpu.run()
+        cpu.run()
+        sample = metrics.sample()
+        self.assertEqual(sample['instructions'], 10)
+        self.assertEqual(sample['ports'], {(30, 'out'): 2, (30, 'in'): 2})
+        self.assertEqual(sample['pages'][(0x10, 'write')], 2)
+    def test_same_name(self):
+        registry = Registry()
+        cpus = [CPU() for i in range(3)]
+        for cpu in cpus:
+            metrics = registry.add(cpu, 'hello.bin')
+            assemble(cpu, "inc ax\nhlt")
+            cpu.run()
+            if cpu is not cpus[-1]:
+                registry.remove(metrics)
+        lines = [line for line in registry.text().splitlines() if line.startswith('simple_cpu_instructions_total')]
+        self.assertEqual(lines, ['simple_cpu_instructions_total{vm="hello.bin"} 6'])
+        self.assertEqual(len(registry.finished), 1)
+    def test_export(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'image.bin')
+            open(filename, 'wb').write('\x00\xff')
+            registry = Registry()
+            cpu = CPU()
+            registry.add(cpu, 'bad')
+            cpu.loadbin(filename, 0)
+            self.assertRaises(CPUException, cpu.run)
+            registry.write(os.path.join(directory, 'vm.prom'))
+            text = open(os.path.join(directory, 'vm.prom')).read().splitlines()
+        finally:
+            shutil.rmtree(directory)
+        self.assertIn('# TYPE simple_cpu_instructions_total counter', text)
+        self.assertIn('simple_cpu_instructions_total{vm="bad"} 1', text)
+        self.assertIn('simple_cpu_image_bytes{vm="bad",image="%s"} 2' % filename, text)
+        self.assertIn('simple_cpu_exceptions_total{vm="bad",type="CPUException"} 1', text)
+
+class TestSymbols(unittest.TestCase):
+    def test_lookup(self):
+        symbols = SymbolTable()
+        for name, addr in (('main', 0x100), ('data', 0x400), ('loop', 0x120), ('end', 0x1f0)):
+            symbols.add(name, addr)
+        self.assertEqual(symbols.lookup(0x124), ('loop', 4))
+        self.assertEqual(symbols.lookup(0x50), None)
+        self.assertEqual((symbols.describe(0x100), symbols.describe(0x1ff), symbols.describe(0x50)), ('main', 'end+0xf', '0x50'))
+        symbols.add('loop', 0x130)
+        self.assertEqual((symbols.lookup(0x124), symbols.lookup(0x130), len(symbols)), (('main', 0x24), ('loop', 0), 4))
+    def test_image(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cpu = CPU()
+            lines = assemble(cpu, "label start\nmov cx,3\nlabel loop\ndec cx\ncmp cx,0\njne *loop\nlabel bad\nhlt")
+            cpu.mem.write(lines[-1], 0xff)
+            filename = os.path.join(directory, 'image.bin')
+            cpu.savebin(filename, 0, lines[-1]+1)
+            self.assertEqual(open(symbol_file(filename)).read().split(), ['0000', 'start', '0003', 'loop', '000a', 'bad'])
+            cpu = CPU()
+            cpu.loadbin(filename, 0x100)
+            profiler = Profiler(cpu)
+            with self.assertRaises(CPUException) as raised:
+                cpu.run(0x100)
+            cpu.savebin(filename, 0, 0x10)
+            self.assertFalse(os.path.exists(symbol_file(filename)))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(str(raised.exception), 'Invalid OpCode detected: 255 (at bad)')
+        self.assertEqual(profiler.labels(), [('loop', 9), ('bad', 1), ('start', 1)])
+
+class BrokenCPU(CPU):
+    def opcode_0xa(self):
+        """ INC """
+        CPU.opcode_0xa(self)
+        if self.cx.b == 13:
+            self.cx.value += 1
+
+class TestDifferential(unittest.TestCase):
+    program = "mov cx,0\nlabel loop\ninc cx\nmov &h1000,cx\ncmp cx,20\njne *loop\nhlt"
+    def machine(self, klass=CPU, engine=None, program=None):
+        cpu = klass()
+        assemble(cpu, program or self.program)
+        if engine is not None:
+            engine(cpu)
+        return CPUEngine(cpu)
+    def test_engines_agree(self):
+        self.assertEqual(DifferentialTest(self.machine, lambda: self.machine(engine=Fuser), every=10).run(), None)
+        def vectorized():
+            engine = batch.BatchCPU(1)
+            cpu = CPU()
+            assemble(cpu, self.program)
+            engine.writeblock(0, cpu.mem.readblock(0, 0x20))
+            return BatchEngine(engine)
+        self.assertEqual(DifferentialTest(self.machine, vectorized, every=10).run(), None)
+    def test_divergence(self):
+        divergence = DifferentialTest(self.machine, lambda: self.machine(BrokenCPU, Fuser), every=25).run()
+        self.assertEqual(divergence.cycles, 50)
+        self.assertEqual(divergence.differences, ['cx: 0xd != 0xe'])
+        self.assertEqual(divergence.trace[-1], (49, 'loop', 'inc cx'))
+        self.assertIn('Divergence after 50 instructions', str(divergence))
+
+    def test_host_errors(self):
+        program = "mov ax,5\ndiv ax,0\nhlt"
+        machine = lambda: self.machine(program=program)
+        self.assertEqual(DifferentialTest(machine, lambda: self.machine(engine=Fuser, program=program)).run(), None)
+        engine = machine()
+        engine.step()
+        engine.step()
+        self.assertFalse(engine.active)
+        self.assertTrue(engine.error.startswith('ZeroDivisionError'))
+
+class TestSMP(unittest.TestCase):
+    def test_cas(self):
+        cpu = CPU()
+        assemble(cpu, "mov ax,5\nmov bx,9\ncas &h1000,bx\nmov cx,ax\ncas &h1000,bx\nhlt")
+        cpu.mem.write16(0x1000, 5)
+        cpu.run()
+        self.assertEqual((cpu.mem.read16(0x1000), cpu.cx.b, cpu.ax.b), (9, 5, 9))
+        self.assertFalse(cpu.flags.bit(0))
+    def test_shared_counter(self):
+        machine = SMPMachine(2)
+        assemble(machine.core(0), """
+            mov cx,0
+            label loop
+            mov ax,&h1000
+            mov bx,ax
+            inc bx
+            cas &h1000,bx
+            jne *loop
+            inc cx
+            cmp cx,300
+            jne *loop
+            hlt
+        """)
+        results = machine.run(timeout=30)
+        self.assertEqual([result['state'] for result in results], ['halted', 'halted'])
+        self.assertEqual(machine.mem.read16(0x1000), 600)
+    def test_errors(self):
+        machine = SMPMachine(2)
+        assemble(machine.core(0), "mov ax,&h3000\nhlt")
+        started = time.time()
+        results = machine.run()
+        self.assertEqual([result['state'] for result in results], ['error', 'error'])
+        self.assertTrue(results[0]['error'].startswith('KeyError'))
+        machine.devices = [type('Exit', (BaseCPUDevice,), {'ports': [], 'cycle': lambda self: os._exit(3)})]
+        results = machine.run(timeout=30)
+        self.assertEqual([result['state'] for result in results], ['error', 'error'])
+        self.assertIn('code 3', results[1]['error'])
+        self.assertLess(time.time()-started, 10)
+    def test_ipi(self):
+        machine = SMPMachine(2)
+        machine.mem.write16(len(machine.mem)-512+(InterruptController.base+2)*2, 0x200)
+        cpu = machine.core(0)
+        assemble(cpu, "mov &h1006,7\nout 22,ax\nret", 0x200)
+        assemble(cpu, """
+            in ax,51
+            cmp ax,0
+            je *sender
+            mov ss,6144
+            mov ax,1
+            out 23,ax
+            mov &h1004,1
+            hlt
+            mov ax,0
+            out 23,ax
+            hlt
+            label sender
+            mov ax,&h1004
+            cmp ax,1
+            jne *sender
+            mov ax,1
+            out 50,ax
+            hlt
+        """)
+        results = machine.run(timeout=30)
+        self.assertEqual([result['state'] for result in results], ['halted', 'halted'])
+        self.assertEqual(machine.mem.read16(0x1006), 7)
 
 if __name__ == '__main__':
     unittest.main()